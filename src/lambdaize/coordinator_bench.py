@@ -0,0 +1,566 @@
+#!/usr/bin/python
+
+###
+#  coordinator scalability benchmark
+#
+#  Forks a swarm of fake workers that speak the SocketNB protocol (with or
+#  without TLS) and answer commands the way libmu.handler would, but with
+#  made-up latencies instead of running anything. Then runs a real server
+#  module's state machine against them and reports coordinator overhead.
+#
+#  e.g., ./coordinator_bench.py -n 2000 -m xcenc_server:XCEncSettingsState -x keyframe_distance=16 -l run=exp:0.5
+#
+#  To compare mainloops, run the same swarm (same -r seed) with
+#    -x event_backend=poll    EventEngine on poll(2) instead of epoll
+#    -E                       the Coordinator embedded in an outside event loop
+###
+
+import collections
+import cPickle
+import errno
+import getopt
+import importlib
+import os
+import random
+import resource
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from libmu import Defs, handler, server, util
+import libmu.event_engine
+import libmu.socket_nb
+import libmu.timers
+
+###
+#  latency distributions, e.g., "const:0.5", "uniform:0.1:0.3", "exp:2", "lognormal:0:0.5"
+###
+distributions = { 'const': lambda a: a
+                , 'uniform': random.uniform
+                , 'exp': lambda mean: random.expovariate(1.0 / mean)
+                , 'lognormal': random.lognormvariate
+                }
+
+def parse_latency(spec):
+    vals = spec.split(':')
+    if vals[0] not in distributions:
+        raise ValueError("unknown latency distribution '%s'" % vals[0])
+
+    dist = distributions[vals[0]]
+    args = [ float(v) for v in vals[1:] ]
+    return lambda: dist(*args)
+
+###
+#  a fake lambda worker: answers like libmu.handler, but jobs just sleep
+#
+#  Messages go through handler.handle_message, so they're split and looked
+#  up (and counted) just as in a real worker; install_fake_commands swaps the
+#  registered commands for the do_* methods below.
+###
+class FakeWorker(object):
+    def __init__(self, swarm, sock):
+        self.swarm = swarm
+        self.sock = sock
+        self.vals = {'nonblock': swarm.nonblock, 'bg_silent': swarm.bg_silent}
+        # what handle_message gets: it sends FAILs to cmdsock, which is us, so they can join a batch
+        self.hvals = {'worker': self, 'cmdsock': self}
+        self.pending = collections.deque()
+        self.busy = False
+        # responses to the batch we're running, if any
+        self.batch = None
+
+        self.start_time = time.time()
+        self.end_time = None
+        # total time covered by at least one job; overlapping jobs only count once
+        self.injected = 0.0
+        self.job_end = self.start_time
+
+        self.sock.enqueue(Defs.hello_binary)
+
+    def handle(self):
+        while True:
+            msg = self.sock.dequeue()
+            if msg is None:
+                break
+            self.pending.append(msg)
+
+        self.run_pending()
+
+    def run_pending(self):
+        # a blocking job holds up everything after it, as it would in a real worker
+        while len(self.pending) > 0 and not self.busy and self.sock.sock is not None:
+            msg = self.pending.popleft()
+            if msg is self.batch_end:
+                if len(self.batch) > 0:
+                    self.sock.enqueue(Defs.batch_response + handler.pack_batch(self.batch))
+                self.batch = None
+                continue
+
+            handler.handle_message(msg, self.hvals)
+
+    # like libmu.handler, responses to a batch go back in one message
+    def reply(self, msg):
+        if self.batch is not None:
+            self.batch.append(msg)
+        else:
+            self.sock.enqueue(msg)
+
+    enqueue = reply
+
+    def _set(self, msg, to_int):
+        res = msg.split(':', 1)
+        if len(res) != 2 or len(res[0]) < 1:
+            self.reply('FAIL(invalid syntax for SET)')
+            return
+
+        if to_int:
+            res[1] = int(res[1])
+            self.reply('OK:SETI(%s)' % res[0])
+        else:
+            self.reply('OK:SET(%s)' % res[0])
+        self.vals[res[0]] = res[1]
+
+    def _get(self, msg, get_info):
+        if self.vals.get(msg) is None:
+            self.reply('FAIL(no such variable %s)' % msg)
+        elif get_info:
+            self.sock.enqueue('INFO:%s:%s' % (msg, self.vals[msg]), Defs.ftype_info)
+            self.reply('OK:GETI(%s)' % msg)
+        else:
+            self.reply('OK:GET(%s)' % self.vals[msg])
+
+    def _background(self, kind, queuemsg, donemsg):
+        now = time.time()
+        delay = self.swarm.latency(kind)
+        self.injected += max(0, now + delay - max(now, self.job_end))
+        self.job_end = max(self.job_end, now + delay)
+
+        if self.vals.get('nonblock'):
+            if not self.vals.get('bg_silent'):
+                self.reply(queuemsg)
+        else:
+            self.busy = True
+        self.swarm.timers.arm(delay, self._job_done, donemsg)
+
+    def _job_done(self, donemsg):
+        self.busy = False
+        if self.sock.sock is None:
+            return
+
+        self.reply(donemsg)
+        self.run_pending()
+
+    def do_set(self, msg):
+        self._set(msg, False)
+
+    def do_seti(self, msg):
+        self._set(msg, True)
+
+    def do_get(self, msg):
+        self._get(msg, False)
+
+    def do_geti(self, msg):
+        self._get(msg, True)
+
+    def do_dump_vals(self, _):
+        self.reply('OK:DUMP_VALS:%s' % str(self.vals))
+
+    def do_retrieve(self, msg):
+        target = msg.split('\0')[0]
+        self._background('retrieve', 'OK:RETRIEVING(%s)' % target, 'OK:RETRIEVE(%s)' % target)
+
+    def do_upload(self, msg):
+        target = msg.split('\0')[0]
+        self._background('upload', 'OK:UPLOADING(%s)' % target, 'OK:UPLOAD(%s)' % target)
+
+    def do_run(self, msg):
+        self._background('run', 'OK:RUNNING(%s)' % msg, 'OK:RETVAL(0):OUTPUT():COMMAND(%s)' % msg)
+
+    def do_echo(self, msg):
+        self.reply('OK:ECHO(%s)' % msg)
+
+    def do_connect(self, msg):
+        # pretend we connected to our neighbor
+        self.reply('OK:CONNECT(%s)' % msg)
+
+    def do_close_connect(self, _):
+        self.reply('OK:CLOSE_CONNECT')
+
+    def do_quit(self, _):
+        # a duplicate that lost the race doesn't finish its job
+        now = time.time()
+        if self.job_end > now:
+            self.injected -= self.job_end - now
+            self.job_end = now
+        self.sock.close()
+
+    def do_batch(self, msg):
+        # run these next, then send everything they said
+        self.batch = []
+        self.pending.appendleft(self.batch_end)
+        self.pending.extendleft(reversed(handler.unpack_batch(msg)))
+
+    batch_end = object()
+
+    fake_commands = { 'set': do_set
+                    , 'seti': do_seti
+                    , 'get': do_get
+                    , 'geti': do_geti
+                    , 'dump_vals': do_dump_vals
+                    , 'retrieve': do_retrieve
+                    , 'upload': do_upload
+                    , 'echo': do_echo
+                    , 'quit': do_quit
+                    , 'run': do_run
+                    , 'connect': do_connect
+                    , 'close_connect': do_close_connect
+                    , 'batch': do_batch
+                    }
+
+def _fake_command(method):
+    return lambda args, vals: method(vals['worker'], args)
+
+# in the swarm process only: commands we don't fake answer FAIL, as unknown ones would
+def install_fake_commands():
+    responses = dict( (verb, cmd[1]) for (verb, cmd) in handler.commands.items() )
+    handler.commands.clear()
+    for (verb, method) in FakeWorker.fake_commands.items():
+        handler.register_command(verb, _fake_command(method), responses[verb])
+
+###
+#  all the fake workers share one event loop in one process
+###
+class Swarm(object):
+    connect_burst = 64
+
+    def __init__(self, bench_info):
+        self.info = bench_info
+        self.nonblock = bench_info.nonblock
+        self.bg_silent = bench_info.bg_silent
+        self.latencies = bench_info.latencies
+        self.engine = libmu.event_engine.EventEngine()
+        self.timers = libmu.timers.TimerQueue()
+        self.workers = {}
+        self.finished = []
+        self.nworkers = bench_info.num_parts + bench_info.overprovision
+        self.nstarted = 0
+        self.nconnected = 0
+
+    def latency(self, kind):
+        sampler = self.latencies.get(kind)
+        if sampler is None:
+            return 0
+        return max(0, sampler())
+
+    def _connect_one(self):
+        info = self.info
+        while True:
+            try:
+                sock = util.connect_socket('127.0.0.1', info.port_number, info.cacert, info.srvcrt, info.srvkey)
+            except socket.error as e:
+                if e.errno != errno.ECONNREFUSED:
+                    raise
+                if self.nconnected > 0:
+                    # coordinator isn't taking spares
+                    return
+                # coordinator isn't listening yet
+                time.sleep(0.05)
+            else:
+                break
+
+        if not isinstance(sock, libmu.SocketNB):
+            raise Exception(str(sock))
+
+        worker = FakeWorker(self, sock)
+        self.engine.register(sock)
+        self.workers[sock.fileno()] = worker
+        self.nconnected += 1
+
+    def run(self):
+        while self.nstarted < self.nworkers or len(self.workers) > 0:
+            # NOTE before connecting more: a new socket can reuse a closed one's fd
+            for sock in self.engine.pop_closed():
+                worker = self.workers.pop(sock.fileno())
+                worker.end_time = time.time()
+                self.finished.append(worker)
+
+            for _ in range(0, min(self.connect_burst, self.nworkers - self.nstarted)):
+                self.nstarted += 1
+                self._connect_one()
+
+            self.timers.run_expired()
+
+            timeout = 0 if self.nstarted < self.nworkers else self.timers.poll_timeout(1000)
+            for (fd, ev) in self.engine.poll(timeout):
+                worker = self.workers.get(fd)
+                if worker is None:
+                    continue
+                if (ev & select.POLLOUT) != 0:
+                    worker.sock.do_write()
+                if (ev & (select.POLLIN | select.POLLHUP | select.POLLERR)) != 0:
+                    worker.sock.do_read()
+
+            for fd in self.engine.pop_ready():
+                worker = self.workers.get(fd)
+                if worker is not None and worker.sock.want_handle:
+                    worker.handle()
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return { 'workers': [ (w.start_time, w.end_time, w.injected, w.sock.msgs_in, w.sock.msgs_out) for w in self.finished ]
+               , 'cpu': usage.ru_utime + usage.ru_stime
+               }
+
+###
+#  benchmark settings
+###
+class BenchInfo(object):
+    num_parts = 100
+    overprovision = 0
+    port_number = 13579
+    server_module = "xcenc_server:XCEncSettingsState"
+    nonblock = 1
+    bg_silent = 1
+    num_shards = 1
+    out_file = None
+    seed = None
+    latency_specs = "run=exp:1,retrieve=uniform:0.1:0.5,upload=uniform:0.1:0.5"
+    latencies = None
+    overrides = []
+    embedded = False
+
+    cacert = None
+    srvcrt = None
+    srvkey = None
+
+def usage_str(defaults):
+    uStr = "Usage: %s [args ...]\n\n" % sys.argv[0]
+    uStr += "  switch         description                                     default\n"
+    uStr += "  --             --                                              --\n"
+    uStr += "  -U:            show this message\n"
+    uStr += "  -n nWorkers:   number of fake workers                          (%d)\n" % defaults.num_parts
+    uStr += "  -X nExtra:     connect nExtra spare workers                    (%d)\n" % defaults.overprovision
+    uStr += "  -m mod:State:  server module and initial state                 ('%s')\n" % defaults.server_module
+    uStr += "  -l k=dist,...: job latencies (const/uniform/exp/lognormal)     ('%s')\n" % defaults.latency_specs
+    uStr += "  -b:            workers run jobs in the foreground              (background)\n"
+    uStr += "  -B:            workers report RUNNING/RETRIEVING/UPLOADING     (silent)\n"
+    uStr += "  -r seed:       random seed for latencies                       (None)\n"
+    uStr += "  -O oFile:      state machine times output file                 (None)\n"
+    uStr += "  -x attr=val:   set ServerInfo.attr (e.g., keyframe_distance=16)\n"
+    uStr += "  -A:            ASCII framing only (no binary frames)           (negotiate)\n"
+    uStr += "  -E:            drive the Coordinator from an outside loop      (run())\n"
+    uStr += "\n  -t portNum:    listen on portNum                               (%d)\n" % defaults.port_number
+    uStr += "  -j nShards:    run nShards coordinator processes on portNum    (%d)\n" % defaults.num_shards
+    uStr += "\n  -c caCert:     CA certificate file                             (None)\n"
+    uStr += "  -s srvCert:    server certificate file                         (None)\n"
+    uStr += "  -k srvKey:     server key file                                 (None)\n"
+    uStr += "     (hint: you can use CA_CERT, SRV_CERT, SRV_KEY envvars instead)\n"
+
+    return (uStr, "Un:X:m:l:bBr:O:x:AEt:j:c:s:k:")
+
+def options(bench_info):
+    (uStr, oStr) = usage_str(bench_info)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], oStr)
+    except getopt.GetoptError as err:
+        print str(err)
+        print uStr
+        sys.exit(1)
+
+    if len(args) > 0:
+        print "ERROR: Extraneous arguments '%s'" % ' '.join(args)
+        print
+        print uStr
+        sys.exit(1)
+
+    cacertfile = os.environ.get('CA_CERT')
+    srvcrtfile = os.environ.get('SRV_CERT')
+    srvkeyfile = os.environ.get('SRV_KEY')
+
+    for (opt, arg) in opts:
+        if opt == "-U":
+            print uStr
+            sys.exit(1)
+        elif opt == "-n":
+            bench_info.num_parts = int(arg)
+        elif opt == "-X":
+            bench_info.overprovision = int(arg)
+        elif opt == "-m":
+            bench_info.server_module = arg
+        elif opt == "-l":
+            bench_info.latency_specs = arg
+        elif opt == "-b":
+            bench_info.nonblock = 0
+        elif opt == "-B":
+            bench_info.bg_silent = 0
+        elif opt == "-r":
+            bench_info.seed = int(arg)
+        elif opt == "-O":
+            bench_info.out_file = arg
+        elif opt == "-x":
+            bench_info.overrides.append(arg.split('=', 1))
+        elif opt == "-A":
+            # both the coordinator and the workers inherit this
+            libmu.socket_nb.SocketNB.binary_framing = False
+        elif opt == "-E":
+            bench_info.embedded = True
+        elif opt == "-t":
+            bench_info.port_number = int(arg)
+        elif opt == "-j":
+            bench_info.num_shards = int(arg)
+        elif opt == "-c":
+            cacertfile = arg
+        elif opt == "-s":
+            srvcrtfile = arg
+        elif opt == "-k":
+            srvkeyfile = arg
+
+    if bench_info.embedded and bench_info.num_shards > 1:
+        print "ERROR: -E and -j are mutually exclusive"
+        print
+        print uStr
+        sys.exit(1)
+
+    bench_info.latencies = {}
+    for spec in bench_info.latency_specs.split(','):
+        if len(spec) > 0:
+            (kind, dist) = spec.split('=', 1)
+            bench_info.latencies[kind] = parse_latency(dist)
+
+    # unlike the real servers, TLS is optional here
+    if cacertfile is not None and srvcrtfile is not None and srvkeyfile is not None:
+        bench_info.cacert = util.read_pem(cacertfile)
+        bench_info.srvcrt = util.read_pem(srvcrtfile)
+        bench_info.srvkey = util.read_pem(srvkeyfile)
+
+###
+#  run the benchmark and print a report
+###
+def percentile(vals, p):
+    if len(vals) == 0:
+        return 0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(len(vals) * p / 100.0))]
+
+def current_rss_kb():
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+###
+#  what a host event loop does with an embedded Coordinator: wait on its
+#  fd, then step it (the fd is epoll's, so this needs the epoll backend)
+###
+def embedded_main_loop(states, constructor, server_info):
+    server_info.start_time = time.time()
+    coord = server.Coordinator(states, constructor, server_info)
+    coord.listen()
+
+    host = select.poll()
+    host.register(coord.fileno(), select.POLLIN)
+    while coord.step(0):
+        host.poll(coord.poll_timeout())
+
+    server._write_results(coord.finish(), server_info) # pylint: disable=protected-access
+
+def run_bench(bench_info):
+    (modname, clsname) = bench_info.server_module.split(':', 1)
+    mod = importlib.import_module(modname)
+    server_info = mod.ServerInfo
+    constructor = getattr(mod, clsname)
+
+    server_info.num_parts = bench_info.num_parts
+    server_info.overprovision = bench_info.overprovision
+    server_info.port_number = bench_info.port_number
+    server_info.num_shards = bench_info.num_shards
+    server_info.out_file = bench_info.out_file
+    server_info.cacert = bench_info.cacert
+    server_info.srvcrt = bench_info.srvcrt
+    server_info.srvkey = bench_info.srvkey
+    server_info.headless = True
+    server_info.status_interval = 5
+    for (attr, val) in bench_info.overrides:
+        for conv in (int, float, str):
+            try:
+                setattr(server_info, attr, conv(val))
+                break
+            except ValueError:
+                pass
+    if hasattr(server_info, 'client_uniq') and server_info.client_uniq is None:
+        server_info.client_uniq = util.rand_str(16)
+
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        if bench_info.seed is not None:
+            random.seed(bench_info.seed)
+        retval = 0
+        try:
+            install_fake_commands()
+            result = Swarm(bench_info).run()
+            with os.fdopen(w, 'w') as wf:
+                cPickle.dump(result, wf, cPickle.HIGHEST_PROTOCOL)
+        except:
+            traceback.print_exc()
+            retval = 1
+        os._exit(retval)
+
+    os.close(w)
+    rss_start = current_rss_kb()
+    ru_self = resource.getrusage(resource.RUSAGE_SELF)
+    ru_child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.time()
+
+    main_loop = embedded_main_loop if bench_info.embedded else server.server_main_loop
+    try:
+        main_loop(getattr(server_info, 'states', []), constructor, server_info)
+    except:
+        # the swarm won't finish on its own
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        raise
+    end_time = time.time()
+
+    with os.fdopen(r, 'r') as rf:
+        result = cPickle.load(rf)
+    os.waitpid(pid, 0)
+
+    ru_self_end = resource.getrusage(resource.RUSAGE_SELF)
+    ru_child_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # with -j, the shards are children too; either way, don't count the swarm
+    cpu = (ru_self_end.ru_utime + ru_self_end.ru_stime) - (ru_self.ru_utime + ru_self.ru_stime)
+    cpu += (ru_child_end.ru_utime + ru_child_end.ru_stime) - (ru_child.ru_utime + ru_child.ru_stime)
+    cpu -= result['cpu']
+
+    # spares that were never used only ever got quit:
+    nmsgs = sum( w[3] + w[4] for w in result['workers'] )
+    workers = [ w for w in result['workers'] if w[3] > 1 ]
+    ideal = max([ w[2] for w in workers ] + [0])
+    overheads = [ (w[1] - w[0]) - w[2] for w in workers ]
+    makespan = end_time - start_time
+
+    print
+    print "workers:            %d (%s, %s)" % (len(workers), bench_info.server_module, "TLS" if bench_info.cacert is not None else "no TLS")
+    print "mainloop:           %s, %s" % ("embedded" if bench_info.embedded else "run()", getattr(server_info, 'event_backend', None) or "default backend")
+    print "messages:           %d" % nmsgs
+    print "makespan:           %.3f s" % makespan
+    print "longest job chain:  %.3f s" % ideal
+    print "makespan overhead:  %.3f s" % (makespan - ideal)
+    print "per-worker overhead (s): mean %.4f, p50 %.4f, p99 %.4f, max %.4f" % (sum(overheads) / max(len(overheads), 1), percentile(overheads, 50), percentile(overheads, 99), max(overheads + [0]))
+    print "coordinator CPU:    %.3f s (%.1f us/message)" % (cpu, 1e6 * cpu / max(nmsgs, 1))
+    if bench_info.num_shards > 1:
+        print "coordinator memory: n/a with -j"
+    else:
+        rss_peak = ru_self_end.ru_maxrss
+        print "coordinator memory: %d KB peak, %.1f KB/actor" % (rss_peak, float(rss_peak - rss_start) / max(len(workers), 1))
+
+def main():
+    options(BenchInfo)
+    run_bench(BenchInfo)
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,12 @@ import select
 import shutil
 import socket
 import tempfile
-import zlib
+import time
 
 from OpenSSL import SSL
 
-from libmu import SocketNB, Defs, util, handler
+from libmu import SocketNB, Defs, util, handler, rawxfer, stream
+from libmu.executor import Executor
 
 ###
 #  send state file to stsock
@@ -35,32 +36,75 @@ def finished_run(msg, vals):
     if not vals.get('send_statefile') or vals.get('stsock') is None:
         return
 
-    # send output state to next worker
-    with open(vals['_tmpdir'] + "/final.state", 'r') as f:
-        indata = ("STATE(%d):" % vals['run_iter']) + zlib.compress(f.read())
-
-    vals['stsock'].enqueue(indata)
+    # stream output state to next worker
+    # NOTE stream from a copy: the next run can overwrite final.state before we're done.
+    #      The open file outlives the unlink.
+    sendfile = vals['_tmpdir'] + "/send%d.state" % vals['run_iter']
+    shutil.copy(vals['_tmpdir'] + "/final.state", sendfile)
+    sfile = open(sendfile, 'r')
+    os.unlink(sendfile)
+    if vals.get('raw_state'):
+        # straight from the file to the socket (just send_stream if stsock is SSL)
+        vals['stsock'].send_file("STATE(%d)" % vals['run_iter'], sfile)
+    else:
+        vals['stsock'].send_stream("STATE(%d)" % vals['run_iter'], sfile)
 
 ###
 #  get state file from stsock
 ###
-def get_input_state(vals):
-    indata = vals['stsock'].dequeue()
-    (msg, data) = indata.split(':', 1)
-
-    if Defs.debug:
-        print "CLIENT received from neighbor: %s... (%d)" % (msg, len(data))
-
+def _state_num(msg):
     assert msg[:6] == "STATE("
     lind = 6
     rind = msg.find(')')
-    statenum = int(msg[lind:rind])
+    return int(msg[lind:rind])
 
-    with open(vals['_tmpdir'] + "/temp.state", 'w') as f:
-        f.write(zlib.decompress(data))
+def _got_state(vals, statenum, nbytes):
+    if Defs.debug:
+        print "CLIENT received from neighbor: STATE(%d) (%d)" % (statenum, nbytes)
 
     # NOTE we write to a tmpfile and rename because renaming is atomic!
-    os.rename(vals['_tmpdir'] + "/temp.state", vals['_tmpdir'] + "/%d.state" % statenum)
+    statefile = vals['_tmpdir'] + "/%d.state" % statenum
+    os.rename(vals['_tmpdir'] + "/temp.state", statefile)
+
+    # start the run that's been waiting for it
+    if vals.get('executor') is not None:
+        vals['executor'].file_arrived(statefile)
+
+def get_input_state(vals):
+    while vals['stsock'].want_handle:
+        indata = vals['stsock'].dequeue()
+
+        # in the middle of a state file: write out this chunk
+        if vals.get('_instate') is not None:
+            (statenum, receiver) = vals['_instate']
+            if receiver.feed(indata):
+                receiver.sink.close()
+                vals['_instate'] = None
+                _got_state(vals, statenum, receiver.nbytes)
+            continue
+
+        # a raw state file: the socket writes it to temp.state and calls raw_state_done
+        raw = rawxfer.parse_begin(indata)
+        if raw is not None:
+            (nbytes, crc, msg) = raw
+            statenum = _state_num(msg)
+            def raw_state_done(receiver, statenum=statenum):
+                if receiver.ok:
+                    _got_state(vals, statenum, receiver.nbytes)
+                else:
+                    vals['cmdsock'].enqueue("FAIL(STATE(%d) failed its checksum)" % statenum)
+
+            sink = open(vals['_tmpdir'] + "/temp.state", 'w+b')
+            vals['stsock'].recv_raw(rawxfer.RawReceiver(sink, nbytes, crc, raw_state_done))
+            continue
+
+        begin = stream.parse_begin(indata)
+        assert begin is not None
+        (msg, compressed) = begin
+        statenum = _state_num(msg)
+
+        sink = open(vals['_tmpdir'] + "/temp.state", 'w')
+        vals['_instate'] = (statenum, stream.StreamReceiver(sink, compressed))
 
 ###
 #  figure out which sockets need to be selected
@@ -68,8 +112,7 @@ def get_input_state(vals):
 def get_arwsocks(vals):
     # asocks is all extant sockets
     socknames = ['cmdsock', 'stsock']
-    asocks = [ s for s in [ vals.get(n) for n in socknames ] if s is not None ] + \
-             [ info[1] for info in vals.setdefault('runinfo', []) ]
+    asocks = [ s for s in [ vals.get(n) for n in socknames ] if s is not None ]
 
     # rsocks is all objects that we could select upon
     rsocks = [ s for s in asocks
@@ -77,6 +120,10 @@ def get_arwsocks(vals):
                  or isinstance(s, SSL.Connection)
                  or (isinstance(s, SocketNB) and s.sock is not None) ]
 
+    # background jobs finishing
+    if vals.get('executor') is not None and vals['executor'].busy():
+        rsocks += vals['executor'].rsocks()
+
     # wsocks is all rsocks that indicate they want to be written
     wsocks = [ s for s in asocks if isinstance(s, SocketNB) and (s.ssl_write or s.want_write) ]
 
@@ -129,7 +176,13 @@ def make_cmdstring(msg, vals):
     # statefile
     if vals['run_iter'] > 0 and vals['expect_statefile']:
         instatefile = "##TMPDIR##/%d.state" % (vals['run_iter'] - 1)
-        instatewait = '( while [ ! -f "%s" ]; do sleep 0.025; done; echo "hi" ) | ' % instatefile
+        if handler.background_executor(vals) is not None:
+            # the executor starts the command once the file is here (see _got_state)
+            instatewait = ""
+            if "##INSTATEWAIT##" in command:
+                vals['_waitfor'] = instatefile.replace("##TMPDIR##", vals['_tmpdir'])
+        else:
+            instatewait = '( while [ ! -f "%s" ]; do sleep 0.025; done; echo "hi" ) | ' % instatefile
         instateswitch = '-r -I "%s" -p "##TMPDIR##/prev.ivf"' % instatefile
 
         if vals['run_iter'] > 1:
@@ -203,10 +256,15 @@ def lambda_handler(event, _):
     nonblock = int(event.get('nonblock', 0))
     expect_statefile = int(event.get('expect_statefile', 0))
     send_statefile = int(event.get('send_statefile', 0))
+    raw_state = int(event.get('raw_state', 0))
     rm_tmpdir = int(event.get('rm_tmpdir', 1))
     bg_silent = int(event.get('bg_silent', 0))
     minimal_recode = int(event.get('minimal_recode', 0))
     hash_s3keys = int(event.get('hash_s3keys', 0))
+    max_jobs = int(event.get('max_jobs', 16))
+    stream_output = int(event.get('stream_output', 0))
+    inotify = int(event.get('inotify', 0))
+    storage = event.get('storage')
 
     if rm_tmpdir:
         os.system("rm -rf /tmp/*")
@@ -220,11 +278,14 @@ def lambda_handler(event, _):
            , 'nonblock': nonblock
            , 'expect_statefile': expect_statefile
            , 'send_statefile': send_statefile
+           , 'raw_state': raw_state
            , 'rm_tmpdir': rm_tmpdir
            , 'bg_silent': bg_silent
            , 'minimal_recode': minimal_recode
            , 'run_iter': 0
            , 'hash_s3keys': hash_s3keys
+           , 'stream_output': stream_output
+           , 'storage': storage
            , '_tmpdir': tempfile.mkdtemp(prefix="lambda_", dir="/tmp")
            }
 
@@ -236,8 +297,16 @@ def lambda_handler(event, _):
     if not isinstance(s, SocketNB):
         return str(s)
     vals['cmdsock'] = s
-    vals['cmdsock'].enqueue('OK:HELLO')
-
+    # runs commands and S3 transfers in the background (see libmu.executor)
+    # (a chained run gives up on its input state after Defs.timeout, too)
+    vals['executor'] = Executor(max_jobs, inotify, Defs.timeout)
+    # advertise binary framing; the coordinator switches us over if it wants to
+    vals['cmdsock'].enqueue(Defs.hello_binary)
+
+    # give up after Defs.timeout seconds without I/O: a background job's output
+    # and its finishing both count, so a hung job doesn't keep us alive forever
+    # (nor does one whose input state never comes: see Executor.expire_waiting)
+    last_io = time.time()
     while True:
         (_, rsocks, wsocks) = get_arwsocks(vals)
         if len(rsocks) == 0 and len(wsocks) == 0:
@@ -245,11 +314,19 @@ def lambda_handler(event, _):
                 print "***WARNING*** unclean client exit"
             break
 
-        (rfds, wfds, _) = select.select(rsocks, wsocks, [], Defs.timeout)
+        timeout = max(0, last_io + Defs.timeout - time.time())
+        wait_left = vals['executor'].wait_remaining()
+        if wait_left is not None:
+            timeout = min(timeout, wait_left)
+        (rfds, wfds, _) = select.select(rsocks, wsocks, [], timeout)
 
-        if len(rfds) == 0 and len(wfds) == 0 and len(vals.setdefault('runinfo', [])) == 0:
-            print "CLIENT TIMEOUT"
-            break
+        vals['executor'].expire_waiting()
+        if len(rfds) == 0 and len(wfds) == 0 and not vals['executor'].want_handle:
+            if time.time() - last_io >= Defs.timeout:
+                print "CLIENT TIMEOUT"
+                break
+            continue
+        last_io = time.time()
 
         # do all the reads we can
         for r in rfds:
@@ -273,26 +350,14 @@ def lambda_handler(event, _):
         if break_outer:
             break
 
-        ### runsocks
-        # if we get something from the runsock, handle it (and kill the sock)
-        # (iterate in reverse because we want to be able to remove entries)
-        for i in reversed(range(0, len(vals.setdefault('runinfo', [])))):
-            (pid, sock) = vals['runinfo'][i]
-            if sock.want_handle:
-                del vals['runinfo'][i]
+        ### background jobs
+        # pass on the results of whatever finished
+        while vals['executor'].want_handle:
+            outmsg = vals['executor'].dequeue()
+            vals['cmdsock'].enqueue(outmsg)
 
-                # we only receive something after the runner is done
-                # the return value is already packed into the outmsg, so no need to get it here
-                os.waitpid(pid, 0)
-
-                outmsg = sock.dequeue()
-                sock.close()
-                del sock
-
-                vals['cmdsock'].enqueue(outmsg)
-
-                if outmsg[:12] == "OK:RETVAL(0)":
-                    finished_run(outmsg, vals)
+            if outmsg[:12] == "OK:RETVAL(0)":
+                finished_run(outmsg, vals)
 
         if vals.get('stsock') is not None and vals['stsock'].want_handle:
             # handle receiving new state file from previous lambda
@@ -316,6 +381,9 @@ def lambda_handler(event, _):
         except:
             pass
 
+    # kills any commands still running
+    vals['executor'].close()
+
     if vals.get('rm_tmpdir') and vals.get('_tmpdir') is not None:
         shutil.rmtree(vals.get('_tmpdir'))
 
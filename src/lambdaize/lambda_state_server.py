@@ -2,10 +2,11 @@
 
 import select
 import socket
-import time
 
 import libmu
+import libmu.rawxfer
 import libmu.server
+import libmu.timers
 
 class ServerInfo(object):
     port_number = 13337
@@ -22,6 +23,8 @@ class ServerInfo(object):
 class StateSocket(libmu.SocketNB):
     stateid = None
     partner = None
+    # state files are only relayed, never parsed, so pass them through without copying
+    recv_views = True
 
     def initialize(self):
         if not self.want_handle:
@@ -45,16 +48,37 @@ class StateSocket(libmu.SocketNB):
         else:
             return myid
 
+    # pass our next message on to partner; the bytes of a raw transfer follow
+    # their announcement straight from our socket to partner's
+    def forward(self, partner):
+        msg = self.dequeue()
+        partner.enqueue(msg)
+
+        raw = libmu.rawxfer.parse_begin(msg)
+        if raw is not None:
+            relay = libmu.rawxfer.RawRelay(self, partner, raw[0])
+            partner.send_queue.append(relay)
+            self.recv_raw(relay)
+
+
+def expire_tombstone(tmbs, tid, tombstone):
+    tstones = tmbs.get(tid)
+    if tstones is None:
+        return
 
-def rwsplit(sts, ret, tmbs):
+    tstones[:] = [ ts for ts in tstones if ts is not tombstone ]
+    if len(tstones) == 0:
+        del tmbs[tid]
+
+def rwsplit(sts, ret, tmbs, timers):
     diffs = {}
     for idx in sts:
         st = sts[idx]
         if st.sock is not None:
-            val = select.POLLIN
-
-            if st.ssl_write or st.want_write:
-                val = val | select.POLLOUT
+            # don't read more than our partner is taking (see SocketNB.send_high_water)
+            partner = sts.get(st.partner)
+            st.throttle(partner is not None and partner.send_full)
+            val = st.poll_flags()
 
             if ret.get(idx) != val:
                 ret[idx] = val
@@ -67,11 +91,41 @@ def rwsplit(sts, ret, tmbs):
             if st.want_handle:
                 plist = tmbs.setdefault(st.partner, [])
                 while st.want_handle:
-                    tombstone = (st.dequeue(), time.time())
+                    msg = st.dequeue()
+                    if libmu.rawxfer.parse_begin(msg) is not None:
+                        # the raw data went down with the socket, so partner will never get
+                        # this file, nor make sense of what follows: hang up on it instead
+                        if libmu.Defs.debug:
+                            print "SERVER (warning) %s closed in a raw transfer, closing %s" % (st.stateid, st.partner)
+                        while st.want_handle:
+                            st.dequeue()
+                        msg = None
+                    # [msg, timer]: the timer discards the message if partner never shows up
+                    # (msg None: close partner when it does)
+                    tombstone = [msg, None]
+                    tombstone[1] = timers.arm(ServerInfo.tombstone_timeout, expire_tombstone, tmbs, st.partner, tombstone)
                     plist.append(tombstone)
 
     return diffs
 
+# hand the messages left for partners that are now connected to them
+def deliver_tombstones(tmbs, sts, timers):
+    to_delete = []
+    for tid in tmbs:
+        # partner is connected! send its messages
+        if sts.get(tid) is not None:
+            to_delete.append(tid)
+            for (msg, timer) in tmbs[tid]:
+                timers.cancel(timer)
+                if msg is None:
+                    sts[tid].close()
+                elif sts[tid].sock is not None:
+                    sts[tid].enqueue(msg)
+
+    # need to delete afterwards because we cannot modify dictionary during iteration
+    for tid in to_delete:
+        del tmbs[tid]
+
 def handle_server_sock(lsock, state_id_map, state_fd_map):
     (ns, _) = lsock.accept()
     ns.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
@@ -96,6 +150,7 @@ def run():
     rwflags = {}
     state_id_map = {}
     tombstones = {}
+    timers = libmu.timers.TimerQueue()
     npasses_out = 0
     poll_obj = select.poll()
     poll_obj.register(lsock_fd, select.POLLIN)
@@ -106,7 +161,9 @@ def run():
         fstates = len(state_fd_map)
         rwstates = len(rwflags)
         tstones = len(tombstones)
-        print "SERVER status: conn_id=%d conn_fd=%d conn_flags=%d partnerless=%d tombstones=%d" % (tstates, fstates, rwstates, npstates, tstones)
+        queued = sum( st.send_bytes for st in state_id_map.itervalues() )
+        nthrottled = len([ 1 for st in state_id_map.itervalues() if st.throttled or st.recv_full ])
+        print "SERVER status: conn_id=%d conn_fd=%d conn_flags=%d partnerless=%d tombstones=%d queued=%d throttled=%d" % (tstates, fstates, rwstates, npstates, tstones, queued, nthrottled)
 
         # enhanced output in debugging mode
         if libmu.Defs.debug:
@@ -115,7 +172,7 @@ def run():
                 print "%d: (%s) %s" % (f, st.stateid, str(st.sock))
 
     while True:
-        dflags = rwsplit(state_id_map, rwflags, tombstones)
+        dflags = rwsplit(state_id_map, rwflags, tombstones, timers)
 
         for idx in dflags:
             if rwflags.get(idx, 0) != 0:
@@ -149,9 +206,15 @@ def run():
             npasses_out = 0
             show_status()
 
-        pfds = poll_obj.poll(1000 * 10)
+        # don't wait on the network if a message is ready to go to a partner that
+        # showed up later in the last pass (a paused raw transfer won't wake us up)
+        ready = any( st.want_handle and st.partner in state_id_map for st in state_id_map.itervalues() )
+        pfds = poll_obj.poll(0 if ready else timers.poll_timeout(1000 * 10))
         npasses_out += 1
 
+        # throw away tombstones nobody came back for
+        timers.run_expired()
+
         if len(pfds) == 0:
             show_status()
 
@@ -185,32 +248,10 @@ def run():
                 if libmu.Defs.debug and state.want_handle:
                     print "SERVER message from %s to %s" % (state.stateid, state.partner)
                 while state.want_handle:
-                    state_id_map[state.partner].enqueue(state.dequeue())
+                    state.forward(state_id_map[state.partner])
 
         # handle tombstone messages
-        to_delete = []
-        for tid in tombstones:
-            tstones = tombstones[tid]
-
-            # partner is connected! send its messages
-            if state_id_map.get(tid) is not None:
-                to_delete.append(tid)
-                for (msg, _) in tstones:
-                    state_id_map[tid].enqueue(msg)
-
-            # every once in a while, go through all the tombstones and get rid of old ones
-            elif len(pfds) == 0:
-                for tidx in reversed(range(0, len(tstones))):
-                    now = time.time()
-                    if now - tstones[tidx][1] > ServerInfo.tombstone_timeout:
-                        del tstones[tidx]
-
-                if len(tstones) == 0:
-                    to_delete.append(tid)
-
-        # need to delete afterwards because we cannot modify dictionary during iteration
-        for tid in to_delete:
-            del tombstones[tid]
+        deliver_tombstones(tombstones, state_id_map, timers)
 
         # send ready messages on each connection that's writable
         for (fd, ev) in pfds:
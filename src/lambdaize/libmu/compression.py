@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+import time
+import zlib
+
+###
+#  per-connection compression with adaptive level selection
+#  We track how fast we compress at the current level and how fast the link
+#  drains when it's backed up. If compression can't keep up with the link,
+#  it's the bottleneck, so we step the level down (eventually to 0, i.e., off);
+#  if it's much faster than the link, we step the level up to save bandwidth.
+###
+class AdaptiveCompressor(object):
+    # 0 means don't compress at all
+    levels = (0, 1, 3, 6, 9)
+    initial_level = 1
+    # compress only when we're this many times faster than the link...
+    headroom = 2.0
+    # ...and go up a level when we're this many times faster
+    step_up = 8.0
+    # reconsider the level after this many samples
+    adjust_every = 8
+    # with compression off, try again after this many messages
+    probe_every = 64
+    # weight of a new sample in the moving averages
+    alpha = 0.25
+
+    def __init__(self):
+        self.idx = self.levels.index(self.initial_level)
+        self.comp_rate = None
+        self.link_rate = None
+        self.samples = 0
+        self.skipped = 0
+
+        # outgoing
+        self.raw_out = 0
+        self.comp_out = 0
+        self.deflate_time = 0.0
+        self.nout = 0
+        # incoming
+        self.comp_in = 0
+        self.raw_in = 0
+        self.inflate_time = 0.0
+        self.nin = 0
+
+    @property
+    def level(self):
+        return self.levels[self.idx]
+
+    def _ewma(self, old, new):
+        return new if old is None else old + self.alpha * (new - old)
+
+    # the level for the next message (or stream)
+    def next_level(self):
+        if self.level == 0:
+            self.skipped += 1
+            if self.skipped >= self.probe_every:
+                # maybe things have changed: start measuring again
+                self.skipped = 0
+                self.idx = 1
+                self.comp_rate = None
+
+        return self.level
+
+    # compress data at the current level
+    # returns None if we're not compressing right now or if it didn't help
+    def compress(self, data):
+        level = self.next_level()
+        if level == 0:
+            return None
+
+        start = time.time()
+        out = zlib.compress(data, level)
+        self.record(len(data), len(out), time.time() - start)
+
+        return out if len(out) < len(data) else None
+
+    # account for nraw bytes compressed to nout bytes in elapsed seconds
+    # (StreamSender calls this for each chunk it compresses)
+    def record(self, nraw, nout, elapsed):
+        self.raw_out += nraw
+        self.comp_out += nout
+        self.deflate_time += elapsed
+        self.nout += 1
+
+        self.comp_rate = self._ewma(self.comp_rate, nraw / max(elapsed, 1e-6))
+        self.samples += 1
+        if self.samples >= self.adjust_every:
+            self.samples = 0
+            self._adjust()
+
+    # the link drained nbytes in elapsed seconds while it was backed up
+    def observe_link(self, nbytes, elapsed):
+        if elapsed > 0 and nbytes > 0:
+            self.link_rate = self._ewma(self.link_rate, nbytes / elapsed)
+
+    def _adjust(self):
+        # if the link never backs up, it isn't the bottleneck: leave well enough alone
+        if self.comp_rate is None or self.link_rate is None:
+            return
+
+        if self.comp_rate < self.headroom * self.link_rate and self.idx > 0:
+            self.idx -= 1
+            self.comp_rate = None
+        elif self.comp_rate > self.step_up * self.link_rate and self.idx < len(self.levels) - 1:
+            self.idx += 1
+            self.comp_rate = None
+
+    def decompress(self, data):
+        start = time.time()
+        out = zlib.decompress(data)
+        self.inflate_time += time.time() - start
+        self.comp_in += len(data)
+        self.raw_in += len(out)
+        self.nin += 1
+
+        return out
+
+    def to_dict(self):
+        return { 'level': self.level
+               , 'msgs_out': self.nout
+               , 'raw_out': self.raw_out
+               , 'comp_out': self.comp_out
+               , 'ratio_out': float(self.comp_out) / self.raw_out if self.raw_out > 0 else None
+               , 'deflate_time': self.deflate_time
+               , 'msgs_in': self.nin
+               , 'comp_in': self.comp_in
+               , 'raw_in': self.raw_in
+               , 'inflate_time': self.inflate_time
+               , 'link_rate': self.link_rate
+               }
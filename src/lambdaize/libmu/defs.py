@@ -1,9 +1,47 @@
 #!/usr/bin/python
 
+import struct
+
 class Defs(object):
     timeout = 300
     header_len = 13
     header_fmt = "%012d %s"
+
+    # binary frames: magic byte, frame type, flags, 4-byte length (see SocketNB)
+    # ASCII headers always start with a digit, so the two can't be confused
+    bin_magic = 0xb1
+    bin_header = struct.Struct("!BBBI")
+    # a HELLO listing capabilities tells the other side what we understand;
+    # a coordinator that takes us up on it answers with an ftype_hello frame
+    hello_prefix = "OK:HELLO("
+    hello_caps = "framing=bin,compress=zlib,batch"
+    hello_binary = hello_prefix + hello_caps + ")"
+
+    # frame types
+    ftype_command = 0
+    ftype_response = 1
+    ftype_info = 2
+    ftype_state = 3
+    ftype_chunk = 4
+    # capabilities; handled inside SocketNB, never queued
+    ftype_hello = 5
+
+    # frame flags
+    fflag_compressed = 0x01
+    fflag_continued = 0x02
+
+    # several commands in one message, and all of their responses in one message
+    # (see libmu.handler.do_batch)
+    batch_command = "batch:"
+    batch_response = "OK:BATCH:"
+
+    # streamed payloads (see libmu.stream)
+    stream_begin = "STREAM_BEGIN("
+    stream_data = "STREAM_DATA:"
+    stream_end = "STREAM_END:"
+
+    # raw file transfers on plain sockets (see libmu.rawxfer)
+    raw_begin = "RAW_BEGIN("
     cipher_list = "ECDHE-RSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-SHA384:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-RSA-AES128-SHA256:ECDHE-RSA-RC4-SHA:ECDHE-RSA-AES256-SHA:HIGH:!aNULL:!eNULL:!EXP:!LOW:!MEDIUM:!MD5:!RC4:!DES:!3DES"
     debug = False
     fun = False
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+import select
+
+###
+#  backends: thin wrappers so that poll and epoll look the same
+#  NOTE on Linux, EPOLLIN/EPOLLOUT/... have the same values as POLLIN/POLLOUT/...
+###
+class PollBackend(object):
+    name = "poll"
+
+    def __init__(self):
+        self.poll_obj = select.poll()
+
+    def register(self, fd, flags):
+        self.poll_obj.register(fd, flags)
+
+    def modify(self, fd, flags):
+        self.poll_obj.modify(fd, flags)
+
+    def unregister(self, fd):
+        self.poll_obj.unregister(fd)
+
+    def poll(self, timeout_ms):
+        return self.poll_obj.poll(timeout_ms)
+
+class EpollBackend(object):
+    name = "epoll"
+
+    def __init__(self):
+        self.poll_obj = select.epoll()  # pylint: disable=no-member
+
+    def register(self, fd, flags):
+        self.poll_obj.register(fd, flags)
+
+    def modify(self, fd, flags):
+        self.poll_obj.modify(fd, flags)
+
+    def unregister(self, fd):
+        self.poll_obj.unregister(fd)
+
+    def poll(self, timeout_ms):
+        # epoll wants seconds, and -1 for infinite
+        timeout = -1 if timeout_ms is None or timeout_ms < 0 else timeout_ms / 1000.0
+        return self.poll_obj.poll(timeout)
+
+backends = { 'poll': PollBackend
+           , 'epoll': EpollBackend
+           }
+
+def make_backend(name=None):
+    if name is None:
+        name = 'epoll' if hasattr(select, 'epoll') else 'poll'
+
+    if name not in backends:
+        raise ValueError("unknown event backend '%s'" % name)
+
+    return backends[name]()
+
+###
+#  EventEngine keeps track of which sockets want which events
+#  Sockets tell the engine when their interest changes (see SocketNB.update_flags),
+#  so the mainloop never has to scan every socket to rebuild the poll set.
+#  It also remembers which sockets have messages waiting to be handled (or
+#  were kicked), so the mainloop only needs to call do_handle on those.
+###
+class EventEngine(object):
+    def __init__(self, backend=None):
+        if backend is None or isinstance(backend, str):
+            backend = make_backend(backend)
+
+        self.backend = backend
+        self.flags = {}
+        self.fd_flags = {}
+        self.closed = []
+        self.ready = set()
+
+    # attach a SocketNB to this engine and register its current interest
+    def register(self, sock):
+        sock.engine = self
+        self.update(sock)
+
+    # called by SocketNB whenever its flags might have changed
+    def update(self, sock):
+        if sock.want_handle:
+            self.ready.add(sock.fileno())
+
+        if sock.sock is None:
+            return self.discard(sock)
+
+        fd = sock.fileno()
+        nflags = sock.poll_flags()
+        oflags = self.flags.get(fd, 0)
+        if nflags == oflags:
+            return
+
+        if nflags == 0:
+            del self.flags[fd]
+            self.backend.unregister(fd)
+        elif oflags == 0:
+            self.flags[fd] = nflags
+            self.backend.register(fd, nflags)
+        else:
+            self.flags[fd] = nflags
+            self.backend.modify(fd, nflags)
+
+    # called by SocketNB right before it closes its socket
+    def discard(self, sock, closing=False):
+        fd = sock.fileno()
+        if self.flags.pop(fd, None) is not None:
+            try:
+                self.backend.unregister(fd)
+            except:
+                pass
+
+        if closing:
+            self.closed.append(sock)
+
+    # hand back (and forget) the sockets that have closed since the last call
+    def pop_closed(self):
+        closed = self.closed
+        self.closed = []
+        return closed
+
+    # hand back (and forget) the fds of sockets that want to be handled
+    def pop_ready(self):
+        ready = self.ready
+        self.ready = set()
+        return ready
+
+    # raw fds (e.g., listening sockets) that don't count as active sockets
+    def add_fd(self, fd, flags):
+        self.fd_flags[fd] = flags
+        self.backend.register(fd, flags)
+
+    def remove_fd(self, fd):
+        if self.fd_flags.pop(fd, None) is not None:
+            try:
+                self.backend.unregister(fd)
+            except:
+                pass
+
+    def num_active(self):
+        return len(self.flags)
+
+    def poll(self, timeout_ms):
+        return self.backend.poll(timeout_ms)
@@ -0,0 +1,372 @@
+#!/usr/bin/python
+
+from collections import deque
+import errno
+import fcntl
+import os
+import Queue
+import subprocess
+import threading
+import time
+import traceback
+
+from libmu import filewatch
+
+###
+#  background jobs in the worker
+#
+#  Commands run in a shell via Popen, with their output read from a
+#  non-blocking pipe in the worker's select loop; everything else (S3
+#  transfers) runs on a small pool of threads, which wake the select loop
+#  through a pipe when they're done. At most max_jobs jobs run at once; the
+#  rest wait their turn. Finished jobs leave their message in a queue, which
+#  the worker empties with want_handle / dequeue(), like a SocketNB.
+#
+#  A job can also wait for a file (submit_after): it's started once the
+#  worker says the file is there (file_arrived), or, with watch_files, once
+#  inotify sees it appear. If it hasn't shown up after wait_timeout seconds,
+#  expire_waiting() drops the job and answers FAIL in its place.
+###
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+###
+#  fun(item) for each of items, nthreads at a time; returns a list of
+#  (seconds, error) in the same order (error is None or a traceback)
+###
+def map_timed(fun, items, nthreads):
+    results = [None] * len(items)
+    todo = Queue.Queue()
+    for idx in range(len(items)):
+        todo.put(idx)
+
+    def worker():
+        while True:
+            try:
+                idx = todo.get_nowait()
+            except Queue.Empty:
+                return
+
+            start = time.time()
+            error = None
+            try:
+                fun(items[idx])
+            except Exception: # pylint: disable=broad-except
+                error = traceback.format_exc()
+            results[idx] = (time.time() - start, error)
+
+    threads = [ threading.Thread(target=worker) for _ in range(min(nthreads, len(items))) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+###
+#  fun() returns the message to send back when it's done
+###
+class CallJob(object):
+    def __init__(self, fun):
+        self.fun = fun
+
+    def run(self):
+        return self.fun()
+
+###
+#  where a command's output goes: by default, we keep all of it
+###
+class OutputBuffer(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    # returns the output for the final response
+    def close(self):
+        return ''.join(self.chunks)
+
+###
+#  or we pass it on as it arrives, and keep just the last tail_bytes for the
+#  final response. report(text) gets complete lines, at most once every
+#  interval seconds (lines that pile up beyond tail_bytes in between are only
+#  in the log), plus whatever's left at the end. log, if not None, is a file
+#  that gets everything.
+###
+class StreamingOutput(object):
+    def __init__(self, report, tail_bytes=65536, interval=1.0, log=None):
+        self.report = report
+        self.tail_bytes = tail_bytes
+        self.interval = interval
+        self.log = log
+        self.tail = deque()
+        self.tail_len = 0
+        self.nbytes = 0
+        self.pending = ''
+        self.last_report = 0
+
+    def write(self, data):
+        self.nbytes += len(data)
+        if self.log is not None:
+            self.log.write(data)
+
+        self.tail.append(data)
+        self.tail_len += len(data)
+        while self.tail_len - len(self.tail[0]) >= self.tail_bytes:
+            self.tail_len -= len(self.tail.popleft())
+
+        self.pending += data
+        if len(self.pending) > self.tail_bytes:
+            # start at a line, if there's one to start at
+            self.pending = self.pending[-self.tail_bytes:]
+            bol = self.pending.find('\n') + 1
+            if 0 < bol < len(self.pending):
+                self.pending = self.pending[bol:]
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            eol = self.pending.rfind('\n')
+            if eol >= 0:
+                self.report(self.pending[:eol + 1])
+                self.pending = self.pending[eol + 1:]
+                self.last_report = now
+
+    def close(self):
+        if len(self.pending) > 0:
+            self.report(self.pending)
+            self.pending = ''
+        if self.log is not None:
+            self.log.close()
+
+        tail = ''.join(self.tail)[-self.tail_bytes:]
+        if self.nbytes > len(tail):
+            tail = "[%d bytes omitted]\n%s" % (self.nbytes - len(tail), tail)
+        return tail
+
+###
+#  run cmdstring in a shell; finish(retval, output) makes the message to send back
+###
+class CommandJob(object):
+    chunk_size = 65536
+
+    def __init__(self, cmdstring, finish, output=None):
+        self.cmdstring = cmdstring
+        self.finish = finish
+        self.proc = None
+        self.output = output if output is not None else OutputBuffer()
+        self.executor = None
+
+    # start it and wait for it
+    def run(self):
+        proc = subprocess.Popen([self.cmdstring], shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        while True:
+            data = os.read(proc.stdout.fileno(), self.chunk_size)
+            if len(data) == 0:
+                break
+            self.output.write(data)
+        proc.stdout.close()
+        return self.finish(proc.wait(), self.output.close())
+
+    # start it, and let the select loop collect the output
+    def start(self, executor):
+        self.executor = executor
+        # NOTE close_fds: otherwise the next command holds this one's stdout open, and we never see EOF
+        self.proc = subprocess.Popen([self.cmdstring], shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        _set_nonblocking(self.proc.stdout.fileno())
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def do_read(self):
+        try:
+            data = os.read(self.fileno(), self.chunk_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        if len(data) > 0:
+            self.output.write(data)
+            return
+
+        # EOF: the command is done, or about to be
+        self.proc.stdout.close()
+        retval = self.proc.wait()
+        self.executor.job_done(self, self.finish(retval, self.output.close()))
+
+    def kill(self):
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+        self.proc.stdout.close()
+
+class Executor(object):
+    def __init__(self, max_jobs=16, watch_files=False, wait_timeout=None):
+        self.max_jobs = max_jobs
+        self.wait_timeout = wait_timeout
+        self.pending = deque()
+        self.waiting = {}
+        self.watcher = None
+        if watch_files and filewatch.available():
+            self.watcher = filewatch.FileWatcher(self.file_arrived)
+        self.running = 0
+        self.commands = []
+        self.threads = []
+        self.calls = Queue.Queue()
+        self.results = deque()
+        self.done_queue = deque()
+        (self.wake_r, self.wake_w) = os.pipe()
+        _set_nonblocking(self.wake_r)
+
+    @property
+    def want_handle(self):
+        return len(self.done_queue) > 0
+
+    def dequeue(self):
+        if len(self.done_queue) == 0:
+            return None
+        return self.done_queue.popleft()
+
+    # True while anything is queued, waiting, or running
+    def busy(self):
+        return self.running > 0 or len(self.pending) > 0 or len(self.waiting) > 0
+
+    def submit(self, job):
+        if self.running < self.max_jobs:
+            self._start(job)
+        else:
+            self.pending.append(job)
+
+    # submit job once path exists; waited(seconds) is called when it's released
+    def submit_after(self, path, job, waited=None):
+        path = os.path.normpath(path)
+        if self.watcher is not None:
+            # watch before looking, so we can't miss it
+            self.watcher.watch(os.path.dirname(path))
+
+        if os.path.exists(path):
+            if waited is not None:
+                waited(0.0)
+            self.submit(job)
+        else:
+            self.waiting.setdefault(path, []).append((job, time.time(), waited))
+
+    # seconds until the next waiting job expires (None: nothing will)
+    def wait_remaining(self, now=None):
+        if self.wait_timeout is None or len(self.waiting) == 0:
+            return None
+
+        if now is None:
+            now = time.time()
+        since = min( since for jobs in self.waiting.values() for (_, since, _) in jobs )
+        return max(0, since + self.wait_timeout - now)
+
+    # give up on jobs that have waited too long for their files
+    def expire_waiting(self, now=None):
+        if self.wait_timeout is None:
+            return
+
+        if now is None:
+            now = time.time()
+        for path in list(self.waiting.keys()):
+            jobs = self.waiting[path]
+            for (job, since, waited) in list(jobs):
+                if now - since >= self.wait_timeout:
+                    jobs.remove((job, since, waited))
+                    self.done_queue.append("FAIL(timed out waiting for %s)" % path)
+            if len(jobs) == 0:
+                del self.waiting[path]
+
+    def file_arrived(self, path):
+        for (job, since, waited) in self.waiting.pop(os.path.normpath(path), []):
+            if waited is not None:
+                waited(time.time() - since)
+            self.submit(job)
+
+    def _start(self, job):
+        self.running += 1
+        if isinstance(job, CommandJob):
+            try:
+                job.start(self)
+            except OSError as e:
+                self.job_done(job, job.finish(127, str(e)))
+            else:
+                self.commands.append(job)
+            return
+
+        if len(self.threads) < self.max_jobs:
+            thread = threading.Thread(target=self._pool_thread)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.calls.put(job)
+
+    def _pool_thread(self):
+        while True:
+            job = self.calls.get()
+            if job is None:
+                return
+            try:
+                msg = job.run()
+            except Exception: # pylint: disable=broad-except
+                msg = 'FAIL(%s)' % traceback.format_exc()
+            self.results.append((job, msg))
+            wake_w = self.wake_w
+            if wake_w is not None:
+                try:
+                    os.write(wake_w, 'x')
+                except OSError:
+                    # closed under us: the worker is on its way out
+                    pass
+
+    def job_done(self, job, msg):
+        if job in self.commands:
+            self.commands.remove(job)
+        self.running -= 1
+        self.done_queue.append(msg)
+        while len(self.pending) > 0 and self.running < self.max_jobs:
+            self._start(self.pending.popleft())
+
+    ###
+    #  for the select loop: we're readable when a pool thread finishes
+    ###
+    def fileno(self):
+        return self.wake_r
+
+    def do_read(self):
+        try:
+            os.read(self.wake_r, 4096)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+        while len(self.results) > 0:
+            self.job_done(*self.results.popleft())
+
+    # everything to select on for reading
+    def rsocks(self):
+        if self.watcher is not None and len(self.waiting) > 0:
+            return [self, self.watcher] + self.commands
+        return [self] + self.commands
+
+    def close(self):
+        for job in self.commands:
+            job.kill()
+        self.commands = []
+        self.pending.clear()
+        self.waiting.clear()
+        if self.watcher is not None:
+            self.watcher.close()
+        for _ in self.threads:
+            self.calls.put(None)
+        # idle threads quit right away; don't wait long for one that's mid-transfer
+        for thread in self.threads:
+            thread.join(0.1)
+        self.threads = []
+        if self.wake_r is not None:
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.wake_r = self.wake_w = None
@@ -27,6 +27,14 @@ class FDWrapper(object):
 
         return os.read(self.fd, length)
 
+    def recv_into(self, buf, length):
+        if self.fd is None:
+            return None
+
+        data = os.read(self.fd, length)
+        buf[0:len(data)] = data
+        return len(data)
+
     def send(self, msg):
         if self.fd is None:
             return None
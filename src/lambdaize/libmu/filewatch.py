@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+###
+#  tell us when files show up in a directory, via Linux inotify
+#
+#  FileWatcher.do_read() calls arrived(path) for each file that's renamed
+#  into, or written and closed in, a watched directory. Python 2 has no
+#  inotify module, so we call libc through ctypes; available() says whether
+#  that worked.
+###
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_init1.restype = ctypes.c_int
+    _inotify_init1.argtypes = [ctypes.c_int]
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.restype = ctypes.c_int
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError):
+    _inotify_init1 = _inotify_add_watch = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0x00080000
+IN_NONBLOCK = 0x00000800
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+_event = struct.Struct("iIII")
+
+def available():
+    return _inotify_init1 is not None
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+class FileWatcher(object):
+    def __init__(self, arrived):
+        self.arrived = arrived
+        self.fd = _check(_inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.dirs = {}
+
+    def watch(self, dirname):
+        dirname = os.path.normpath(dirname)
+        if dirname not in self.dirs.values():
+            wd = _check(_inotify_add_watch(self.fd, dirname, IN_CLOSE_WRITE | IN_MOVED_TO))
+            self.dirs[wd] = dirname
+
+    def fileno(self):
+        return self.fd
+
+    def do_read(self):
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        off = 0
+        while off + _event.size <= len(buf):
+            (wd, _, _, nlen) = _event.unpack_from(buf, off)
+            name = buf[off + _event.size:off + _event.size + nlen].rstrip('\0')
+            off += _event.size + nlen
+
+            dirname = self.dirs.get(wd)
+            if dirname is not None and len(name) > 0:
+                self.arrived(os.path.join(dirname, name))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
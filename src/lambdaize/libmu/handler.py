@@ -1,15 +1,15 @@
 #!/usr/bin/python
 
-import os
-import subprocess
-import sys
+import json
+import time
 import traceback
 
 import boto3
 
 from libmu.defs import Defs
-from libmu.fd_wrapper import FDWrapper
+from libmu.executor import CallJob, CommandJob, StreamingOutput, map_timed
 from libmu.socket_nb import SocketNB
+from libmu.storage import S3Storage, TransferSettings, open_storage
 import libmu.util
 
 s3_client = boto3.client('s3')
@@ -50,7 +50,7 @@ def _do_get(msg, vals, get_info):
         return False
 
     if get_info:
-        vals['cmdsock'].enqueue('INFO:%s:%s' % (msg, vals[msg]))
+        vals['cmdsock'].enqueue('INFO:%s:%s' % (msg, vals[msg]), Defs.ftype_info)
         vals['cmdsock'].enqueue('OK:GETI(%s)' % (msg))
     else:
         vals['cmdsock'].enqueue('OK:GET(%s)' % vals[msg])
@@ -68,48 +68,54 @@ def do_dump_vals(_, vals):
     return False
 
 ###
-#  run something in the background
+#  run a job (see libmu.executor) in the background, if we have an executor
+#  and nonblock is set; otherwise, run it right here
 ###
-def _background(runner, vals, queuemsg):
-    sock = None
-    if vals['nonblock']:
-        (r, w) = os.pipe()
-        pid = os.fork()
-
-        if pid != 0:
-            os.close(w)
-            sock = FDWrapper(r)
-            sock.set_blocking(False)
-
-            info = vals.setdefault('runinfo', [])
-            info.append((pid, SocketNB(sock)))
-
-            if not vals.get('bg_silent'):
-                vals['cmdsock'].enqueue(queuemsg)
-            return False
-
+def background_executor(vals):
+    return vals.get('executor') if vals.get('nonblock') else None
+
+# a run: waited this long for its input state; tell the coordinator, and count it in stats:
+def _state_waited(vals, secs):
+    vals['cmdsock'].enqueue('INFO:state_wait(%d):%f' % (vals.get('run_iter', 0), secs), Defs.ftype_info)
+    stats = command_stats.setdefault('state_wait', [0, 0.0, 0])
+    stats[0] += 1
+    stats[1] += secs
+
+def _background(job, vals, queuemsg, waitfor=None):
+    executor = background_executor(vals)
+    if executor is not None:
+        if waitfor is None:
+            executor.submit(job)
         else:
-            os.close(r)
-            sock = FDWrapper(w)
+            executor.submit_after(waitfor, job, lambda secs: _state_waited(vals, secs))
+        if not vals.get('bg_silent'):
+            vals['cmdsock'].enqueue(queuemsg)
+        return False
 
-    (donemsg, retval) = runner()
+    donemsg = job.run()
 
-    if sock is None:
-        if vals.get('cmdsock') is not None:
-            vals['cmdsock'].enqueue(donemsg)
-            return False
+    if vals.get('cmdsock') is not None:
+        vals['cmdsock'].enqueue(donemsg)
+        return False
 
-        else:
-            # for mode 0 where we don't connect to a command server
+    else:
+        # for mode 0 where we don't connect to a command server
+        print donemsg
+        return donemsg
 
-            print donemsg
-            return donemsg
+###
+#  where objects come from and go to (see libmu.storage): vals['storage'] if
+#  it's set (a backend, or a spec for open_storage, say from
+#  set:storage:file:///dir), otherwise S3
+###
+def _storage(vals):
+    storage = vals.get('storage')
+    if storage is None:
+        return S3Storage(s3_client)
 
-    else:
-        msg = SocketNB.format_message(donemsg)
-        sock.send(msg)
-        sock.close()
-        sys.exit(retval)
+    if isinstance(storage, basestring):
+        storage = vals['storage'] = open_storage(storage, s3_client)
+    return storage
 
 ###
 #  tell the client to retrieve a segment from S3
@@ -120,18 +126,21 @@ def do_retrieve(msg, vals):
         vals['cmdsock'].enqueue('FAIL(could not compute download params)')
         return False
 
+    try:
+        (storage, settings) = (_storage(vals), TransferSettings.from_vals(vals))
+    except ValueError as e:
+        vals['cmdsock'].enqueue('FAIL(%s)' % str(e))
+        return False
+
     def ret_helper():
-        donemsg = 'OK:RETRIEVE(%s/%s)' % (bucket, key)
-        retval = 0
         try:
-            s3_client.download_file(bucket, key, filename)
+            storage.download(bucket, key, filename, settings)
         except:
-            donemsg = 'FAIL(retrieving %s:%s->%s from s3:\n%s)' % (bucket, key, filename, traceback.format_exc())
-            retval = 1
+            return 'FAIL(retrieving %s:%s->%s from s3:\n%s)' % (bucket, key, filename, traceback.format_exc())
 
-        return (donemsg, retval)
+        return 'OK:RETRIEVE(%s/%s)' % (bucket, key)
 
-    return _background(ret_helper, vals, 'OK:RETRIEVING(%s/%s->%s)' % (bucket, key, filename))
+    return _background(CallJob(ret_helper), vals, 'OK:RETRIEVING(%s/%s->%s)' % (bucket, key, filename))
 
 ###
 #  tell the client to upload a segment to s3
@@ -142,18 +151,88 @@ def do_upload(msg, vals):
         vals['cmdsock'].enqueue('FAIL(could not compute upload params)')
         return False
 
+    try:
+        (storage, settings) = (_storage(vals), TransferSettings.from_vals(vals))
+    except ValueError as e:
+        vals['cmdsock'].enqueue('FAIL(%s)' % str(e))
+        return False
+
     def ret_helper():
-        donemsg = 'OK:UPLOAD(%s/%s)' % (bucket, key)
-        retval = 0
         try:
-            s3_client.upload_file(filename, bucket, key)
+            storage.upload(filename, bucket, key, settings)
         except:
-            donemsg = 'FAIL(uploading %s->%s:%s to s3:\n%s)' % (filename, bucket, key, traceback.format_exc())
-            retval = 1
+            return 'FAIL(uploading %s->%s:%s to s3:\n%s)' % (filename, bucket, key, traceback.format_exc())
 
-        return (donemsg, retval)
+        return 'OK:UPLOAD(%s/%s)' % (bucket, key)
 
-    return _background(ret_helper, vals, 'OK:UPLOADING(%s->%s/%s)' % (filename, bucket, key))
+    return _background(CallJob(ret_helper), vals, 'OK:UPLOADING(%s->%s/%s)' % (filename, bucket, key))
+
+###
+#  retrieve or upload a bunch of objects at once, transfer_threads at a time
+#
+#  retrieve_many:key\0file\0key\0file...      these pairs
+#  retrieve_many:keyfmt\0filefmt\0start:stop   (keyfmt % i, filefmt % i) for i in range(start, stop)
+#
+#  (upload_many: takes the same.) The response gives each object's transfer
+#  time: OK:RETRIEVE_MANY({"key": seconds, ...})
+###
+def _many_pairs(msg):
+    fields = msg.split('\0')
+    if len(fields) % 2 == 0:
+        return zip(fields[0::2], fields[1::2])
+
+    (keyfmt, filefmt, irange) = fields
+    (start, stop) = [ int(i) for i in irange.split(':') ]
+    return [ (keyfmt % i, filefmt % i) for i in range(start, stop) ]
+
+def _transfer_many(msg, vals, make_string, transfer, verb, doing):
+    try:
+        pairs = _many_pairs(msg)
+    except (ValueError, TypeError):
+        vals['cmdsock'].enqueue('FAIL(invalid syntax for %s)' % verb)
+        return False
+
+    objects = []
+    for (key, filename) in pairs:
+        (success, bucket, key, filename) = make_string('%s\0%s' % (key, filename), vals)
+        if not success:
+            vals['cmdsock'].enqueue('FAIL(could not compute %s params)' % verb)
+            return False
+        objects.append((bucket, key, filename))
+    nthreads = int(vals.get('transfer_threads', 8))
+
+    def ret_helper():
+        results = map_timed(lambda obj: transfer(*obj), objects, nthreads)
+        errors = [ '%s/%s: %s' % (obj[0], obj[1], error) for (obj, (_, error)) in zip(objects, results) if error is not None ]
+        if len(errors) > 0:
+            return 'FAIL(%s: %d of %d objects failed:\n%s)' % (verb, len(errors), len(objects), '\n'.join(errors))
+
+        times = dict( (obj[1], round(secs, 6)) for (obj, (secs, _)) in zip(objects, results) )
+        return 'OK:%s(%s)' % (verb.upper(), json.dumps(times, sort_keys=True))
+
+    return _background(CallJob(ret_helper), vals, 'OK:%s(%d)' % (doing, len(objects)))
+
+def do_retrieve_many(msg, vals):
+    try:
+        (storage, settings) = (_storage(vals), TransferSettings.from_vals(vals))
+    except ValueError as e:
+        vals['cmdsock'].enqueue('FAIL(%s)' % str(e))
+        return False
+
+    def retrieve(bucket, key, filename):
+        storage.download(bucket, key, filename, settings)
+    return _transfer_many(msg, vals, Defs.make_retrievestring, retrieve, 'retrieve_many', 'RETRIEVING_MANY')
+
+def do_upload_many(msg, vals):
+    try:
+        (storage, settings) = (_storage(vals), TransferSettings.from_vals(vals))
+    except ValueError as e:
+        vals['cmdsock'].enqueue('FAIL(%s)' % str(e))
+        return False
+
+    def upload(bucket, key, filename):
+        storage.upload(filename, bucket, key, settings)
+    return _transfer_many(msg, vals, Defs.make_uploadstring, upload, 'upload_many', 'UPLOADING_MANY')
 
 ###
 #  echo msg back to the server
@@ -171,23 +250,34 @@ def do_quit(_, vals):
 
 ###
 #  run the command
+#
+#  With stream_output set, its output goes back in INFO:output: messages as it
+#  comes (at most one every output_interval seconds), and OK:RETVAL only has
+#  the last output_tail bytes; output_log names a file (##TMPDIR## is
+#  allowed) that gets all of it, ready to upload:
+#
+#  make_cmdstring can leave the name of an input state file in
+#  vals['_waitfor']; the command only starts once it's there.
 ###
-def do_run(msg, vals):
-    cmdstring = Defs.make_cmdstring(msg, vals)
+def _streaming_output(vals):
+    log = vals.get('output_log')
+    if log is not None:
+        log = open(log.replace("##TMPDIR##", vals.get('_tmpdir', '')), 'a')
 
-    def ret_helper():
-        retval = 0
-        try:
-            output = subprocess.check_output([cmdstring], shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            retval = e.returncode
-            output = e.output
+    def report(text):
+        vals['cmdsock'].enqueue('INFO:output:%s' % text, Defs.ftype_info)
 
-        donemsg = 'OK:RETVAL(%d):OUTPUT(%s):COMMAND(%s)' % (retval, output, cmdstring)
+    return StreamingOutput(report, int(vals.get('output_tail', 65536)), float(vals.get('output_interval', 1)), log)
 
-        return (donemsg, retval)
+def do_run(msg, vals):
+    cmdstring = Defs.make_cmdstring(msg, vals)
 
-    return _background(ret_helper, vals, 'OK:RUNNING(%s)' % cmdstring)
+    def finish(retval, output):
+        return 'OK:RETVAL(%d):OUTPUT(%s):COMMAND(%s)' % (retval, output, cmdstring)
+
+    output = _streaming_output(vals) if vals.get('stream_output') else None
+    waitfor = vals.pop('_waitfor', None)
+    return _background(CommandJob(cmdstring, finish, output), vals, 'OK:RUNNING(%s)' % cmdstring, waitfor)
 
 ###
 #  connect to peer lambda
@@ -228,49 +318,128 @@ def do_close_connect(_, vals):
     vals['cmdsock'].enqueue('OK:CLOSE_CONNECT')
     return False
 
+###
+#  run several commands in a row, sending back all of their responses in one message
+###
+def pack_batch(msgs):
+    return ''.join( "%d:%s" % (len(msg), msg) for msg in msgs )
+
+def unpack_batch(data):
+    msgs = []
+    off = 0
+    while off < len(data):
+        colon = data.index(':', off)
+        mlen = int(data[off:colon])
+        msgs.append(data[colon + 1:colon + 1 + mlen])
+        off = colon + 1 + mlen
+
+    return msgs
+
+# stands in for cmdsock while a batch runs
+class _BatchCollector(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.responses = []
+
+    def enqueue(self, msg, ftype=Defs.ftype_command):
+        if ftype == Defs.ftype_info:
+            # INFO goes out on its own, ahead of the batched response (as it would have anyway)
+            self.sock.enqueue(msg, ftype)
+        else:
+            self.responses.append(msg)
+
+    def close(self):
+        self.sock.close()
+
+def do_batch(msg, vals):
+    cmdsock = vals['cmdsock']
+    collector = _BatchCollector(cmdsock)
+    vals['cmdsock'] = collector
+
+    retval = False
+    try:
+        for cmd in unpack_batch(msg):
+            retval = handle_message(cmd, vals)
+            if retval:
+                break
+    finally:
+        vals['cmdsock'] = cmdsock
+
+    if len(collector.responses) > 0 and cmdsock.sock is not None:
+        cmdsock.enqueue(Defs.batch_response + pack_batch(collector.responses), Defs.ftype_response)
+
+    return retval
+
+###
+#  per-command counters, fetched with stats:
+#  verb -> [count, seconds, bytes of arguments]
+#  (a command that runs in the background is only timed until it's started;
+#  a batch is timed along with the commands in it). state_wait counts the
+#  runs that waited for an input state file, and how long they waited.
+###
+command_stats = {}
+
+def do_stats(_, vals):
+    stats = dict( (verb, {'count': count, 'time': round(secs, 6), 'bytes': nbytes})
+                  for (verb, (count, secs, nbytes)) in command_stats.items() )
+    vals['cmdsock'].enqueue('OK:STATS(%s)' % json.dumps(stats, sort_keys=True))
+    return False
+
+# on the coordinator side: the dict in a stats: response
+def parse_stats(msg):
+    return json.loads(msg[len('OK:STATS('):-1])
+
 ###
 #  dispatch to handler functions
+#
+#  'verb:args' calls the function registered for verb as fun(args, vals); it
+#  returns True if the worker should stop. response is the start of the reply
+#  the coordinator waits for (see expected_response). Server modules can
+#  register their own commands, as long as the worker imports them too.
 ###
-message_types = { 'set:': do_set
-                , 'seti:': do_seti
-                , 'get:': do_get
-                , 'geti:': do_geti
-                , 'dump_vals:': do_dump_vals
-                , 'retrieve:': do_retrieve
-                , 'upload:': do_upload
-                , 'echo:': do_echo
-                , 'quit:': do_quit
-                , 'run:': do_run
-                , 'connect:': do_connect
-                , 'close_connect:': do_close_connect
-                }
+commands = {}
+
+def register_command(verb, fun, response="OK"):
+    commands[verb] = (fun, response)
+
+register_command('set', do_set, 'OK:SET')
+register_command('seti', do_seti, 'OK:SETI')
+register_command('get', do_get, 'OK:GET')
+register_command('geti', do_geti, 'OK:GETI')
+register_command('dump_vals', do_dump_vals, 'OK:DUMP_VALS')
+register_command('retrieve', do_retrieve, 'OK:RETRIEV')
+register_command('upload', do_upload, 'OK:UPLOAD')
+register_command('retrieve_many', do_retrieve_many, 'OK:RETRIEV')
+register_command('upload_many', do_upload_many, 'OK:UPLOAD')
+register_command('echo', do_echo, 'OK:ECHO')
+register_command('quit', do_quit)
+register_command('run', do_run, 'OK:R')
+register_command('connect', do_connect, 'OK:CONNECT')
+register_command('close_connect', do_close_connect, 'OK:CLOSE_CONNECT')
+register_command('batch', do_batch, 'OK:BATCH')
+register_command('stats', do_stats, 'OK:STATS')
+
 def handle_message(msg, vals):
     if Defs.debug:
         print "CLIENT HANDLING %s" % msg
 
-    for mtype in message_types:
-        if msg[:len(mtype)] == mtype:
-            return message_types[mtype](msg[len(mtype):], vals)
+    (verb, sep, args) = msg.partition(':')
+    cmd = commands.get(verb) if sep else None
+    if cmd is None:
+        vals['cmdsock'].enqueue("FAIL(no such command '%s')" % msg)
+        return False
 
-    # if we got here, we don't recognize the command
-    vals['cmdsock'].enqueue("FAIL(no such command '%s')" % msg)
-    return False
+    start = time.time()
+    try:
+        return cmd[0](args, vals)
+    finally:
+        stats = command_stats.get(verb)
+        if stats is None:
+            stats = command_stats[verb] = [0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += time.time() - start
+        stats[2] += len(args)
 
-message_responses = { 'set': 'OK:SET'
-                    , 'seti': 'OK:SETI'
-                    , 'get': 'OK:GET'
-                    , 'geti': 'OK:GETI'
-                    , 'dump_vals': 'OK:DUMP_VALS'
-                    , 'retrieve': 'OK:RETRIEV'
-                    , 'upload': 'OK:UPLOAD'
-                    , 'echo': 'OK:ECHO'
-                    , 'run': 'OK:R'
-                    , 'listen': 'OK:LISTEN'
-                    , 'close_listen': 'OK:CLOSE_LISTEN'
-                    , 'connect': 'OK:CONNECT'
-                    , 'close_connect': 'OK:CLOSE_CONNECT'
-                    }
 def expected_response(msg):
-    cmd = msg.split(':', 1)[0]
-    expected = message_responses.get(cmd, "OK")
-    return expected
+    cmd = commands.get(msg.split(':', 1)[0])
+    return "OK" if cmd is None else cmd[1]
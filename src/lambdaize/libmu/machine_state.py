@@ -10,6 +10,11 @@ import libmu.util
 class MachineState(SocketNB):
     expect = None
     extra = "(base class)"
+    # if not None, the server kills an actor that stays in this state this many seconds
+    timeout = None
+    # we only send a worker more commands after reading its responses, so with
+    # send_high_water set, stop reading from a worker that isn't keeping up
+    throttle_when_full = True
 
     def __init__(self, prevState, actorNum=0):
         super(MachineState, self).__init__(prevState)
@@ -20,6 +25,8 @@ class MachineState(SocketNB):
             self.timestamps = prevState.timestamps
             self.stateinfo = prevState.stateinfo
             self.info = prevState.info
+            self.timeline = prevState.timeline
+            self.speculative = prevState.speculative
 
         else:
             # first time we're being initialized
@@ -28,10 +35,24 @@ class MachineState(SocketNB):
             self.timestamps = []
             self.stateinfo = []
             self.info = {}
+            # the server can hand us a libmu.timeline.TimelineWriter via the socket,
+            # and tell us we're a speculative duplicate (see Coordinator._speculate)
+            self.timeline = getattr(prevState, 'timeline', None)
+            self.speculative = getattr(prevState, 'speculative', False)
 
         self.messages = []
-        self.timestamps.append(time.time())
-        self.stateinfo.append(self.__class__.__name__)
+        self.timer = None
+        now = time.time()
+        if self.timeline is None:
+            self.timestamps.append(now)
+            self.stateinfo.append(self.__class__.__name__)
+        else:
+            # stream transitions to the timeline instead of keeping them all in memory
+            # (but keep the first one: timestamps[0] is the actor's start time)
+            self.timeline.record(self.actorNum, self.__class__.__name__, now, self.bytes_in, self.bytes_out, self.speculative)
+            if len(self.timestamps) == 0:
+                self.timestamps.append(now)
+                self.stateinfo.append(self.__class__.__name__)
 
     def __repr__(self):
         return "%s: %s" % (type(self), str(self))
@@ -50,20 +71,19 @@ class MachineState(SocketNB):
 
     def do_handle(self):
         ### handle INFO messages
-        info_updated = False
-        for msg in list(self.recv_queue):
-        # use list(deque) so that we can modify the deque inside the iteration
-            if msg[:4] == 'INFO':
-                if Defs.debug:
-                    print "SERVER HANDLING (%d) %s" % (self.actorNum, msg)
-                info_updated = True
-                self.recv_queue.remove(msg)
-
-                vv = msg[5:].split(':', 1)
-                if len(vv) != 2 or len(vv[0]) < 1:
-                    raise AttributeError("improper INFO message received")
-
-                self.info[vv[0]] = vv[1]
+        # binary frames are typed, so INFO messages arrive in their own queue
+        info_updated = len(self.info_queue) > 0
+        while len(self.info_queue) > 0:
+            self._handle_info(self.info_queue.popleft())
+
+        # with ASCII frames, we have to go looking for them
+        if not self.send_binary:
+            for msg in list(self.recv_queue):
+            # use list(deque) so that we can modify the deque inside the iteration
+                if msg[:4] == 'INFO':
+                    info_updated = True
+                    self.recv_queue.remove(msg)
+                    self._handle_info(msg)
 
         if info_updated:
             self.info_updated()
@@ -75,6 +95,12 @@ class MachineState(SocketNB):
         retries = []
         while state.want_handle:
             msg = state.dequeue()
+            if msg[:len(Defs.batch_response)] == Defs.batch_response:
+                # responses to a batch: handle them one by one, as if they'd come separately
+                state.recv_queue.extendleft(reversed(libmu.handler.unpack_batch(msg[len(Defs.batch_response):])))
+                state.update_flags()
+                continue
+
             if Defs.debug:
                 print "SERVER HANDLING (%d) %s" % (self.actorNum, msg)
 
@@ -92,19 +118,30 @@ class MachineState(SocketNB):
                 print repr(state)
             state.update_flags()
 
-        # put any that were skipped back in the queue
+        # put any that were skipped back in the queue; they don't count toward recv_high_water
         state.recv_queue.extend(retries)
+        state.recv_held = len(retries)
         state.update_flags()
 
         return state
 
+    def _handle_info(self, msg):
+        if Defs.debug:
+            print "SERVER HANDLING (%d) %s" % (self.actorNum, msg)
+
+        vv = msg[5:].split(':', 1)
+        if len(vv) != 2 or len(vv[0]) < 1:
+            raise AttributeError("improper INFO message received")
+
+        self.info[vv[0]] = vv[1]
+
     def do_read(self):
         try:
             super(MachineState, self).do_read()
         except Exception as e:  # pylint: disable=broad-except
             return ErrorState(self, str(e))
 
-        if self.want_handle:
+        if self.want_handle or len(self.info_queue) > 0:
             return self.do_handle()
 
         return self
@@ -122,6 +159,7 @@ class MachineState(SocketNB):
 
 class TerminalState(MachineState):
     extra = "(terminal state)"
+    want_read = False
 
     def __init__(self, prevState, actorNum=0):
         super(TerminalState, self).__init__(prevState, actorNum)
@@ -151,7 +189,7 @@ class OnePassState(MachineState):
     def kick(self):
         # schedule ourselves for immediate run
         self.recv_queue.appendleft(self.expect)
-        self.want_handle = True
+        self.update_flags()
 
     def transition(self, msg):
         if msg[:len(self.expect)] != self.expect:
@@ -170,6 +208,9 @@ class OnePassState(MachineState):
 class MultiPassState(MachineState):
     nextState = TerminalState
     extra = "(multi-pass state)"
+    # if True, commands that go out together are sent as one batch: command
+    # (as long as the worker said it understands them)
+    batched = False
 
     def __init__(self, prevState, actorNum=0):
         super(MultiPassState, self).__init__(prevState, actorNum)
@@ -183,24 +224,34 @@ class MultiPassState(MachineState):
         self.messages.append(msg)
 
         # enqueue as many further commands as we can
+        commands = []
         send_next_message = True
         while send_next_message:
             command = self.commands[self.cmdNum]
             self.cmdNum += 1
 
             if command is not None:
-                self.enqueue(command)
+                commands.append(command)
 
             if self.cmdNum >= len(self.commands):
-                return self.nextState(self)
+                break
 
             send_next_message = self.expects[self.cmdNum] is None
 
+        if self.batched and len(commands) > 1 and 'batch' in self.peer_caps:
+            self.enqueue(Defs.batch_command + libmu.handler.pack_batch(commands))
+        else:
+            for command in commands:
+                self.enqueue(command)
+
+        if self.cmdNum >= len(self.commands):
+            return self.nextState(self)
+
         return self
 
     def kick(self):
         self.recv_queue.appendleft(self.expects[self.cmdNum])
-        self.want_handle = True
+        self.update_flags()
 
     def str_extra(self):
         return "(%s (#%d))" % (self.extra, self.cmdNum)
@@ -212,9 +263,13 @@ class CommandListState(MultiPassState):
     nextState = TerminalState
     commandlist = []
     pipelined = False
+    # None means batch whenever we're pipelined
+    batched = None
 
     def __init__(self, prevState, actorNum=0):
         super(CommandListState, self).__init__(prevState, actorNum)
+        if self.batched is None:
+            self.batched = self.pipelined
 
         # explicit expect if given, otherwise set expect based on previous command
         self.expects = [ self.commandlist[0][0] if isinstance(self.commandlist[0], tuple) else "OK" ]
@@ -289,7 +344,10 @@ class SuperpositionState(MachineState):
         super(SuperpositionState, self).__init__(prevState, actorNum)
         states = []
         for s in self.state_constructors:
-            states.append(s(prevState, actorNum))
+            st = s(prevState, actorNum)
+            # substates share our socket; only we talk to the event engine
+            st.engine = None
+            states.append(st)
         self.states = states
 
     def str_extra(self):
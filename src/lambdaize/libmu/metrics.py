@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+import json
+import math
+import os
+import select
+import socket
+import time
+
+###
+#  fixed-size latency histogram
+#  Buckets are log-spaced (4 per power of two starting at 1us), so add() is
+#  O(1) and percentiles are accurate to within about 20%.
+###
+class Histogram(object):
+    per_octave = 4
+
+    def __init__(self, min_val=1e-6, nbuckets=128):
+        self.min_val = min_val
+        self.buckets = [0] * nbuckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, val):
+        self.count += 1
+        self.total += val
+        if val > self.max:
+            self.max = val
+
+        if val <= self.min_val:
+            idx = 0
+        else:
+            idx = int(math.ceil(self.per_octave * math.log(val / self.min_val, 2)))
+            idx = min(idx, len(self.buckets) - 1)
+        self.buckets[idx] += 1
+
+    # upper bound of the bucket holding the p'th percentile (0 < p <= 100)
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+
+        want = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for (idx, num) in enumerate(self.buckets):
+            seen += num
+            if seen >= want:
+                return min(self.max, self.min_val * 2 ** (float(idx) / self.per_octave))
+
+        return self.max
+
+    def to_dict(self):
+        mean = self.total / self.count if self.count > 0 else None
+        return { 'count': self.count
+               , 'mean': mean
+               , 'max': self.max
+               , 'p50': self.percentile(50)
+               , 'p90': self.percentile(90)
+               , 'p99': self.percentile(99)
+               }
+
+###
+#  counters and histograms the Coordinator updates as it runs
+#  Everything here is cheap to update; the work happens in snapshot(), which
+#  only runs when someone asks for metrics.
+###
+class CoordinatorMetrics(object):
+    # summed over every connection's libmu.compression.AdaptiveCompressor
+    compression_keys = ('raw_out', 'comp_out', 'deflate_time', 'raw_in', 'comp_in', 'inflate_time')
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.iterations = 0
+        self.poll_wait = Histogram()
+        self.handler = Histogram()
+        self.state_time = {}
+        self.last_sample = None
+        self.rates = {}
+
+    # one pass of the mainloop: time spent in poll(), then in handlers
+    def record_iteration(self, poll_wait, handler_time):
+        self.iterations += 1
+        self.poll_wait.add(poll_wait)
+        self.handler.add(handler_time)
+
+    # an actor spent elapsed seconds in a state of class name
+    def record_state_time(self, name, elapsed):
+        hist = self.state_time.get(name)
+        if hist is None:
+            hist = Histogram()
+            self.state_time[name] = hist
+        hist.add(elapsed)
+
+    def snapshot(self, states, extra=None):
+        now = time.time()
+        totals = { 'bytes_in': 0, 'bytes_out': 0, 'msgs_in': 0, 'msgs_out': 0 }
+        ztotals = dict.fromkeys(self.compression_keys, 0)
+        queues = { 'send_bytes': 0, 'send_bytes_max': 0, 'recv_msgs': 0, 'recv_msgs_max': 0, 'throttled': 0 }
+        classes = {}
+        for st in states:
+            for key in totals:
+                totals[key] += getattr(st, key, 0)
+            send_bytes = getattr(st, 'send_bytes', 0)
+            recv_msgs = len(getattr(st, 'recv_queue', ()))
+            queues['send_bytes'] += send_bytes
+            queues['send_bytes_max'] = max(queues['send_bytes_max'], send_bytes)
+            queues['recv_msgs'] += recv_msgs
+            queues['recv_msgs_max'] = max(queues['recv_msgs_max'], recv_msgs)
+            if getattr(st, 'throttled', False) or getattr(st, 'recv_full', False):
+                queues['throttled'] += 1
+            comp = getattr(st, 'compressor', None)
+            if comp is not None:
+                for key in ztotals:
+                    ztotals[key] += getattr(comp, key)
+            name = st.__class__.__name__
+            classes[name] = classes.get(name, 0) + 1
+
+        # rates are computed over (at least) the last second
+        if self.last_sample is None:
+            self.last_sample = (self.start_time, dict.fromkeys(totals, 0))
+        (last_time, last_totals) = self.last_sample
+        if now - last_time >= 1 or not self.rates:
+            elapsed = max(now - last_time, 1e-6)
+            self.rates = dict( (key + '_per_sec', (totals[key] - last_totals[key]) / elapsed) for key in totals )
+            self.last_sample = (now, totals)
+
+        io = dict(totals)
+        io.update(self.rates)
+
+        ret = { 'time': now
+              , 'uptime': now - self.start_time
+              , 'loop': { 'iterations': self.iterations
+                        , 'poll_wait': self.poll_wait.to_dict()
+                        , 'handler': self.handler.to_dict()
+                        }
+              , 'io': io
+              , 'compression': ztotals
+              , 'queues': queues
+              , 'states': classes
+              , 'state_time': dict( (name, hist.to_dict()) for (name, hist) in self.state_time.items() )
+              }
+        if extra is not None:
+            ret.update(extra)
+
+        return ret
+
+###
+#  serve metrics snapshots from inside the Coordinator's event loop
+#  addr is either a port number (plain HTTP on localhost, e.g., curl
+#  http://localhost:port/) or the path of a UNIX socket (send any line and
+#  read back one JSON object, e.g., echo | socat - UNIX-CONNECT:path).
+#  Metrics fds are registered with the engine as raw fds, so they never keep
+#  the mainloop alive.
+###
+class MetricsServer(object):
+    def __init__(self, addr, engine, snapshot_fn):
+        self.engine = engine
+        self.snapshot_fn = snapshot_fn
+        self.clients = {}
+        self.path = None
+
+        if isinstance(addr, int) or str(addr).isdigit():
+            self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.lsock.bind(('127.0.0.1', int(addr)))
+        else:
+            self.path = addr
+            if os.path.exists(addr):
+                os.unlink(addr)
+            self.lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.lsock.bind(addr)
+
+        self.lsock.listen(16)
+        self.lsock.setblocking(False)
+        self.lsock_fd = self.lsock.fileno()
+        self.engine.add_fd(self.lsock_fd, select.POLLIN)
+
+    def owns(self, fd):
+        return fd == self.lsock_fd or fd in self.clients
+
+    def handle(self, fd):
+        if fd == self.lsock_fd:
+            try:
+                (ns, _) = self.lsock.accept()
+            except socket.error:
+                return
+            ns.setblocking(False)
+            self.clients[ns.fileno()] = ns
+            self.engine.add_fd(ns.fileno(), select.POLLIN)
+            return
+
+        ns = self.clients[fd]
+        try:
+            req = ns.recv(4096)
+        except socket.error:
+            req = ""
+
+        try:
+            if len(req) > 0:
+                body = json.dumps(self.snapshot_fn(), sort_keys=True) + "\n"
+                if req.startswith("GET "):
+                    hdr = "HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(body)
+                    body = hdr + body
+
+                # responses are small, so don't bother with non-blocking writes
+                ns.settimeout(1)
+                ns.sendall(body)
+        except socket.error:
+            pass
+
+        self._close_client(fd)
+
+    def _close_client(self, fd):
+        self.engine.remove_fd(fd)
+        ns = self.clients.pop(fd)
+        try:
+            ns.close()
+        except:
+            pass
+
+    def close(self):
+        for fd in list(self.clients.keys()):
+            self._close_client(fd)
+
+        self.engine.remove_fd(self.lsock_fd)
+        self.lsock.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
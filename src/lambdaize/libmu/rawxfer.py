@@ -0,0 +1,356 @@
+#!/usr/bin/python
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import zlib
+
+from libmu.defs import Defs
+
+###
+#  raw file transfers on plain (non-TLS) sockets
+#
+#  RAW_BEGIN(nbytes:crc):header   an ordinary message announcing the transfer
+#  <nbytes bytes, unframed>       the file itself, straight after the announcement
+#
+#  The sender hands the file to the kernel with sendfile(2), the state relay
+#  moves the bytes from one socket to the other with splice(2) through a pipe,
+#  and the receiver splices them into its file. None of it passes through
+#  Python strings. crc is the zlib.crc32 of the file; the receiver checks it
+#  once the whole file is there.
+#
+#  Python 2 has neither os.sendfile nor os.splice, so we call libc through
+#  ctypes; where that's not possible, the same protocol runs on plain reads
+#  and writes.
+###
+
+def _libc_function(names, restype, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+    for name in names:
+        fun = getattr(libc, name, None)
+        if fun is not None:
+            fun.restype = restype
+            fun.argtypes = argtypes
+            return fun
+
+    return None
+
+_sendfile = _libc_function( ('sendfile64', 'sendfile'), ctypes.c_ssize_t
+                          , [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t] )
+_splice = _libc_function( ('splice',), ctypes.c_ssize_t
+                        , [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint] )
+
+# set these to False to use plain reads and writes instead
+use_sendfile = _sendfile is not None
+use_splice = _splice is not None
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+def _would_block(exc):
+    return getattr(exc, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# copy up to count bytes from in_fd (starting at offset) to out_fd; returns the number copied
+def sendfile(out_fd, in_fd, offset, count):
+    if use_sendfile:
+        return _check(_sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count))
+
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    return os.write(out_fd, os.read(in_fd, count))
+
+def file_crc(fobj, chunk_size=1048576):
+    fobj.seek(0)
+    crc = 0
+    while True:
+        data = fobj.read(chunk_size)
+        if len(data) == 0:
+            break
+        crc = zlib.crc32(data, crc)
+    fobj.seek(0)
+
+    return crc & 0xffffffff
+
+def format_begin(nbytes, crc, header):
+    return "%s%d:%08x):%s" % (Defs.raw_begin, nbytes, crc, header)
+
+# if msg announces a raw transfer, return (nbytes, crc, header); otherwise None
+def parse_begin(msg):
+    if msg[:len(Defs.raw_begin)] != Defs.raw_begin:
+        return None
+
+    rind = msg.find('):')
+    if rind < 0:
+        raise ValueError("malformed raw transfer header")
+    (nbytes, crc) = msg[len(Defs.raw_begin):rind].split(':')
+
+    return (int(nbytes), int(crc, 16), msg[rind + 2:])
+
+###
+#  a pipe that bytes pass through on their way from one fd to another
+#  fill() and drain() raise EnvironmentError with errno EAGAIN when the fd isn't ready
+###
+class SplicePipe(object):
+    # ask for a pipe this big (the kernel may say no)
+    pipe_size = 1048576
+
+    def __init__(self):
+        (self.rfd, self.wfd) = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        try:
+            fcntl.fcntl(self.wfd, F_SETPIPE_SZ, self.pipe_size)
+        except IOError:
+            pass
+        try:
+            self.capacity = fcntl.fcntl(self.wfd, F_GETPIPE_SZ)
+        except IOError:
+            self.capacity = 65536
+        self.nbytes = 0
+
+    def __len__(self):
+        return self.nbytes
+
+    def room(self):
+        return self.capacity - self.nbytes
+
+    # move up to count bytes from fd into the pipe; 0 means EOF
+    def fill(self, fd, count):
+        nmoved = _check(_splice(fd, None, self.wfd, None, count, SPLICE_F_MOVE | SPLICE_F_NONBLOCK))
+        self.nbytes += nmoved
+        return nmoved
+
+    # move as much as fd will take out of the pipe
+    def drain(self, fd):
+        nmoved = _check(_splice(self.rfd, None, fd, None, self.nbytes, SPLICE_F_MOVE | SPLICE_F_NONBLOCK))
+        self.nbytes -= nmoved
+        return nmoved
+
+    def close(self):
+        if self.rfd is not None:
+            os.close(self.rfd)
+            os.close(self.wfd)
+            self.rfd = self.wfd = None
+
+# the same, through a string (when we can't splice)
+class BufferPipe(object):
+    capacity = 1048576
+
+    def __init__(self):
+        self.buf = ''
+
+    def __len__(self):
+        return len(self.buf)
+
+    def room(self):
+        return self.capacity - len(self.buf)
+
+    def fill(self, fd, count):
+        data = os.read(fd, count)
+        self.buf += data
+        return len(data)
+
+    def drain(self, fd):
+        nmoved = os.write(fd, self.buf)
+        self.buf = self.buf[nmoved:]
+        return nmoved
+
+    def close(self):
+        self.buf = ''
+
+def make_pipe():
+    return SplicePipe() if use_splice else BufferPipe()
+
+###
+#  the sending half: SocketNB.send_file puts one of these in sock.streams.
+#  The first pump() queues the announcement and the sender itself behind it;
+#  after that, each pump() hands as much of the file as the socket takes to sendfile.
+###
+class RawSender(object):
+    # most we hand to sendfile at once
+    chunk_size = 1048576
+
+    def __init__(self, header, fobj):
+        self.header = header
+        self.fobj = fobj
+        self.nbytes = os.fstat(fobj.fileno()).st_size
+        self.offset = 0
+        self.started = False
+
+    def __len__(self):
+        return self.nbytes - self.offset
+
+    @staticmethod
+    def ready():
+        return True
+
+    def pump(self, sock):
+        if not self.started:
+            self.started = True
+            sock.enqueue(format_begin(self.nbytes, file_crc(self.fobj), self.header), Defs.ftype_state)
+            sock.send_queue.append(self)
+            return True
+
+        while self.offset < self.nbytes:
+            try:
+                nsent = sendfile(sock.fileno(), self.fobj.fileno(), self.offset, min(self.chunk_size, self.nbytes - self.offset))
+            except EnvironmentError as e:
+                if _would_block(e):
+                    return False
+                raise
+
+            if nsent == 0:
+                raise IOError("%s: file shrank while sending it" % self.header)
+            self.offset += nsent
+            sock.bytes_out += nsent
+
+        self.fobj.close()
+        return True
+
+###
+#  the receiving half: after dequeueing a RAW_BEGIN, hand one of these to
+#  SocketNB.recv_raw along with the file to write (opened 'w+b'). done(receiver)
+#  is called once the file is complete; receiver.ok says whether the checksum matched.
+###
+class RawReceiver(object):
+    def __init__(self, fobj, nbytes, crc, done=None):
+        self.fobj = fobj
+        self.nbytes = nbytes
+        self.crc = crc
+        self.done = done
+        self.toread = nbytes
+        self.pipe = make_pipe()
+        self.ok = None
+
+    @staticmethod
+    def reading():
+        return True
+
+    def pump(self, sock):
+        fd = self.fobj.fileno()
+
+        # first, whatever arrived along with the announcement
+        data = sock.take_buffered(self.toread)
+        self.toread -= len(data)
+        while len(data) > 0:
+            data = data[os.write(fd, data):]
+
+        try:
+            while self.toread > 0:
+                nread = self.pipe.fill(sock.fileno(), min(self.toread, self.pipe.room()))
+                if nread == 0:
+                    # the sender went away halfway through
+                    self.pipe.close()
+                    sock.close()
+                    return
+                self.toread -= nread
+                sock.bytes_in += nread
+                while len(self.pipe) > 0:
+                    self.pipe.drain(fd)
+        except EnvironmentError as e:
+            if not _would_block(e):
+                raise
+            return
+
+        self.pipe.close()
+        self.ok = file_crc(self.fobj) == self.crc
+        self.fobj.close()
+        sock.raw_done()
+        if self.done is not None:
+            self.done(self)
+
+###
+#  the state relay's half: connects src (which has just delivered a RAW_BEGIN)
+#  to dst. It sits in dst.send_queue behind the forwarded announcement and is
+#  src's raw sink, so it's pumped when src is readable and when dst is writable.
+###
+class RawRelay(object):
+    def __init__(self, src, dst, nbytes):
+        self.src = src
+        self.dst = dst
+        self.head = src.take_buffered(nbytes)
+        self.toread = nbytes - len(self.head)
+        self.towrite = nbytes
+        self.pipe = make_pipe()
+
+    def __len__(self):
+        return self.towrite
+
+    def ready(self):
+        return self.towrite == 0 or len(self.head) > 0 or len(self.pipe) > 0
+
+    def reading(self):
+        return self.toread > 0 and self.pipe.room() > 0
+
+    # one side is gone or broken; the other can't make sense of what follows
+    def _abort(self):
+        self.pipe.close()
+        self.src.close()
+        self.dst.close()
+        return False
+
+    def pump(self, _=None):
+        (src, dst) = (self.src, self.dst)
+        if src.sock is None or dst.sock is None:
+            return self._abort()
+
+        try:
+            try:
+                while self.toread > 0 and self.pipe.room() > 0:
+                    nread = self.pipe.fill(src.fileno(), min(self.toread, self.pipe.room()))
+                    if nread == 0:
+                        raise EOFError()
+                    self.toread -= nread
+                    src.bytes_in += nread
+            except EnvironmentError as e:
+                if not _would_block(e):
+                    raise
+
+            # only write once everything queued ahead of us is out
+            if dst.send_buf is None and len(dst.send_queue) > 0 and dst.send_queue[0] is self:
+                while len(self.head) > 0:
+                    nsent = dst.sock.send(self.head)
+                    self.head = self.head[nsent:]
+                    self.towrite -= nsent
+                    dst.bytes_out += nsent
+                while len(self.pipe) > 0:
+                    nsent = self.pipe.drain(dst.fileno())
+                    self.towrite -= nsent
+                    dst.bytes_out += nsent
+        except EnvironmentError as e:
+            if not _would_block(e):
+                return self._abort()
+        except EOFError:
+            return self._abort()
+
+        if self.toread == 0 and src.raw_sink is self:
+            # src can go back to messages while we finish writing
+            src.raw_done()
+        if self.towrite == 0:
+            self.pipe.close()
+
+        src.update_flags()
+        dst.update_flags()
+        return self.towrite == 0
+
+###
+#  outgoing raw data sits in SocketNB.send_queue (after its RAW_BEGIN), and
+#  SocketNB.do_write calls its pump() once everything before it has been sent.
+#  ready() says whether pump() can make progress right now; pump() returns True
+#  once the whole transfer has been written.
+###
+raw_out_types = (RawSender, RawRelay)
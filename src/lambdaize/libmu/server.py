@@ -1,10 +1,12 @@
 #!/usr/bin/python
 
+import cPickle
 import cProfile
 import datetime
 import fcntl
 import getopt
 import json
+import multiprocessing
 import os
 import select
 import socket
@@ -12,38 +14,41 @@ import struct
 import sys
 import termios
 import time
+import traceback
 
 import pylaunch
 import libmu.defs
+import libmu.event_engine
 import libmu.machine_state
+import libmu.metrics
+import libmu.socket_nb
+import libmu.timeline
+import libmu.timers
 import libmu.util
 
 ###
-#  handle new connection on server listening socket
+#  number the next connection (across all shards, if sharded)
 ###
-def _handle_server_sock(ls, states, state_fd_map, state_actNum_map, server_info, constructor):
-    (ns, _) = ls.accept()
-    ns.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-    ns.setblocking(False)
-
-    this_actor = len(states)
-    if getattr(server_info, 'keyframe_distance', None) is not None:
-        (actor_number, group_number, _) = _compute_actor_number(this_actor, server_info.keyframe_distance, server_info.num_parts)
-    else:
-        actor_number = this_actor
-        group_number = None
+def _next_arrival(states, server_info):
+    counter = getattr(server_info, 'actor_counter', None)
+    if counter is None:
+        return len(states)
 
-    if hasattr(server_info, 'state_srv_threads') and group_number is not None:
-        nstate = constructor(ns, actor_number, group_number)
-    else:
-        nstate = constructor(ns, actor_number)
-    nstate.do_handshake()
+    with counter.get_lock():
+        this_actor = counter.value
+        counter.value += 1
+
+    return this_actor
 
-    states.append(nstate)
-    state_fd_map[nstate.fileno()] = this_actor
-    state_actNum_map[actor_number] = this_actor
+def _num_arrived(states, server_info):
+    counter = getattr(server_info, 'actor_counter', None)
+    if counter is None:
+        return len(states)
 
-    if len(states) == server_info.num_parts:
+    return min(counter.value, server_info.num_parts)
+
+def _close_if_all_arrived(ls, states, server_info):
+    if ls is not None and _num_arrived(states, server_info) >= server_info.num_parts:
         # no need to listen any longer, we have all our connections
         try:
             ls.shutdown()
@@ -115,186 +120,686 @@ def server_launch(server_info, event, akid, secret):
 #  set up server listen sock
 ###
 def setup_server_listen(server_info):
-    return libmu.util.listen_socket('0.0.0.0', server_info.port_number, server_info.cacert, server_info.srvcrt, server_info.srvkey, server_info.num_parts + 10)
+    reuse_port = getattr(server_info, 'num_shards', 1) > 1
+    return libmu.util.listen_socket('0.0.0.0', server_info.port_number, server_info.cacert, server_info.srvcrt, server_info.srvkey, server_info.num_parts + 10, reuse_port)
 
 ###
-#  server mainloop
+#  Coordinator: the server mainloop as an object
+#  server_main_loop just calls run(), but another event loop can embed a
+#  Coordinator instead: poll on fileno() (needs the epoll backend), wake up
+#  after at most poll_timeout() ms, and call step(0) each time.
 ###
-def server_main_loop(states, constructor, server_info):
-    server_info.start_time = time.time()
-    # handle profiling if specified
-    if server_info.profiling:
-        pr = cProfile.Profile()
-        pr.enable()
-
-    lsock = setup_server_listen(server_info)
-    lsock_fd = lsock.fileno()
-
-    def rwsplit(sts, ret):
-        diffs = []
-        ret += [0] * (len(sts) - len(ret))
-        for (st, idx) in zip(sts, range(0, len(sts))):
-            val = 0
-            if st.sock is not None:
-                if not isinstance(st, libmu.machine_state.TerminalState):
-                    val = val | select.POLLIN
-
-                if st.ssl_write or st.want_write:
-                    val = val | select.POLLOUT
-
-                if val != ret[idx]:
-                    ret[idx] = val
-                    diffs.append(idx)
+class Coordinator(object):
+    def __init__(self, states, constructor, server_info):
+        self.states = states
+        self.constructor = constructor
+        self.server_info = server_info
+        self.shard_id = getattr(server_info, 'shard_id', None)
+
+        self.engine = libmu.event_engine.EventEngine(getattr(server_info, 'event_backend', None))
+        self.timers = libmu.timers.TimerQueue()
+        self.state_fd_map = {}
+        self.state_actNum_map = {}
+        self.arrivals = list(range(0, len(states)))
+        self.lsock = None
+        self.lsock_fd = None
+        self.start_time = time.time()
+
+        # status accounting is updated on every state change, so show_status never scans states
+        self.headless = getattr(server_info, 'headless', False)
+        self.status_interval = getattr(server_info, 'status_interval', 1.0)
+        self.last_status = 0
+        self.nerror = 0
+        self.ndone = 0
+        for st in states:
+            self._count_state(st, 1)
+        self.cells = [None] * len(states)
+        self.dirty = set(range(0, len(states)))
+
+        # stream state transitions to disk rather than keeping them in memory
+        self.timeline = None
+        timeline_file = getattr(server_info, 'timeline_file', None)
+        if timeline_file is not None:
+            if self.shard_id is not None:
+                timeline_file = "%s.%d" % (timeline_file, self.shard_id)
+            self.timeline = libmu.timeline.TimelineWriter(timeline_file, getattr(server_info, 'start_time', self.start_time))
+
+        # speculative re-execution: overprovisioned workers wait as spares, and
+        # an actor that's been in one state much longer than its peers gets a
+        # duplicate on a spare. Whichever copy finishes first wins.
+        # NOTE only sensible when actors don't talk to each other (e.g., no state server)
+        self.speculate_pct = getattr(server_info, 'speculate_pct', None)
+        self.speculate_factor = getattr(server_info, 'speculate_factor', 1.5)
+        self.speculate_min_samples = getattr(server_info, 'speculate_min_samples', 8)
+        self.spares = {}
+        self.dups = {}
+        self.dup_fd_map = {}
+        self.ctor_args = {}
+        self.nspeculated = 0
+        self.ndupwins = 0
+
+        # live metrics, served from the mainloop; see libmu.metrics
+        # (speculation uses the per-state-class times, too)
+        self.metrics = None
+        self.metrics_server = None
+        self.entered = [self.start_time] * len(states)
+        if getattr(server_info, 'metrics_addr', None) is not None or self.speculate_pct is not None:
+            self.metrics = libmu.metrics.CoordinatorMetrics()
+        if self.speculate_pct is not None:
+            self.timers.arm(1, self._check_stragglers)
+
+        if getattr(server_info, 'kill_state', None) is None:
+            class TerminatedState(libmu.machine_state.ErrorState):
+                extra = "(TERMINATED)"
+            server_info.kill_state = TerminatedState
+
+        try:
+            (screen_height, screen_width, _, _) = struct.unpack("HHHH", fcntl.ioctl(0, termios.TIOCGWINSZ, struct.pack("HHHH", 0, 0, 0, 0)))
+        except:
+            screen_width = 80
+            screen_height = 50
+        n_per_line = 1 + server_info.num_parts // screen_height
+        n_chars_maybe = max(screen_width // n_per_line, 24)
+        self.n_across = max(screen_width // n_chars_maybe, 1)
+        self.n_chars = screen_width // self.n_across - 1
+
+    ###
+    #  setup and embedding interface
+    ###
+    def listen(self):
+        self.lsock = setup_server_listen(self.server_info)
+        self.lsock_fd = self.lsock.fileno()
+        self.engine.add_fd(self.lsock_fd, select.POLLIN)
+
+        metrics_addr = getattr(self.server_info, 'metrics_addr', None)
+        if metrics_addr is not None and self.metrics_server is None:
+            if self.shard_id is not None:
+                # each shard serves its own metrics
+                if str(metrics_addr).isdigit():
+                    metrics_addr = int(metrics_addr) + self.shard_id
+                else:
+                    metrics_addr = "%s.%d" % (metrics_addr, self.shard_id)
+            self.metrics_server = libmu.metrics.MetricsServer(metrics_addr, self.engine, self.metrics_snapshot)
+
+    def fileno(self):
+        return self.engine.backend.poll_obj.fileno()
+
+    def poll_timeout(self, max_ms=2000):
+        # the next step deals with sockets that closed, or sees we're done; don't sleep on them
+        if len(self.engine.closed) > 0 or (self.engine.num_active() == 0 and self.lsock is None):
+            return 0
+        return self.timers.poll_timeout(max_ms)
+
+    # adopt a connected, non-blocking socket as the next worker
+    def add_connection(self, ns):
+        this_actor = _next_arrival(self.states, self.server_info)
+        if this_actor >= self.server_info.num_parts and self.speculate_pct is not None:
+            # an overprovisioned worker: keep it around in case someone straggles
+            self._park_spare(ns)
+            return None
+
+        elif this_actor >= self.server_info.num_parts:
+            # sharded mode: another shard already accepted the last worker we need
+            try:
+                ns.close()
+            except:
+                pass
+
+            return None
+
+        if self.timeline is not None:
+            # MachineState picks the timeline up from the socket it's given
+            ns = libmu.socket_nb.SocketNB(ns)
+            ns.timeline = self.timeline
+
+        server_info = self.server_info
+        if getattr(server_info, 'keyframe_distance', None) is not None:
+            (actor_number, group_number, _) = _compute_actor_number(this_actor, server_info.keyframe_distance, server_info.num_parts)
+        else:
+            actor_number = this_actor
+            group_number = None
 
+        if hasattr(server_info, 'state_srv_threads') and group_number is not None:
+            nstate = self.constructor(ns, actor_number, group_number)
+        else:
+            nstate = self.constructor(ns, actor_number)
+        self.engine.register(nstate)
+        nstate.do_handshake()
+
+        stateIdx = len(self.states)
+        self.ctor_args[stateIdx] = (actor_number, group_number) if group_number is not None else (actor_number,)
+        self.states.append(nstate)
+        self.arrivals.append(this_actor)
+        self.cells.append(None)
+        self.entered.append(time.time())
+        self.dirty.add(stateIdx)
+        self._count_state(nstate, 1)
+        self.state_fd_map[nstate.fileno()] = stateIdx
+        self.state_actNum_map[actor_number] = stateIdx
+        self._start_timers(stateIdx)
+
+        return stateIdx
+
+    ###
+    #  run to completion, as server_main_loop does
+    ###
+    def run(self):
+        # handle profiling if specified
+        pr = None
+        if self.server_info.profiling:
+            pr = cProfile.Profile()
+            pr.enable()
+
+        if self.lsock is None:
+            self.listen()
+
+        while self.step():
+            pass
+
+        results = self.finish()
+
+        if pr is not None:
+            pr.disable()
+            if self.shard_id is None:
+                pr.dump_stats(self.server_info.profiling)
             else:
-                ret[idx] = 0
-                diffs.append(idx)
-                if not isinstance(st, libmu.machine_state.TerminalState):
-                    sts[idx] = libmu.machine_state.ErrorState(sts[idx], "sock closed in %s" % str(sts[idx]))
-
-        return diffs
-
-    state_fd_map = {}
-    state_actNum_map = {}
-    rwflags = []
-    poll_obj = select.poll()
-    poll_obj.register(lsock_fd, select.POLLIN)
-    npasses_out = 0
-    start_time = time.time()
-
-    if getattr(server_info, 'kill_state', None) is None and getattr(server_info, 'kill_time', None) is not None:
-        class TerminatedState(libmu.machine_state.ErrorState):
-            extra = "(TERMINATED)"
-        server_info.kill_state = TerminatedState
+                pr.dump_stats("%s.%d" % (self.server_info.profiling, self.shard_id))
 
-    try:
-        (screen_height, screen_width, _, _) = struct.unpack("HHHH", fcntl.ioctl(0, termios.TIOCGWINSZ, struct.pack("HHHH", 0, 0, 0, 0)))
-    except:
-        screen_width = 80
-        screen_height = 50
-    n_per_line = 1 + server_info.num_parts // screen_height
-    n_chars_maybe = max(screen_width // n_per_line, 24)
-    n_across = max(screen_width // n_chars_maybe, 1)
-    n_chars = screen_width // n_across - 1
-
-    def show_status():
-        actStates = len([ 1 for v in rwflags if v != 0 ])
-        errStates = len([ 1 for s in states if isinstance(s, libmu.machine_state.ErrorState) ])
-        doneStates = len([ 1 for s in states if isinstance(s, libmu.machine_state.TerminalState) ]) - errStates
-        waitStates = server_info.num_parts - len(states)
-        runTime = str(datetime.timedelta(seconds=time.time() - start_time))
+        return results
+
+    ###
+    #  one pass of the mainloop; returns False once all workers are finished
+    ###
+    def step(self, timeout_ms=None):
+        states = self.states
+
+        # sockets that closed since last time: non-terminal states are now errors
+        for st in self.engine.pop_closed():
+            if self._spare_or_dup_closed(st):
+                continue
+
+            stateIdx = self.state_actNum_map[st.actorNum]
+            st = states[stateIdx]
+            if not isinstance(st, libmu.machine_state.TerminalState):
+                self._set_state(stateIdx, libmu.machine_state.ErrorState(st, "sock closed in %s" % str(st)))
+
+        if self.speculate_pct is None:
+            # in sharded mode, other shards might have accepted the rest of the workers
+            self.lsock = _close_if_all_arrived(self.lsock, states, self.server_info)
+        elif self._all_finished():
+            # stop accepting spares and let the ones we have go
+            self._end_speculation()
+
+        if self.engine.num_active() == 0 and self.lsock is None:
+            return False
+
+        if self.lsock is None and self.lsock_fd is not None:
+            self.engine.remove_fd(self.lsock_fd)
+            self.lsock_fd = None
+
+        # kill_time and per-state timeouts
+        self.timers.run_expired()
+
+        if time.time() - self.last_status >= self.status_interval:
+            self.show_status()
+
+        if timeout_ms is None:
+            timeout_ms = self.poll_timeout()
+        poll_start = time.time()
+        pfds = self.engine.poll(timeout_ms)
+        poll_end = time.time()
+
+        self._handle_events(pfds)
+
+        if self.metrics is not None:
+            self.metrics.record_iteration(poll_end - poll_start, time.time() - poll_end)
+
+        return True
+
+    # dispatch poll results to the listener, the metrics server, and the states
+    def _handle_events(self, pfds):
+        states = self.states
+        if len(pfds) == 0:
+            return
+
+        # look for readable FDs
+        for (fd, ev) in pfds:
+            if (ev & (select.POLLIN | select.POLLHUP | select.POLLERR)) != 0:
+                if self.lsock is not None and fd == self.lsock_fd:
+                    self._accept()
+
+                elif self.metrics_server is not None and self.metrics_server.owns(fd):
+                    self.metrics_server.handle(fd)
+
+                else:
+                    self._do_io(fd, 'do_read')
+
+        for (fd, ev) in pfds:
+            if (ev & select.POLLOUT) != 0:
+                self._do_io(fd, 'do_write')
+
+        # only states that got messages or were kicked need handling
+        # NOTE states that requeue messages (see MachineState.do_handle) stay ready for the next pass
+        for fd in self.engine.pop_ready():
+            stateIdx = self.state_fd_map.get(fd)
+            if stateIdx is not None:
+                rnext = states[stateIdx]
+                if rnext.want_handle and not isinstance(rnext, libmu.machine_state.TerminalState):
+                    self._set_state(stateIdx, rnext.do_handle())
+
+            elif fd in self.dup_fd_map:
+                stateIdx = self.dup_fd_map[fd]
+                rnext = self.dups[stateIdx]
+                if rnext.want_handle and not isinstance(rnext, libmu.machine_state.TerminalState):
+                    self._set_dup(stateIdx, rnext.do_handle())
+
+    # read or write whatever lives on fd: a worker, a duplicate, or a spare
+    def _do_io(self, fd, method):
+        stateIdx = self.state_fd_map.get(fd)
+        if stateIdx is not None:
+            self._set_state(stateIdx, getattr(self.states[stateIdx], method)())
+
+        elif fd in self.dup_fd_map:
+            stateIdx = self.dup_fd_map[fd]
+            self._set_dup(stateIdx, getattr(self.dups[stateIdx], method)())
+
+        elif fd in self.spares:
+            try:
+                getattr(self.spares[fd], method)()
+            except:
+                self._retire(self.spares.pop(fd), False)
+
+    ###
+    #  close all workers and collect
+    #  (arrival number, actor number, timestamp log, error or None) for each one
+    ###
+    def finish(self):
+        start_time = getattr(self.server_info, 'start_time', self.start_time)
+
+        # if we streamed a timeline, the transitions are on disk rather than in the states
+        tl_actors = None
+        if self.timeline is not None:
+            self.timeline.close()
+            if self.server_info.out_file is not None:
+                tl_actors = libmu.timeline.load_timeline(self.timeline.filename)
+
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+        self._end_speculation()
+
+        results = []
+        for (state, num) in zip(self.states, self.arrivals):
+            state.close()
+            errval = None
+            if isinstance(state, libmu.machine_state.ErrorState) or not isinstance(state, libmu.machine_state.TerminalState):
+                errval = repr(state)
+
+            if tl_actors is not None:
+                tslog = tl_actors.get(state.actorNum, [])
+            else:
+                timestamps = [ ts - start_time for ts in state.timestamps ]
+                tslog = zip(timestamps, state.stateinfo)
+            results.append((num, state.actorNum, str(tslog), errval))
+
+        return results
+
+    def show_status(self):
+        self.last_status = time.time()
+        if self.timeline is not None:
+            self.timeline.flush()
+
+        if self.shard_id not in (None, 0) and not self.headless:
+            # only the first shard talks to the terminal
+            return
+
+        actStates = self.engine.num_active() - len(self.spares) - len(self.dups)
+        errStates = self.nerror
+        doneStates = self.ndone
+        waitStates = self.server_info.num_parts - _num_arrived(self.states, self.server_info)
+        runTime = str(datetime.timedelta(seconds=self.last_status - self.start_time))
+
+        if self.shard_id is None:
+            shardStr = ""
+        elif self.headless:
+            shardStr = " (shard %d of %d)" % (self.shard_id, self.server_info.num_shards)
+        else:
+            shardStr = " (shard 0 of %d)" % self.server_info.num_shards
+        statStr = "SERVER status%s (%s): active=%d, done=%d, prelaunch=%d, error=%d" % (shardStr, runTime, actStates, doneStates, waitStates, errStates)
+        if self.speculate_pct is not None:
+            statStr += ", spare=%d, speculating=%d" % (len(self.spares), len(self.dups))
+
+        # headless: just the summary, one line per refresh, for log collection
+        if self.headless:
+            sys.stdout.write(statStr + "\n")
+            sys.stdout.flush()
+            return
 
         # enhanced output in debugging mode
         #if errStates == 0 and not libmu.defs.Defs.debug:
         #    # make output pretty as long as there aren't errors
         #    sys.stdout.write("\033[3J\033[H\033[2J")
         #    sys.stdout.flush()
+
+        # only re-render cells whose states changed since last time
+        if libmu.defs.Defs.fun:
+            self.dirty.update(range(0, len(self.states)))
+        for idx in self.dirty:
+            self.cells[idx] = self._render_cell(self.states[idx])
+        self.dirty.clear()
+
+        outstr = ['\n']
         n_printed = 0
-        outstr = '\n'
-        for s in states:
-            s_str = str(s)
-            lsstr = len(s_str)
-            s_str = s_str[:n_chars]
-            if isinstance(s, libmu.machine_state.ErrorState):
-                s_str = "\033[1;31m" + s_str + "\033[0m"
-            elif libmu.defs.Defs.fun:
-                s_str = libmu.util.rand_green(s_str)
-            outstr += s_str
-            outstr += ' ' * (n_chars - min(lsstr, n_chars))
+        for cell in self.cells:
+            outstr.append(cell)
             n_printed += 1
-            if n_printed == n_across:
-                outstr += '\n'
+            if n_printed == self.n_across:
+                outstr.append('\n')
                 n_printed = 0
             else:
-                outstr += ' '
+                outstr.append(' ')
         if n_printed != 0:
-            outstr += '\n'
-        sys.stdout.write(outstr + "SERVER status (%s): active=%d, done=%d, prelaunch=%d, error=%d" % (runTime, actStates, doneStates, waitStates, errStates))
+            outstr.append('\n')
+        outstr.append(statStr)
+        sys.stdout.write(''.join(outstr))
         sys.stdout.flush()
 
-    while True:
-        dflags = rwsplit(states, rwflags)
+    def metrics_snapshot(self):
+        actors = { 'active': self.engine.num_active() - len(self.spares) - len(self.dups)
+                 , 'done': self.ndone
+                 , 'error': self.nerror
+                 , 'prelaunch': self.server_info.num_parts - _num_arrived(self.states, self.server_info)
+                 }
+        extra = {'actors': actors, 'shard': self.shard_id}
+        if self.speculate_pct is not None:
+            extra['speculation'] = { 'spares': len(self.spares)
+                                   , 'running': len(self.dups)
+                                   , 'started': self.nspeculated
+                                   , 'won': self.ndupwins
+                                   }
+        return self.metrics.snapshot(self.states, extra)
+
+    def _render_cell(self, s):
+        n_chars = self.n_chars
+        s_str = str(s)
+        lsstr = len(s_str)
+        s_str = s_str[:n_chars]
+        if isinstance(s, libmu.machine_state.ErrorState):
+            s_str = "\033[1;31m" + s_str + "\033[0m"
+        elif libmu.defs.Defs.fun:
+            s_str = libmu.util.rand_green(s_str)
+
+        return s_str + ' ' * (n_chars - min(lsstr, n_chars))
+
+    def _count_state(self, st, incr):
+        if isinstance(st, libmu.machine_state.ErrorState):
+            self.nerror += incr
+        elif isinstance(st, libmu.machine_state.TerminalState):
+            self.ndone += incr
+
+    ###
+    #  internals
+    ###
+    def _accept(self):
+        (ns, _) = self.lsock.accept()
+        ns.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        ns.setblocking(False)
+        self.add_connection(ns)
+        if self.speculate_pct is None:
+            self.lsock = _close_if_all_arrived(self.lsock, self.states, self.server_info)
+
+    def _set_state(self, stateIdx, st):
+        prev = self.states[stateIdx]
+        self.states[stateIdx] = st
+        self.engine.update(st)
+        self.dirty.add(stateIdx)
+
+        if st is not prev:
+            self._count_state(prev, -1)
+            self._count_state(st, 1)
+
+            if self.metrics is not None:
+                now = time.time()
+                self.metrics.record_state_time(prev.__class__.__name__, now - self.entered[stateIdx])
+                self.entered[stateIdx] = now
+
+            # per-state deadline: disarm the old state's, arm the new one's
+            self.timers.cancel(prev.timer)
+            if st.timeout is not None and not isinstance(st, libmu.machine_state.TerminalState):
+                st.timer = self.timers.arm(st.timeout, self._state_timed_out, stateIdx, st)
+
+            # race against a duplicate: if we failed, it carries on; otherwise, we won
+            if stateIdx in self.dups and isinstance(st, libmu.machine_state.TerminalState):
+                if isinstance(st, libmu.machine_state.ErrorState):
+                    self._promote_dup(stateIdx)
+                else:
+                    self._drop_dup(stateIdx)
+
+    def _kill_actor(self, stateIdx, msg):
+        if stateIdx in self.dups:
+            self._drop_dup(stateIdx)
+
+        st = self.states[stateIdx]
+        if not isinstance(st, libmu.machine_state.TerminalState):
+            self._set_state(stateIdx, self.server_info.kill_state(st, msg))
+
+    def _state_timed_out(self, stateIdx, st):
+        if self.states[stateIdx] is st:
+            # NOTE a duplicate, if any, gets to carry on (see _set_state)
+            self._set_state(stateIdx, self.server_info.kill_state(st, "timed out after %s seconds in %s" % (str(st.timeout), st.__class__.__name__)))
+
+    def _start_timers(self, stateIdx):
+        st = self.states[stateIdx]
+        kill_time = getattr(self.server_info, 'kill_time', None)
+        if kill_time is not None:
+            self.timers.arm_at(st.timestamps[0] + kill_time, self._kill_actor, stateIdx, "terminated after %d seconds" % kill_time)
+
+        if st.timeout is not None:
+            st.timer = self.timers.arm(st.timeout, self._state_timed_out, stateIdx, st)
+
+    ###
+    #  speculative re-execution
+    ###
+    def _all_finished(self):
+        return _num_arrived(self.states, self.server_info) >= self.server_info.num_parts and self.ndone + self.nerror == len(self.states)
+
+    def _park_spare(self, ns):
+        spare = libmu.socket_nb.SocketNB(ns)
+        self.engine.register(spare)
+        spare.do_handshake()
+        self.spares[spare.fileno()] = spare
+
+    # stop tracking a connection and (if it's still up) tell its worker to quit
+    def _retire(self, st, send_quit=True):
+        self.engine.discard(st)
+        st.engine = None
+        if send_quit and st.sock is not None:
+            try:
+                st.enqueue("quit:")
+                # (SocketNB's do_write, since MachineState's would swallow errors)
+                libmu.socket_nb.SocketNB.do_write(st)
+            except:
+                pass
+        st.close()
+
+    def _spare_or_dup_closed(self, st):
+        # NOTE every state in a chain shares one recv_queue, so that's how we recognize st
+        fd = st.fileno()
+        spare = self.spares.get(fd)
+        if spare is not None and spare.recv_queue is st.recv_queue:
+            del self.spares[fd]
+            return True
 
-        if all([ v == 0 for v in rwflags ]) and lsock is None:
-            break
+        stateIdx = self.dup_fd_map.get(fd)
+        if stateIdx is not None and self.dups[stateIdx].recv_queue is st.recv_queue:
+            self._drop_dup(stateIdx)
+            return True
 
-        for idx in dflags:
-            if rwflags[idx] != 0:
-                poll_obj.register(states[idx], rwflags[idx])
-            else:
-                try:
-                    poll_obj.unregister(states[idx])
-                except:
-                    pass
+        return False
 
-        if lsock is None and lsock_fd is not None:
-            poll_obj.unregister(lsock_fd)
-            lsock_fd = None
+    def _check_stragglers(self):
+        if self.speculate_pct is None:
+            return
+        self.timers.arm(1, self._check_stragglers)
 
         now = time.time()
-        if getattr(server_info, 'kill_time', None) is not None:
-            for killId in reversed([ stId for stId in range(0, len(states)) if not isinstance(states[stId], libmu.machine_state.TerminalState) and now - states[stId].timestamps[0] > server_info.kill_time ]):
-                states[killId] = server_info.kill_state(states[killId], "terminated after %d seconds" % server_info.kill_time)
+        for (stateIdx, st) in enumerate(self.states):
+            if len(self.spares) == 0:
+                break
+
+            if stateIdx in self.dups or isinstance(st, libmu.machine_state.TerminalState):
+                continue
+
+            hist = self.metrics.state_time.get(st.__class__.__name__)
+            if hist is None or hist.count < self.speculate_min_samples:
+                continue
+
+            if now - self.entered[stateIdx] > self.speculate_factor * hist.percentile(self.speculate_pct):
+                self._speculate(stateIdx)
+
+    # start over on a spare worker, running alongside the original
+    def _speculate(self, stateIdx):
+        (fd, spare) = self.spares.popitem()
+        st = self.states[stateIdx]
+        if self.timeline is not None:
+            spare.timeline = self.timeline
+        # its timeline records carry the original's actor number, so mark them
+        spare.speculative = True
+
+        dup = self.constructor(spare, *self.ctor_args.get(stateIdx, (st.actorNum,)))
+        self.engine.register(dup)
+        self.dups[stateIdx] = dup
+        self.dup_fd_map[fd] = stateIdx
+        self.nspeculated += 1
+
+    def _set_dup(self, stateIdx, st):
+        self.dups[stateIdx] = st
+        self.engine.update(st)
+
+        if isinstance(st, libmu.machine_state.ErrorState):
+            # the duplicate failed; the original carries on
+            self._drop_dup(stateIdx, False)
+        elif isinstance(st, libmu.machine_state.TerminalState):
+            # the duplicate won; the original gets told to quit
+            self.ndupwins += 1
+            self._promote_dup(stateIdx)
+
+    def _drop_dup(self, stateIdx, send_quit=True):
+        dup = self.dups.pop(stateIdx)
+        del self.dup_fd_map[dup.fileno()]
+        self._retire(dup, send_quit)
+
+    def _promote_dup(self, stateIdx):
+        dup = self.dups.pop(stateIdx)
+        del self.dup_fd_map[dup.fileno()]
+
+        prev = self.states[stateIdx]
+        self.state_fd_map.pop(prev.fileno(), None)
+        self._retire(prev, not isinstance(prev, libmu.machine_state.TerminalState))
+
+        self.state_fd_map[dup.fileno()] = stateIdx
+        self._set_state(stateIdx, dup)
+
+    def _end_speculation(self):
+        if self.lsock is not None:
+            try:
+                self.lsock.shutdown()
+                self.lsock.close()
+            except:
+                pass
+            self.lsock = None
 
-        if npasses_out == 100:
-            npasses_out = 0
-            show_status()
+        for stateIdx in list(self.dups.keys()):
+            self._drop_dup(stateIdx)
 
-        pfds = poll_obj.poll(2000)
-        npasses_out += 1
+        for spare in self.spares.values():
+            self._retire(spare)
+        self.spares.clear()
 
-        if len(pfds) == 0:
-            show_status()
-            continue
+###
+#  server mainloop
+###
+def server_main_loop(states, constructor, server_info):
+    server_info.start_time = time.time()
 
-        # look for readable FDs
-        for (fd, ev) in pfds:
-            if (ev & select.POLLIN) != 0:
-                if lsock is not None and fd == lsock_fd:
-                    lsock = _handle_server_sock(lsock, states, state_fd_map, state_actNum_map, server_info, constructor)
+    if getattr(server_info, 'num_shards', 1) > 1:
+        results = _sharded_main_loop(states, constructor, server_info)
+    else:
+        results = Coordinator(states, constructor, server_info).run()
 
-                else:
-                    stateIdx = state_fd_map[fd]
-                    r = states[stateIdx]
-                    rnext = r.do_read()
-                    states[stateIdx] = rnext
+    _write_results(results, server_info)
 
-        for (fd, ev) in pfds:
-            if (ev & select.POLLOUT) != 0:
-                stateIdx = state_fd_map[fd]
-                w = states[stateIdx]
-                wnext = w.do_write()
-                states[stateIdx] = wnext
+###
+#  sharded mainloop: num_shards processes share the listen port via SO_REUSEPORT
+#  Each shard owns the workers it accepts; a shared counter hands out actor numbers,
+#  and each shard sends its results back to us over a pipe when it's done.
+###
+def _sharded_main_loop(states, constructor, server_info):
+    server_info.actor_counter = multiprocessing.Value('i', 0)
+
+    shards = []
+    for shard_id in range(0, server_info.num_shards):
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            for (_, rf) in shards:
+                rf.close()
+
+            server_info.shard_id = shard_id
+            retval = 0
+            try:
+                shard_result = (Coordinator(states, constructor, server_info).run(), None)
+            except:
+                shard_result = ([], "shard %d: %s" % (shard_id, traceback.format_exc()))
+                retval = 1
+
+            with os.fdopen(w, 'w') as wf:
+                cPickle.dump(shard_result, wf, cPickle.HIGHEST_PROTOCOL)
+            os._exit(retval)
+
+        os.close(w)
+        shards.append((pid, os.fdopen(r, 'r')))
 
-        for rnext in [ st for st in states if not isinstance(st, libmu.machine_state.TerminalState) ]:
-            if rnext.want_handle:
-                rnext = rnext.do_handle()
-            stateIdx = state_actNum_map[rnext.actorNum]
-            states[stateIdx] = rnext
+    results = []
+    failures = []
+    for (shard_id, (pid, rf)) in zip(range(0, len(shards)), shards):
+        try:
+            (shard_results, failure) = cPickle.load(rf)
+        except:
+            (shard_results, failure) = ([], "shard %d: exited without reporting results" % shard_id)
+        rf.close()
+        os.waitpid(pid, 0)
+
+        results += shard_results
+        if failure is not None:
+            failures.append(failure)
 
+    if failures:
+        _write_results(results, server_info, failures)
+
+    return results
+
+###
+#  write out_file and report errors, given results from one or more mainloops
+###
+def _write_results(results, server_info, failures=None):
     fo = None
     error = []
     errvals = []
     if server_info.out_file is not None:
         fo = open(server_info.out_file, 'w')
 
-    for (state, num) in zip(states, range(0, len(states))):
-        state.close()
-        if isinstance(state, libmu.machine_state.ErrorState) or not isinstance(state, libmu.machine_state.TerminalState):
+    for (num, actorNum, tslog, errval) in sorted(results):
+        if errval is not None:
             error.append(num)
-            errvals.append(repr(state))
+            errvals.append(errval)
 
         if fo is not None:
-            timestamps = [ ts - server_info.start_time for ts in state.timestamps ]
-            tslog = zip(timestamps, state.stateinfo)
-            fo.write("%d:%s\n" % (state.actorNum, str(tslog)))
-
-    if server_info.profiling:
-        pr.disable()
-        pr.dump_stats(server_info.profiling)
+            fo.write("%d:%s\n" % (actorNum, tslog))
 
-    if error:
-        evals = str(error) + "\n  " + "\n  ".join(errvals)
+    if error or failures:
+        evals = str(error) + "\n  " + "\n  ".join(errvals + (failures or []))
         if fo is not None:
             fo.write("ERR:%s\n" % str(error))
             fo.close() # we'll never get to the close below
@@ -322,7 +827,8 @@ def usage_str(defaults):
     if hasattr(defaults, 'out_file'):
         oFileStr = "'%s'" % defaults.out_file if defaults.out_file is not None else "None"
         uStr += "  -O oFile:      state machine times output file                 (%s)\n" % oFileStr
-        oStr += "O:"
+        uStr += "  -J tlFile:     stream state transitions (JSONL) to tlFile      (None)\n"
+        oStr += "O:J:"
 
     if hasattr(defaults, 'profiling'):
         pFileStr = "'%s'" % defaults.profiling if defaults.profiling is not None else "None"
@@ -334,7 +840,8 @@ def usage_str(defaults):
 
     if hasattr(defaults, 'overprovision'):
         uStr += "  -X nExtra:     overprovision lambda invocations by nExtra      (%d)\n" % defaults.overprovision
-        oStr += "X:"
+        uStr += "  -Z pct:        duplicate stragglers past pct'th pctile         (None)\n"
+        oStr += "X:Z:"
 
     if hasattr(defaults, 'num_list'):
         uStr += "  -N a,b,c,...   run clients numbered exactly a, b, c, ...       (None)\n"
@@ -399,6 +906,17 @@ def usage_str(defaults):
     uStr += "\n  -t portNum:    listen on portNum                               (%d)\n" % defaults.port_number
     oStr += "t:"
 
+    uStr += "  -j nShards:    run nShards coordinator processes on portNum    (%d)\n" % getattr(defaults, 'num_shards', 1)
+    oStr += "j:"
+
+    uStr += "  -e interval:   refresh status at most every interval seconds   (%s)\n" % str(getattr(defaults, 'status_interval', 1.0))
+    uStr += "  -L:            headless: one-line status, for log collection   (disabled)\n"
+    uStr += "  -W mAddr:      serve live metrics on local port or UNIX path   (None)\n"
+    uStr += "  -A:            ASCII framing only (no binary frames)           (negotiate)\n"
+    uStr += "  -Q nBytes:     pause readers at nBytes queued to send          (None)\n"
+    uStr += "  -G nMsgs:      stop reading at nMsgs received, unhandled       (None)\n"
+    oStr += "e:LW:AQ:G:"
+
     if hasattr(defaults, 'state_srv_addr'):
         uStr += "  -H stHostAddr: hostname or IP for nat punching host            (%s)\n" % defaults.state_srv_addr
         oStr += "H:"
@@ -411,6 +929,10 @@ def usage_str(defaults):
         uStr += "  -R nThreads:   state server runs nThreads on sequential ports  (%d)\n" % defaults.state_srv_threads
         oStr += "R:"
 
+    if hasattr(defaults, 'raw_state'):
+        uStr += "  -F:            raw state transfers (plain TCP only)            (%s)\n" % str(defaults.raw_state)
+        oStr += "F"
+
     if hasattr(defaults, 'lambda_function'):
         uStr += "  -l fnName:     lambda function name                            ('%s')\n" % defaults.lambda_function
         oStr += "l:"
@@ -497,6 +1019,8 @@ def options(server_info):
             sys.exit(1)
         elif opt == "-O":
             server_info.out_file = arg
+        elif opt == "-J":
+            server_info.timeline_file = arg
         elif opt == "-P":
             server_info.profiling = arg
         elif opt == "-p":
@@ -526,6 +1050,22 @@ def options(server_info):
             assert len(server_info.num_list) > 0
         elif opt == "-t":
             server_info.port_number = int(arg)
+        elif opt == "-j":
+            server_info.num_shards = int(arg)
+        elif opt == "-e":
+            server_info.status_interval = float(arg)
+        elif opt == "-L":
+            server_info.headless = True
+        elif opt == "-Z":
+            server_info.speculate_pct = float(arg)
+        elif opt == "-W":
+            server_info.metrics_addr = arg
+        elif opt == "-A":
+            libmu.socket_nb.SocketNB.binary_framing = False
+        elif opt == "-Q":
+            libmu.socket_nb.SocketNB.send_high_water = int(arg)
+        elif opt == "-G":
+            libmu.socket_nb.SocketNB.recv_high_water = int(arg)
         elif opt == "-h":
             server_info.host_addr = arg
         elif opt == "-q":
@@ -540,6 +1080,8 @@ def options(server_info):
             server_info.state_srv_port = int(arg)
         elif opt == "-R":
             server_info.state_srv_threads = int(arg)
+        elif opt == "-F":
+            server_info.raw_state = True
         elif opt == "-x":
             server_info.run_xcenc = True
         elif opt == "-u":
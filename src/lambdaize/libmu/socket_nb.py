@@ -1,41 +1,133 @@
 #!/usr/bin/python
 
 import collections
+import select
 import socket
+import time
 import traceback
 
 from OpenSSL import SSL
 
+from libmu.compression import AdaptiveCompressor
 from libmu.defs import Defs
+from libmu.rawxfer import RawSender, raw_out_types, parse_begin as parse_raw_begin
+from libmu.stream import StreamSender
 
 # wrapper around socket-like objects to handle
 # non-blocking reading and writing in correct format
 # This class also works for non-blocking SSL sockets!
 class SocketNB(object):
+    # whether an event loop should poll this socket for reading
+    want_read = True
+    # how much we ask the socket for at a time
+    recv_chunk = 16384
+    # if True, messages of at least view_threshold bytes are queued as
+    # memoryviews rather than copied into strings (see _frame_messages)
+    recv_views = False
+    view_threshold = 65536
+    # small messages are coalesced into sends of at most this many bytes;
+    # bigger payloads are sent in place (see _fill_send_buf)
+    send_chunk = 65536
+    # if True, we switch to binary frames once the other side shows that it
+    # understands them (see _frame_messages); receiving either kind always works
+    binary_framing = True
+    # with binary frames, compress messages at least this big (None: never)
+    # if the other side can take it (see libmu.compression)
+    compress_threshold = 16384
+    # flow control (None: unlimited). Once send_high_water bytes are waiting to
+    # go out, send_full stays True until they drain to send_low_water (default:
+    # half the high mark); whoever feeds this socket should pause meanwhile (see
+    # throttle). Likewise, we stop reading while recv_queue holds recv_high_water
+    # messages, until it's down to recv_low_water. Messages the handler put
+    # back because it couldn't take them yet (recv_held, at the front of
+    # recv_queue) don't count: otherwise they could stop the reads that would
+    # let them through.
+    send_high_water = None
+    send_low_water = None
+    recv_high_water = None
+    recv_low_water = None
+    # if True, a full send queue also stops us reading: for request/response
+    # peers, whatever we read is what fills the queue
+    throttle_when_full = False
+
     def __init__(self, sock):
         if isinstance(sock, SocketNB):
             self.sock = sock.sock
             self.want_write = sock.want_write
             self.want_handle = sock.want_handle
             self.expectlen = sock.expectlen
+            self.expecttype = sock.expecttype
+            self.expectflags = sock.expectflags
             self.recv_queue = sock.recv_queue
+            self.info_queue = sock.info_queue
             self.send_queue = sock.send_queue
+            self.streams = sock.streams
+            self.raw_left = sock.raw_left
+            self.raw_sink = sock.raw_sink
+            self.binary_framing = sock.binary_framing
+            self.send_binary = sock.send_binary
+            self.peer_caps = sock.peer_caps
+            self.peer_compress = sock.peer_compress
+            self.compressor = sock.compressor
+            self.link_mark = sock.link_mark
             self.recv_buf = sock.recv_buf
+            self.recv_off = sock.recv_off
+            self.recv_end = sock.recv_end
             self.send_buf = sock.send_buf
+            self.send_bytes = sock.send_bytes
+            self.send_full = sock.send_full
+            self.recv_full = sock.recv_full
+            self.recv_held = sock.recv_held
+            self.throttled = sock.throttled
             self.ssl_write = sock.ssl_write
             self.handshaking = sock.handshaking
+            self.engine = sock.engine
+            self.bytes_in = sock.bytes_in
+            self.bytes_out = sock.bytes_out
+            self.msgs_in = sock.msgs_in
+            self.msgs_out = sock.msgs_out
 
         else:
             self.sock = sock
             self.want_write = False
             self.want_handle = False
             self.expectlen = None
+            self.expecttype = None
+            self.expectflags = 0
             self.recv_queue = collections.deque()
+            # typed INFO frames skip recv_queue (see MachineState.do_handle)
+            self.info_queue = collections.deque()
             self.send_queue = collections.deque()
-            self.recv_buf = ""
+            # StreamSenders (and RawSenders) waiting to go out, in order
+            self.streams = collections.deque()
+            # after a RAW_BEGIN we stop framing messages until raw_sink has
+            # taken the raw_left bytes that follow it (see libmu.rawxfer)
+            self.raw_left = None
+            self.raw_sink = None
+            self.send_binary = False
+            # what the other side told us it understands (see _got_caps)
+            self.peer_caps = frozenset()
+            self.peer_compress = False
+            self.compressor = AdaptiveCompressor()
+            self.link_mark = None
+            # received data lives in recv_buf[recv_off:recv_end]
+            self.recv_buf = bytearray(self.recv_chunk)
+            self.recv_off = 0
+            self.recv_end = 0
             self.send_buf = None
+            # bytes in send_queue and send_buf (raw transfers don't count: they aren't in memory)
+            self.send_bytes = 0
+            self.send_full = False
+            self.recv_full = False
+            self.recv_held = 0
+            self.throttled = False
             self.ssl_write = None
             self.handshaking = False
+            self.engine = None
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.msgs_in = 0
+            self.msgs_out = 0
 
         self._fileno = sock.fileno()
 
@@ -59,6 +151,9 @@ class SocketNB(object):
         if Defs.debug:
             print "CLOSING SOCKET %s" % traceback.format_exc()
 
+        if self.engine is not None:
+            self.engine.discard(self, True)
+
         try:
             if isinstance(self.sock, SSL.Connection):
                 self.sock.shutdown()
@@ -70,16 +165,75 @@ class SocketNB(object):
 
         self.sock = None
 
+    # parse the frame header at recv_buf[off:end]
+    # returns (header length, message length, frame type, flags), or None if incomplete
+    # ASCII headers have no type (None) and no flags
+    def _parse_header(self, off, end):
+        buf = self.recv_buf
+        if end - off < 1:
+            return None
+
+        if buf[off] == Defs.bin_magic:
+            hlen = Defs.bin_header.size
+            if end - off < hlen:
+                return None
+            (_, ftype, flags, mlen) = Defs.bin_header.unpack_from(buf, off)
+            return (hlen, mlen, ftype, flags)
+
+        hlen = Defs.header_len
+        if end - off < hlen:
+            return None
+        # NOTE exception will bubble out to calling function!
+        return (hlen, int(str(buf[off:off + hlen])), None, 0)
+
+    # how many more bytes we'd like room for at the end of recv_buf
+    def _recv_want(self):
+        have = self.recv_end - self.recv_off
+        need = 0
+        if self.expectlen is not None:
+            need = self.expectlen - have
+        else:
+            # peek at the header so that a big message gets its space all at once
+            try:
+                hdr = self._parse_header(self.recv_off, self.recv_end)
+            except ValueError:
+                # do_read will complain about this
+                hdr = None
+            if hdr is not None:
+                need = hdr[0] + hdr[1] - have
+
+        return max(need, self.recv_chunk)
+
+    def _recv_room(self):
+        want = self._recv_want()
+        if len(self.recv_buf) - self.recv_end >= want:
+            return
+
+        # copy the live data to the front of a new buffer (never resize the old one:
+        # there might be memoryviews into it), growing geometrically
+        have = self.recv_end - self.recv_off
+        nbuf = bytearray(max(have + want, 2 * have))
+        nbuf[0:have] = memoryview(self.recv_buf)[self.recv_off:self.recv_end]
+        self.recv_buf = nbuf
+        self.recv_off = 0
+        self.recv_end = have
+
     def _fill_recv_buf(self):
         self.ssl_write = None
-        start_len = len(self.recv_buf)
+        start_len = self.recv_end - self.recv_off
         while True:
+            self._recv_room()
+            nbytes = len(self.recv_buf) - self.recv_end
+            if isinstance(self.sock, SSL.Connection):
+                # pyOpenSSL allocates (and zeroes) a temporary buffer this big; one record is plenty
+                nbytes = min(nbytes, self.recv_chunk)
             try:
-                nbuf = self.sock.recv(16384)
-                if len(nbuf) == 0:
+                nread = self.sock.recv_into(memoryview(self.recv_buf)[self.recv_end:], nbytes)
+                if nread == 0:
                     break
                 else:
-                    self.recv_buf += nbuf
+                    self.recv_end += nread
+                    self.bytes_in += nread
             except SSL.WantReadError:
                 start_len = -1
                 break
@@ -89,9 +243,103 @@ class SocketNB(object):
             except:
                 break
 
-        if len(self.recv_buf) == start_len:
+        if self.recv_end - self.recv_off == start_len:
             self.close()
 
+    # pull complete messages out of recv_buf
+    def _frame_messages(self):
+        buf = self.recv_buf
+        view = memoryview(buf)
+        off = self.recv_off
+        end = self.recv_end
+        big = self.view_threshold if self.recv_views else None
+        while True:
+            if self.expectlen is None:
+                hdr = self._parse_header(off, end)
+                if hdr is None:
+                    break
+
+                (hlen, self.expectlen, self.expecttype, self.expectflags) = hdr
+                if self.expectflags & ~Defs.fflag_compressed:
+                    raise ValueError("unsupported frame flags 0x%x" % self.expectflags)
+                if self.expecttype is not None and self.binary_framing:
+                    # they sent us a binary frame, so we can send them binary frames
+                    self.send_binary = True
+                off += hlen
+
+            # expectlen indicates how much we want, so get it
+            elif end - off >= self.expectlen:
+                mend = off + self.expectlen
+                ftype = self.expecttype
+                msg = None
+                if self.expectflags & Defs.fflag_compressed:
+                    msg = self.compressor.decompress(view[off:mend].tobytes())
+                    off = mend
+                elif big is not None and self.expectlen >= big and ftype != Defs.ftype_info:
+                    # hand out the message in place; whatever follows it moves to a new buffer
+                    self.recv_queue.append(view[off:mend])
+                    buf = bytearray(view[mend:end])
+                    view = memoryview(buf)
+                    end -= mend
+                    off = 0
+                    self.recv_buf = buf
+                else:
+                    # exactly one copy, straight out of the buffer
+                    msg = view[off:mend].tobytes()
+                    off = mend
+
+                if msg is None:
+                    pass
+                elif ftype == Defs.ftype_hello:
+                    self._got_caps(msg, False)
+                else:
+                    (self.info_queue if ftype == Defs.ftype_info else self.recv_queue).append(msg)
+                    if ftype is None and not self.send_binary and msg.startswith(Defs.hello_prefix):
+                        # their HELLO says what they understand
+                        self._got_caps(msg[len(Defs.hello_prefix):msg.find(')')], True)
+                    elif ftype != Defs.ftype_info and msg.startswith(Defs.raw_begin):
+                        self.raw_left = parse_raw_begin(msg)[0]
+
+                self.msgs_in += 1
+                self.expectlen = None
+                self.expecttype = None
+                self.expectflags = 0
+
+                if self.raw_left is not None:
+                    # what follows isn't ours to frame
+                    break
+
+            else:
+                break
+
+        # everything consumed: start over at the front of the buffer
+        if off == end:
+            off = end = 0
+        self.recv_off = off
+        self.recv_end = end
+
+    # the other side told us what it understands, either in its HELLO (then we
+    # reply with our own capabilities) or in an ftype_hello frame
+    def _got_caps(self, caps, reply):
+        self.peer_caps = frozenset(caps.split(','))
+        self.peer_compress = 'compress=zlib' in self.peer_caps
+        if self.binary_framing and 'framing=bin' in self.peer_caps and not self.send_binary:
+            self.send_binary = True
+            if reply:
+                self.enqueue(Defs.hello_caps, Defs.ftype_hello)
+
+    # the link drains at most this fast when it's backed up; the compressor wants to know
+    def _sample_link(self):
+        now = time.time()
+        if self.link_mark is not None:
+            (then, nbytes) = self.link_mark
+            self.compressor.observe_link(self.bytes_out - nbytes, now - then)
+
+        if self.send_buf is not None or len(self.send_queue) > 0:
+            self.link_mark = (now, self.bytes_out)
+        else:
+            self.link_mark = None
+
     def do_read(self):
         if self.sock is None:
             return
@@ -99,61 +347,175 @@ class SocketNB(object):
         if self.handshaking:
             return self.do_handshake()
 
-        self._fill_recv_buf()
-        if len(self.recv_buf) == 0:
+        if self.throttled or self.recv_full:
+            # leave it in the kernel's buffers; the sender will feel it
             return
 
-        while True:
-            if self.expectlen is None:
-                if len(self.recv_buf) >= Defs.header_len:
-                    # NOTE exception will bubble out to calling function!
-                    self.expectlen = int(self.recv_buf[0:Defs.header_len])
-                    self.recv_buf = self.recv_buf[Defs.header_len:]
-                else:
-                    break
+        if self.raw_left is not None:
+            # the bytes on the wire belong to a raw transfer
+            if self.raw_sink is not None:
+                self.raw_sink.pump(self)
+            self.update_flags()
+            return
 
-            # expectlen indicates how much we want, so get it
-            else:
-                if len(self.recv_buf) >= self.expectlen:
-                    self.recv_queue.append(self.recv_buf[:self.expectlen])
-                    self.recv_buf = self.recv_buf[self.expectlen:]
-                    self.expectlen = None
-                else:
-                    break
+        self._fill_recv_buf()
+        if self.recv_end > self.recv_off:
+            self._frame_messages()
 
         self.update_flags()
 
+    # hysteresis: full at high water, not full again until low water
+    @staticmethod
+    def _water_level(full, level, high, low):
+        if high is None:
+            return False
+        if low is None:
+            low = high // 2
+        return level > low if full else level >= high
+
     def update_flags(self):
+        self.send_full = self._water_level(self.send_full, self.send_bytes, self.send_high_water, self.send_low_water)
+        self.recv_full = self._water_level(self.recv_full, len(self.recv_queue) - self.recv_held, self.recv_high_water, self.recv_low_water)
+        if self.throttle_when_full:
+            self.throttled = self.send_full
+
         self.want_handle = len(self.recv_queue) > 0
-        self.want_write = len(self.send_queue) > 0 or self.send_buf is not None
+        self.want_write = self.send_buf is not None or len(self.streams) > 0 or \
+                          (len(self.send_queue) > 0 and (not isinstance(self.send_queue[0], raw_out_types) or self.send_queue[0].ready()))
 
-    def enqueue(self, msg):
-        self.send_queue.append(self.format_message(msg))
+        if self.engine is not None:
+            self.engine.update(self)
+
+    def poll_flags(self):
+        if self.sock is None:
+            return 0
+
+        reading = self.raw_left is None or (self.raw_sink is not None and self.raw_sink.reading())
+        reading = reading and not self.throttled and not self.recv_full
+        val = select.POLLIN if self.want_read and reading else 0
+        if self.ssl_write or self.want_write:
+            val = val | select.POLLOUT
+
+        return val
+
+    # ftype is one of the Defs.ftype_* values; it only makes it onto the wire with binary frames
+    def enqueue(self, msg, ftype=Defs.ftype_command):
+        # header and payload are queued separately so that msg is never copied here
+        if self.send_binary:
+            flags = 0
+            if self.peer_compress and self.compress_threshold is not None and len(msg) >= self.compress_threshold \
+                    and ftype != Defs.ftype_chunk and isinstance(msg, str):
+                zmsg = self.compressor.compress(msg)
+                if zmsg is not None:
+                    msg = zmsg
+                    flags = Defs.fflag_compressed
+            header = Defs.bin_header.pack(Defs.bin_magic, ftype, flags, len(msg))
+        else:
+            header = Defs.header_fmt % (len(msg), '')
+        self.send_queue.append(header)
+        if len(msg) > 0:
+            self.send_queue.append(msg)
+        self.send_bytes += len(header) + len(msg)
+        self.msgs_out += 1
         self.update_flags()
 
     @staticmethod
     def format_message(msg):
         return Defs.header_fmt % (len(msg), msg)
 
+    # send a file (or an iterator of strings) as a stream of chunks (see libmu.stream)
+    # chunks are only read from source as the socket drains, so memory use stays bounded
+    def send_stream(self, header, source, compress=True):
+        self.streams.append(StreamSender(header, source, compress))
+        self.update_flags()
+
+    # send a file raw (see libmu.rawxfer): the kernel copies it from the file to the socket.
+    # With TLS that's impossible, so on an SSL socket this is just send_stream.
+    def send_file(self, header, fobj):
+        if isinstance(self.sock, SSL.Connection):
+            return self.send_stream(header, fobj)
+
+        self.streams.append(RawSender(header, fobj))
+        self.update_flags()
+
+    # pause (or resume) reading, e.g., because the socket we forward to is full
+    # (the event loop stops polling for POLLIN; see poll_flags)
+    def throttle(self, paused):
+        if paused != self.throttled:
+            self.throttled = paused
+            self.update_flags()
+
+    # after dequeueing a RAW_BEGIN: sink (a RawReceiver or RawRelay) takes the raw bytes
+    def recv_raw(self, sink):
+        self.raw_sink = sink
+        sink.pump(self)
+        self.update_flags()
+
+    # hand out up to maxlen bytes of whatever is left in recv_buf (for a raw sink)
+    def take_buffered(self, maxlen):
+        nbytes = min(maxlen, self.recv_end - self.recv_off)
+        data = memoryview(self.recv_buf)[self.recv_off:self.recv_off + nbytes].tobytes()
+        self.recv_off += nbytes
+        if self.recv_off == self.recv_end:
+            self.recv_off = self.recv_end = 0
+        return data
+
+    # the raw sink has everything: back to messages
+    def raw_done(self):
+        self.raw_left = None
+        self.raw_sink = None
+        if self.recv_end > self.recv_off:
+            self._frame_messages()
+        self.update_flags()
+
+    # bytes enqueued but not yet sent
+    def send_pending(self):
+        return self.send_bytes
+
+    def _pump_streams(self):
+        while len(self.streams) > 0 and self.streams[0].pump(self):
+            self.streams.popleft()
+
     def dequeue(self):
         if len(self.recv_queue) == 0:
             return None
 
         ret = self.recv_queue.popleft()
+        if self.recv_held > 0:
+            self.recv_held -= 1
         self.update_flags()
         return ret
 
     def _fill_send_buf(self):
-        self.send_buf = '' if self.send_buf is None else self.send_buf
-        if self.ssl_write is True:
+        # a partially sent (or SSL-retried) buffer goes out before anything else
+        if self.send_buf is not None or self.ssl_write is True or len(self.send_queue) == 0 \
+                or isinstance(self.send_queue[0], raw_out_types):
             return
 
-        # if we have multiple messages enqueued, put them all in the buffer
-        while len(self.send_queue) > 0:
-            self.send_buf += self.send_queue.popleft()
+        # big payloads on plain sockets go out as memoryviews (slicing them is free).
+        # pyOpenSSL copies whatever it's handed, so SSL gets one record's worth at a time.
+        is_ssl = isinstance(self.sock, SSL.Connection)
+        limit = self.recv_chunk if is_ssl else self.send_chunk
+        first = self.send_queue[0]
+        if not is_ssl and len(first) >= limit:
+            self.send_queue.popleft()
+            self.send_buf = first if isinstance(first, memoryview) else memoryview(first)
+            return
 
-        if len(self.send_buf) == 0:
-            self.send_buf = None
+        # otherwise gather small buffers (and the front of the next big one) into one send
+        parts = []
+        size = 0
+        while len(self.send_queue) > 0 and size < limit and not isinstance(self.send_queue[0], raw_out_types):
+            buf = self.send_queue.popleft()
+            room = limit - size
+            if len(buf) > room:
+                view = buf if isinstance(buf, memoryview) else memoryview(buf)
+                self.send_queue.appendleft(view[room:])
+                buf = view[:room]
+            parts.append(buf.tobytes() if isinstance(buf, memoryview) else str(buf))
+            size += len(buf)
+
+        self.send_buf = parts[0] if len(parts) == 1 else ''.join(parts)
 
     def _send_raw(self):
         last_slen = None
@@ -165,16 +527,32 @@ class SocketNB(object):
             except (socket.error, OSError, SSL.ZeroReturnError, SSL.SysCallError, SSL.WantReadError):
                 break
             except SSL.WantWriteError:
+                # NOTE send_buf is left alone: SSL needs the very same buffer on retry
                 self.ssl_write = True
 
             if slen == 0 and last_slen == 0:
                 break
             last_slen = slen
+            self.bytes_out += slen
+            self.send_bytes -= slen
 
             self.send_buf = self.send_buf[slen:]
             if len(self.send_buf) < 1:
                 self.send_buf = None
+                # on to the next batch
+                self._fill_send_buf()
+                if self.send_buf is None:
+                    break
+
+    # a raw transfer at the front of send_queue writes to the socket itself
+    def _pump_raw_out(self):
+        while self.send_buf is None and len(self.send_queue) > 0 and isinstance(self.send_queue[0], raw_out_types):
+            if not self.send_queue[0].pump(self):
                 break
+            self.send_queue.popleft()
+            self._fill_send_buf()
+            if self.send_buf is not None:
+                self._send_raw()
 
     def do_write(self):
         if self.sock is None:
@@ -183,9 +561,14 @@ class SocketNB(object):
         if self.handshaking:
             return self.do_handshake()
 
+        self._pump_streams()
         self._fill_send_buf()
         if self.send_buf is not None:
             self._send_raw()
+        self._pump_raw_out()
+
+        if self.compressor.nout > 0:
+            self._sample_link()
 
         self.update_flags()
 
@@ -206,3 +589,6 @@ class SocketNB(object):
             self.close()
         else:
             self.handshaking = False
+
+        if self.engine is not None:
+            self.engine.update(self)
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import urlparse
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+###
+#  where retrieve: and upload: (and their _many versions) move objects
+#
+#  A backend has download(bucket, key, filename, settings) and
+#  upload(filename, bucket, key, settings), where settings is a
+#  TransferSettings (or None for the defaults). open_storage picks one:
+#
+#    "s3"                S3
+#    "http://host:port"  an S3-compatible endpoint, e.g., a local stand-in
+#    "file:///some/dir"  objects are files, at /some/dir/bucket/key
+###
+
+###
+#  per-job transfer tuning; None means the backend's default
+#
+#  For S3, objects bigger than part_size are fetched with that many bytes
+#  per ranged GET (and uploaded in parts that big), concurrency of them at
+#  once; use_threads=False does it all on one thread.
+###
+class TransferSettings(object):
+    def __init__(self, part_size=None, concurrency=None, use_threads=True):
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.use_threads = use_threads
+
+    # from the worker's vals (set: or seti:), or failing that, its event
+    @classmethod
+    def from_vals(cls, vals):
+        event = vals.get('event') or {}
+        def lookup(name):
+            val = vals.get(name)
+            if val is None:
+                val = event.get(name)
+            return None if val is None else int(val)
+
+        use_threads = lookup('s3_use_threads')
+        return cls(lookup('s3_part_size'), lookup('s3_max_concurrency'), use_threads is None or use_threads != 0)
+
+    def is_default(self):
+        return self.part_size is None and self.concurrency is None and self.use_threads
+
+class S3Storage(object):
+    def __init__(self, client=None, endpoint_url=None):
+        if client is None:
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+
+    @staticmethod
+    def _config(settings):
+        if settings is None or settings.is_default():
+            return {}
+
+        kwargs = {}
+        if settings.part_size is not None:
+            kwargs['multipart_threshold'] = settings.part_size
+            kwargs['multipart_chunksize'] = settings.part_size
+        if settings.concurrency is not None:
+            kwargs['max_concurrency'] = settings.concurrency
+        if not settings.use_threads:
+            kwargs['use_threads'] = False
+
+        return {'Config': TransferConfig(**kwargs)}
+
+    def download(self, bucket, key, filename, settings=None):
+        self.client.download_file(bucket, key, filename, **self._config(settings))
+
+    def upload(self, filename, bucket, key, settings=None):
+        self.client.upload_file(filename, bucket, key, **self._config(settings))
+
+class LocalStorage(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def download(self, bucket, key, filename, _=None):
+        shutil.copyfile(self._path(bucket, key), filename)
+
+    def upload(self, filename, bucket, key, _=None):
+        path = self._path(bucket, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        # NOTE copy and rename, so readers never see half an object
+        shutil.copyfile(filename, path + ".part")
+        os.rename(path + ".part", path)
+
+def open_storage(spec, client=None):
+    if spec is None or spec == "s3":
+        return S3Storage(client)
+
+    url = urlparse.urlparse(spec)
+    if url.scheme == "file":
+        return LocalStorage(url.path)
+    if url.scheme in ("http", "https"):
+        return S3Storage(endpoint_url=spec)
+
+    raise ValueError("unknown storage '%s'" % spec)
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import time
+import zlib
+
+from libmu.defs import Defs
+
+###
+#  streaming transfer of big payloads (e.g., state files) as a sequence of messages
+#
+#  STREAM_BEGIN(z):header    z if the data are zlib-compressed, else nothing
+#  STREAM_DATA:bytes         zero or more
+#  STREAM_END:bytes          last (possibly empty) piece
+#
+#  The markers travel inside the messages, so streams work with either framing
+#  and pass unchanged through the state relay.
+###
+
+# if msg begins a stream, return (header, compressed); otherwise None
+def parse_begin(msg):
+    if msg[:len(Defs.stream_begin)] != Defs.stream_begin:
+        return None
+
+    rind = msg.find('):')
+    if rind < 0:
+        raise ValueError("malformed stream header")
+
+    return (msg[rind + 2:], msg[len(Defs.stream_begin):rind] == 'z')
+
+###
+#  the sending half: SocketNB.send_stream makes one of these, and pump() is
+#  called from do_write to top up the send queue
+###
+class StreamSender(object):
+    # raw bytes read from the source at a time
+    chunk_size = 262144
+    # stop producing chunks while the socket has this many bytes waiting to go out
+    window = 1048576
+
+    # source is a file-like object (which we close when done) or an iterator of strings
+    # if compress is True, the level comes from the socket's AdaptiveCompressor
+    def __init__(self, header, source, compress=True):
+        self.header = header
+        self.source = source
+        self.compress = compress
+        self.compressor = None
+        self.started = False
+
+    def _read(self):
+        if hasattr(self.source, 'read'):
+            data = self.source.read(self.chunk_size)
+            return data if len(data) > 0 else None
+
+        return next(self.source, None)
+
+    # enqueue chunks on sock until its window is full; returns True once the stream is done
+    def pump(self, sock):
+        if not self.started:
+            self.started = True
+            # the level is fixed for the whole stream; what we learn here applies to the next one
+            level = sock.compressor.next_level() if self.compress else 0
+            if level > 0:
+                self.compressor = zlib.compressobj(level)
+            sock.enqueue("%s%s):%s" % (Defs.stream_begin, 'z' if self.compressor is not None else '', self.header), Defs.ftype_chunk)
+
+        while sock.send_pending() < self.window:
+            data = self._read()
+            if data is None:
+                tail = self.compressor.flush() if self.compressor is not None else ''
+                sock.enqueue(Defs.stream_end + tail, Defs.ftype_chunk)
+                if hasattr(self.source, 'close'):
+                    self.source.close()
+                return True
+
+            if self.compressor is not None:
+                start = time.time()
+                nraw = len(data)
+                data = self.compressor.compress(data)
+                sock.compressor.record(nraw, len(data), time.time() - start)
+            if len(data) > 0:
+                sock.enqueue(Defs.stream_data + data, Defs.ftype_chunk)
+
+        return False
+
+###
+#  the receiving half: feed() it every message after the STREAM_BEGIN
+###
+class StreamReceiver(object):
+    # most bytes we decompress at a time, so a small chunk can't blow up in memory
+    out_chunk = 1048576
+
+    # sink is anything with a write() method
+    def __init__(self, sink, compressed=True):
+        self.sink = sink
+        self.decompressor = zlib.decompressobj() if compressed else None
+        self.nbytes = 0
+
+    # returns True when the stream is complete
+    def feed(self, msg):
+        if msg[:len(Defs.stream_data)] == Defs.stream_data:
+            plen = len(Defs.stream_data)
+            done = False
+        elif msg[:len(Defs.stream_end)] == Defs.stream_end:
+            plen = len(Defs.stream_end)
+            done = True
+        else:
+            raise ValueError("expected stream data, got '%s'" % msg[:32])
+
+        # avoid copying the chunk just to drop the marker
+        data = buffer(msg, plen) if isinstance(msg, str) else msg[plen:].tobytes()
+        if self.decompressor is None:
+            self._write(data)
+        else:
+            out = self.decompressor.decompress(data, self.out_chunk)
+            while len(out) > 0:
+                self._write(out)
+                out = self.decompressor.decompress(self.decompressor.unconsumed_tail, self.out_chunk)
+            if done:
+                self._write(self.decompressor.flush())
+
+        return done
+
+    def _write(self, data):
+        if len(data) > 0:
+            self.sink.write(data)
+            self.nbytes += len(data)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+import json
+import os
+import time
+
+###
+#  streaming, append-only log of state transitions
+#
+#  The file is JSONL. The first line is a header, {"start": <time>}. The first
+#  time a state class shows up we write {"class": <id>, "name": <class name>}.
+#  After that each transition is one compact list:
+#      [actorNum, class id, timestamp, bytes in, bytes out]
+#  where the byte counts are cumulative for the actor's connection. A
+#  speculative duplicate (see Coordinator._speculate) runs as the same actor;
+#  its transitions get a sixth element, 1, so they don't mix with the original's.
+###
+class TimelineWriter(object):
+    def __init__(self, filename, start_time=None, batch_size=512):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.class_ids = {}
+        self.buf = []
+        self.fo = open(filename, 'w')
+
+        if start_time is None:
+            start_time = time.time()
+        self.buf.append(json.dumps({'start': start_time, 'pid': os.getpid()}))
+        self.flush()
+
+    def record(self, actor, state_name, ts, bytes_in=None, bytes_out=None, spec=False):
+        cid = self.class_ids.get(state_name)
+        if cid is None:
+            cid = len(self.class_ids)
+            self.class_ids[state_name] = cid
+            self.buf.append(json.dumps({'class': cid, 'name': state_name}))
+
+        rec = [actor, cid, round(ts, 6), bytes_in, bytes_out]
+        if spec:
+            rec.append(1)
+        self.buf.append(json.dumps(rec, separators=(',', ':')))
+        if len(self.buf) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.fo is None or len(self.buf) == 0:
+            return
+
+        # one write per batch, so a crash loses at most the last partial line
+        self.fo.write('\n'.join(self.buf) + '\n')
+        self.fo.flush()
+        self.buf = []
+
+    def close(self):
+        if self.fo is None:
+            return
+
+        self.flush()
+        self.fo.close()
+        self.fo = None
+
+###
+#  read back a timeline file
+#  yields (actorNum, state name, timestamp relative to start, bytes in, bytes out, spec)
+#  where spec is True for a speculative duplicate's transitions
+###
+def read_timeline(filename):
+    names = {}
+    start = 0
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # truncated last line after a crash
+                break
+
+            if isinstance(rec, list):
+                (actor, cid, ts, bytes_in, bytes_out) = rec[:5]
+                yield (actor, names[cid], ts - start, bytes_in, bytes_out, len(rec) > 5 and rec[5] == 1)
+
+            elif 'class' in rec:
+                names[rec['class']] = str(rec['name'])
+
+            elif 'start' in rec:
+                start = rec['start']
+
+###
+#  actorNum -> [(timestamp, state name), ...], as in the coordinator's out_file
+#  (just the original workers: speculative duplicates are left out)
+###
+def load_timeline(filenames):
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    actors = {}
+    for filename in filenames:
+        for (actor, name, ts, _, _, spec) in read_timeline(filename):
+            if not spec:
+                actors.setdefault(actor, []).append((ts, name))
+
+    return actors
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+import heapq
+import itertools
+import time
+
+###
+#  a single armed timer; cancel() is O(1), the heap entry is dropped lazily
+###
+class Timer(object):
+    __slots__ = ['deadline', 'callback', 'args', 'cancelled']
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.callback = None
+        self.args = None
+
+###
+#  heap of timers: arm is O(log n), expiring k timers is O(k log n)
+###
+class TimerQueue(object):
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.ncancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.ncancelled
+
+    # run callback(*args) at time deadline (seconds since epoch)
+    def arm_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        # counter breaks ties so that we never compare Timer objects
+        heapq.heappush(self.heap, (deadline, next(self.counter), timer))
+        return timer
+
+    # run callback(*args) delay seconds from now
+    def arm(self, delay, callback, *args):
+        return self.arm_at(time.time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        if timer is None or timer.cancelled:
+            return
+
+        timer.cancel()
+        self.ncancelled += 1
+
+        # don't let cancelled timers pile up in the heap
+        if self.ncancelled > 64 and self.ncancelled > len(self.heap) // 2:
+            self.heap = [ ent for ent in self.heap if not ent[2].cancelled ]
+            heapq.heapify(self.heap)
+            self.ncancelled = 0
+
+    def _drop_cancelled(self):
+        while len(self.heap) > 0 and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.ncancelled -= 1
+
+    # deadline of the next live timer, or None
+    def next_deadline(self):
+        self._drop_cancelled()
+        if len(self.heap) == 0:
+            return None
+
+        return self.heap[0][0]
+
+    # how long (in ms) a poll can wait without missing a timer, at most max_ms
+    def poll_timeout(self, max_ms, now=None):
+        deadline = self.next_deadline()
+        if deadline is None:
+            return max_ms
+
+        if now is None:
+            now = time.time()
+
+        return max(0, min(max_ms, int(1000 * (deadline - now)) + 1))
+
+    # fire every timer whose deadline has passed; returns number fired
+    def run_expired(self, now=None):
+        if now is None:
+            now = time.time()
+
+        nfired = 0
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            (_, _, timer) = heapq.heappop(self.heap)
+            if timer.cancelled:
+                self.ncancelled -= 1
+                continue
+
+            (callback, args) = (timer.callback, timer.args)
+            # mark as done so that a later cancel() is harmless
+            timer.cancelled = True
+            timer.callback = None
+            timer.args = None
+            callback(*args)
+            nfired += 1
+
+        return nfired
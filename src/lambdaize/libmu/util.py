@@ -52,7 +52,23 @@ def connect_socket(addr, port, cacert, srvcrt, srvkey):
 
     return s
 
+###
+#  SSL contexts, one per set of credentials: parsing the PEMs and checking
+#  the key is expensive, and thousands of connections use the same ones.
+#  Sharing a context also shares its session cache, so reconnects resume.
+###
+_ssl_contexts = {}
+
 def ssl_context(cacert, srvcrt, srvkey):
+    key = (cacert, srvcrt, srvkey)
+    sslctx = _ssl_contexts.get(key)
+    if sslctx is None:
+        sslctx = _new_ssl_context(cacert, srvcrt, srvkey)
+        _ssl_contexts[key] = sslctx
+
+    return sslctx
+
+def _new_ssl_context(cacert, srvcrt, srvkey):
     # general setup: TLSv1.2, no compression, paranoid ciphers
     sslctx = SSL.Context(SSL.TLSv1_2_METHOD)
     sslctx.set_verify_depth(9)
@@ -82,8 +98,33 @@ def ssl_context(cacert, srvcrt, srvkey):
     # check that all's well
     sslctx.check_privatekey()
 
+    # session resumption (IDs and tickets) needs a session id context when we verify peers
+    sslctx.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+    sslctx.set_session_id("libmu")
+    sslctx.set_info_callback(_save_session)
+
     return sslctx
 
+###
+#  client-side session resumption: a new connection to a server offers the
+#  session from our last connection to it, so reconnects skip the full handshake.
+#  We keep just the session (saved when the handshake is done), not the connection.
+###
+_ssl_sessions = {}
+
+def _resume_session(sslconn, key):
+    sslconn.set_app_data(key)
+    session = _ssl_sessions.get(key)
+    if session is not None:
+        sslconn.set_session(session)
+
+def _save_session(sslconn, where, _):
+    if where & SSL.SSL_CB_HANDSHAKE_DONE:
+        key = sslconn.get_app_data()
+        session = sslconn.get_session() if key is not None else None
+        if session is not None:
+            _ssl_sessions[key] = session
+
 ###
 #  SSLize a connected socket, requiring a supplied cacert
 ###
@@ -93,6 +134,7 @@ def sslize(sock, cacert, srvcrt, srvkey, is_connect):
         sslctx = ssl_context(cacert, srvcrt, srvkey)
         sslconn = SSL.Connection(sslctx, sock)
         if is_connect:
+            _resume_session(sslconn, (sock.getpeername(), cacert, srvcrt, srvkey))
             sslconn.set_connect_state()
         else:
             sslconn.set_accept_state()
@@ -104,9 +146,12 @@ def sslize(sock, cacert, srvcrt, srvkey, is_connect):
 ###
 #  listen on a socket, maybe SSLizing
 ###
-def listen_socket(addr, port, cacert, srvcrt, srvkey, nlisten=1):
+def listen_socket(addr, port, cacert, srvcrt, srvkey, nlisten=1, reuse_port=False):
     ls = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     ls.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # let several processes accept on the same port
+        ls.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     ls.bind((addr, port))
     ls.listen(nlisten)
 
@@ -21,13 +21,25 @@ parser.add_option( "-f"
                  , help    ="Corodinator Log file"
                  , metavar ="FILE"
                  )
+parser.add_option( "-t"
+                 , "--timeline"
+                 , dest    ="timeline_filenames"
+                 , action  ="append"
+                 , help    ="Coordinator timeline file (-J); may be repeated for shards"
+                 , metavar ="FILE"
+                 )
 (options, args) = parser.parse_args()
 LOG_FILE = options.log_filename
 
-with open(LOG_FILE) as fd:
+if options.timeline_filenames:
+  import libmu.timeline
+  actors = libmu.timeline.load_timeline(options.timeline_filenames)
+  log_entries = [ str(actors[actor]) for actor in sorted(actors.keys()) ]
+else:
+  with open(LOG_FILE) as fd:
     log_entries = fd.readlines()
 
-fd.close()
+  fd.close()
 
 ofd = open(OUTPUT_FILE, "w")
 ###
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+###
+#  SocketNB micro-benchmark
+#
+#  Pushes messages through a pair of connected SocketNBs in one process and
+#  reports throughput, e.g., for many small control messages and for a few
+#  big state files.
+#
+#  ./socketnb_bench.py                    # 1 KB x 20000 and 20 MB x 5
+#  ./socketnb_bench.py -s 1024 -n 100000  # just 1 KB x 100000
+###
+
+import getopt
+import select
+import socket
+import sys
+import time
+
+from libmu.socket_nb import SocketNB
+
+def run_one(msg_size, num_msgs, views=False):
+    (a, b) = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    sender = SocketNB(a)
+    receiver = SocketNB(b)
+    receiver.recv_views = views
+
+    msg = 'x' * msg_size
+    poll_obj = select.poll()
+    poll_obj.register(receiver.fileno(), select.POLLIN)
+
+    nsent = 0
+    nrecvd = 0
+    start = time.time()
+    while nrecvd < num_msgs:
+        # keep a few messages in flight
+        while nsent < num_msgs and nsent - nrecvd < 8:
+            sender.enqueue(msg)
+            nsent += 1
+
+        if sender.want_write:
+            sender.do_write()
+
+        for _ in poll_obj.poll(0 if sender.want_write else 1000):
+            receiver.do_read()
+
+        while receiver.dequeue() is not None:
+            nrecvd += 1
+
+    elapsed = time.time() - start
+    sender.close()
+    receiver.close()
+
+    return elapsed
+
+def report(msg_size, num_msgs, views=False):
+    elapsed = run_one(msg_size, num_msgs, views)
+    mbytes = msg_size * num_msgs / 1048576.0
+    print "%10d B x %-7d %s %8.3f s  %10.1f msg/s  %8.1f MB/s" % (msg_size, num_msgs, "(views)" if views else "       ", elapsed, num_msgs / elapsed, mbytes / elapsed)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:n:v")
+    except getopt.GetoptError as err:
+        print str(err)
+        sys.exit(1)
+
+    if len(args) > 0:
+        print "Usage: %s [-s msgSize -n numMsgs] [-v]" % sys.argv[0]
+        sys.exit(1)
+
+    msg_size = None
+    num_msgs = 1
+    views = False
+    for (opt, arg) in opts:
+        if opt == "-s":
+            msg_size = int(arg)
+        elif opt == "-n":
+            num_msgs = int(arg)
+        elif opt == "-v":
+            views = True
+
+    if msg_size is not None:
+        report(msg_size, num_msgs, views)
+        return
+
+    # control messages and state files
+    report(1024, 20000)
+    report(20 * 1024 * 1024, 5)
+    report(20 * 1024 * 1024, 5, True)
+
+if __name__ == "__main__":
+    main()
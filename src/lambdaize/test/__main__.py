@@ -6,9 +6,39 @@ sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
 # insert parent directory in search path, since test/ lives alongside libmu
 
 import test.run as run
+import test.timers as timers
+import test.timeline as timeline
+import test.metrics as metrics
+import test.options as options
+import test.dispatch as dispatch
+import test.executor as executor
+import test.transfers as transfers
+import test.storage as storage
+import test.batch as batch
+import test.compression as compression
+import test.framing as framing
+import test.stream as stream
+import test.rawxfer as rawxfer
+import test.tls as tls
+import test.flowcontrol as flowcontrol
 import test.states as states
 import test.encsrv as encsrv
 
+timers.run_tests()
+timeline.run_tests()
+metrics.run_tests()
+options.run_tests()
+dispatch.run_tests()
+executor.run_tests()
+transfers.run_tests()
+storage.run_tests()
+batch.run_tests()
+compression.run_tests()
+framing.run_tests()
+stream.run_tests()
+rawxfer.run_tests()
+tls.run_tests()
+flowcontrol.run_tests()
 run.run_tests()
 states.run_tests()
 encsrv.run_tests()
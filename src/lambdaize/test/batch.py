@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import sys
+import os
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu import CommandListState, TerminalState, ErrorState, Defs
+from libmu.handler import pack_batch, unpack_batch, handle_message
+import test.util as tutil
+
+class FakeConn(object):
+    def __init__(self):
+        self.sock = self
+
+    @staticmethod
+    def fileno():
+        return 0
+
+class DoneState(TerminalState):
+    pass
+
+class BatchedState(CommandListState):
+    nextState = DoneState
+    pipelined = True
+    commandlist = [ ("OK:HELLO", "set:a:1")
+                  , "seti:b:2"
+                  , "geti:b"
+                  , ("OK:GETI", None)
+                  ]
+
+def run_tests():
+    msgs = ['set:a:1', '', 'retrieve:x\0y:z', '12:34']
+    assert unpack_batch(pack_batch(msgs)) == msgs
+
+    # the worker runs the commands in order and answers once (INFO goes out separately)
+    sock = tutil.FakeSock(record_ftype=True)
+    vals = {'cmdsock': sock}
+    assert not handle_message(Defs.batch_command + pack_batch(['set:a:1', 'seti:b:2', 'geti:b', 'nope:']), vals)
+    assert vals['cmdsock'] is sock
+    assert vals['a'] == '1' and vals['b'] == 2
+    assert sock.sent[0] == ('INFO:b:2', Defs.ftype_info)
+    assert len(sock.sent) == 2 and sock.sent[1][0].startswith(Defs.batch_response)
+    responses = unpack_batch(sock.sent[1][0][len(Defs.batch_response):])
+    assert responses == ['OK:SET(a)', 'OK:SETI(b)', 'OK:GETI(b)', "FAIL(no such command 'nope:')"]
+
+    # quit: stops the batch
+    sock = tutil.FakeSock(record_ftype=True)
+    assert handle_message(Defs.batch_command + pack_batch(['quit:', 'set:a:1']), {'cmdsock': sock})
+    assert sock.sock is None and sock.sent == []
+
+    # a pipelined CommandListState batches its commands if the worker understands batch:
+    state = BatchedState(FakeConn())
+    state.peer_caps = frozenset(['batch'])
+    state.recv_queue.append('OK:HELLO')
+    state = state.do_handle()
+    assert [ msg for msg in state.send_queue if msg.startswith(Defs.batch_command) ] == \
+           [ Defs.batch_command + pack_batch(['set:a:1', 'seti:b:2', 'geti:b']) ]
+
+    # ...and takes its batched response apart again
+    state.recv_queue.append(Defs.batch_response + pack_batch(['OK:SET(a)', 'OK:SETI(b)', 'OK:GETI(b)']))
+    state = state.do_handle()
+    assert isinstance(state, DoneState), repr(state)
+
+    # a FAIL inside the batch is still a FAIL
+    state = BatchedState(FakeConn())
+    state.peer_caps = frozenset(['batch'])
+    state.recv_queue.append('OK:HELLO')
+    state.recv_queue.append(Defs.batch_response + pack_batch(['OK:SET(a)', 'FAIL(oops)']))
+    state = state.do_handle()
+    assert isinstance(state, ErrorState) and state.err == 'FAIL(oops)'
+
+    print "Batch tests passed."
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+import sys
+import os
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu.compression import AdaptiveCompressor
+
+def run_tests():
+    comp = AdaptiveCompressor()
+    data = 'frame 1234 done\n' * 10000
+    zdata = comp.compress(data)
+    assert zdata is not None and len(zdata) < len(data) / 10
+    assert comp.decompress(zdata) == data
+    assert comp.to_dict()['ratio_out'] < 0.1
+
+    # incompressible data goes out as is
+    assert comp.compress(os.urandom(4096)) is None
+
+    # no idea how fast the link is: stay put
+    comp = AdaptiveCompressor()
+    start = comp.level
+    for _ in range(4 * comp.adjust_every):
+        comp.record(1000000, 100000, 0.01)
+    assert comp.level == start
+
+    # compression (100 MB/s) is much faster than the link (1 MB/s): go up
+    comp.observe_link(1000000, 1.0)
+    for _ in range(comp.adjust_every):
+        comp.record(1000000, 100000, 0.01)
+    assert comp.level > start
+
+    # compression (1 MB/s) can't keep up with the link: back down, all the way to off
+    for _ in range(10 * comp.adjust_every):
+        comp.record(1000000, 100000, 1.0)
+        if comp.level == 0:
+            break
+    assert comp.level == 0
+    assert comp.compress(data) is None
+
+    # ...but we try again after a while
+    for _ in range(comp.probe_every):
+        comp.compress(data)
+    assert comp.level > 0
+
+    print "Compression tests passed."
+
+if __name__ == "__main__":
+    run_tests()
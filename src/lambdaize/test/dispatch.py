@@ -0,0 +1,53 @@
+#!/usr/bin/python
+
+import sys
+import os
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu import handler
+import test.util as tutil
+
+def do_double(msg, vals):
+    vals['cmdsock'].enqueue('OK:DOUBLE(%s)' % (msg * 2))
+    return False
+
+def run_tests():
+    handler.command_stats.clear()
+    sock = tutil.FakeSock()
+    vals = {'cmdsock': sock}
+
+    # the verb is everything up to the first colon
+    assert not handler.handle_message('echo:a:b', vals)
+    assert sock.sent[-1] == 'OK:ECHO(a:b)'
+    assert not handler.handle_message('echo', vals)
+    assert sock.sent[-1] == "FAIL(no such command 'echo')"
+    assert not handler.handle_message('echoes:x', vals)
+    assert sock.sent[-1] == "FAIL(no such command 'echoes:x')"
+
+    # server modules can add commands, along with what the coordinator should expect back
+    assert handler.expected_response('double:x') == 'OK'
+    handler.register_command('double', do_double, 'OK:DOUBLE')
+    try:
+        assert handler.expected_response('double:x') == 'OK:DOUBLE'
+        assert not handler.handle_message('double:xy', vals)
+        assert sock.sent[-1] == 'OK:DOUBLE(xyxy)'
+    finally:
+        del handler.commands['double']
+    assert handler.expected_response('set:a:b') == 'OK:SET'
+    assert handler.expected_response('quit:') == 'OK'
+
+    # every command is counted
+    assert not handler.handle_message('set:a:1234', vals)
+    assert not handler.handle_message('stats:', vals)
+    stats = handler.parse_stats(sock.sent[-1])
+    assert stats['echo'] == {'count': 1, 'time': stats['echo']['time'], 'bytes': 3}
+    assert stats['set']['count'] == 1 and stats['set']['bytes'] == 6
+    assert stats['double']['count'] == 1
+    assert 'stats' not in stats and 'echoes' not in stats
+    assert all( cstats['time'] >= 0 for cstats in stats.values() )
+
+    print "Dispatch tests passed."
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+import sys
+import os
+import select
+import shutil
+import tempfile
+import time
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu.executor import Executor, CallJob, CommandJob, StreamingOutput
+
+# run the select loop until n messages have come out of executor
+def collect(executor, n):
+    msgs = []
+    deadline = time.time() + 20
+    while len(msgs) < n:
+        assert time.time() < deadline, "jobs never finished: %s" % str(msgs)
+        (rfds, _, _) = select.select(executor.rsocks(), [], [], 1)
+        for r in rfds:
+            r.do_read()
+        while executor.want_handle:
+            msgs.append(executor.dequeue())
+    return msgs
+
+def finish(retval, output):
+    return 'RETVAL(%d):%s' % (retval, output)
+
+def run_tests():
+    executor = Executor(2)
+
+    # commands and calls, no more than two at a time
+    executor.submit(CommandJob('echo one; sleep 0.2', finish))
+    executor.submit(CallJob(lambda: 'two'))
+    executor.submit(CommandJob('echo three >&2; exit 3', finish))
+    executor.submit(CallJob(lambda: 1 / 0))
+    assert executor.running == 2 and len(executor.pending) == 2 and executor.busy()
+    msgs = collect(executor, 4)
+    fails = [ msg for msg in msgs if msg.startswith('FAIL(') ]
+    assert len(fails) == 1 and 'ZeroDivisionError' in fails[0]
+    assert sorted(set(msgs) - set(fails)) == ['RETVAL(0):one\n', 'RETVAL(3):three\n', 'two']
+    assert not executor.busy() and executor.rsocks() == [executor]
+
+    # lots of output comes through intact
+    executor.submit(CommandJob('head -c 1000000 /dev/zero', finish))
+    assert collect(executor, 1) == ['RETVAL(0):' + '\0' * 1000000]
+
+    # jobs really do run side by side
+    start = time.time()
+    for _ in range(2):
+        executor.submit(CommandJob('sleep 0.5', finish))
+    collect(executor, 2)
+    assert time.time() - start < 0.9
+
+    # run() runs a job right here
+    assert CommandJob('echo hi', finish).run() == 'RETVAL(0):hi\n'
+
+    # streamed output: reports come in whole lines, and the final response only gets the tail
+    reports = []
+    (fd, logname) = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        output = StreamingOutput(reports.append, 100, 0, open(logname, 'w'))
+        executor.submit(CommandJob('for i in $(seq 1 50); do echo line $i; sleep 0.001; done; printf end', finish, output))
+        (msg,) = collect(executor, 1)
+        everything = ''.join( 'line %d\n' % i for i in range(1, 51) ) + 'end'
+        assert ''.join(reports) == everything
+        assert all( report.endswith('\n') for report in reports[:-1] )
+        assert msg == 'RETVAL(0):[%d bytes omitted]\n%s' % (len(everything) - 100, everything[-100:])
+        with open(logname, 'r') as f:
+            assert f.read() == everything
+    finally:
+        os.unlink(logname)
+
+    # ...no more often than we asked for
+    reports = []
+    output = StreamingOutput(reports.append, 1000, 60)
+    assert CommandJob('echo one; echo two; printf three', finish, output).run() == 'RETVAL(0):one\ntwo\nthree'
+    assert reports[0] in ('one\n', 'one\ntwo\n') and ''.join(reports) == 'one\ntwo\nthree' and len(reports) <= 2
+
+    # a job can wait for its input file
+    tmpdir = tempfile.mkdtemp()
+    try:
+        waits = []
+        statefile = os.path.join(tmpdir, '1.state')
+        executor.submit_after(statefile, CallJob(lambda: 'ran'), waits.append)
+        assert executor.busy() and executor.running == 0
+        time.sleep(0.05)
+        open(statefile, 'w').close()
+        executor.file_arrived(statefile)
+        assert collect(executor, 1) == ['ran']
+        assert len(waits) == 1 and waits[0] >= 0.05
+
+        # (not if it's already there)
+        executor.submit_after(statefile, CallJob(lambda: 'ran again'), waits.append)
+        assert collect(executor, 1) == ['ran again'] and waits[1] == 0
+
+        # a file that never comes: after wait_timeout, the job is dropped with a FAIL
+        expiring = Executor(2, wait_timeout=0.1)
+        lostfile = os.path.join(tmpdir, 'lost.state')
+        expiring.submit_after(lostfile, CallJob(lambda: 'never'), waits.append)
+        assert expiring.busy() and 0 < expiring.wait_remaining() <= 0.1
+        expiring.expire_waiting()
+        assert not expiring.want_handle
+        time.sleep(0.1)
+        expiring.expire_waiting()
+        assert expiring.dequeue() == 'FAIL(timed out waiting for %s)' % lostfile
+        assert not expiring.busy() and expiring.wait_remaining() is None and len(waits) == 2
+        expiring.close()
+
+        # inotify can tell us instead
+        watcher = Executor(2, True)
+        if watcher.watcher is not None:
+            statefile = os.path.join(tmpdir, '2.state')
+            watcher.submit_after(statefile, CommandJob('echo go', finish))
+            with open(os.path.join(tmpdir, 'temp.state'), 'w') as f:
+                f.write('state')
+            os.rename(os.path.join(tmpdir, 'temp.state'), statefile)
+            assert collect(watcher, 1) == ['RETVAL(0):go\n'] and not watcher.busy()
+        watcher.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # close() kills what's still running
+    executor.submit(CommandJob('sleep 30', finish))
+    job = executor.commands[0]
+    executor.close()
+    assert job.proc.returncode is not None
+
+    print "Executor tests passed."
+
+if __name__ == "__main__":
+    run_tests()
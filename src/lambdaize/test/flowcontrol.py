@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import sys
+import os
+import select
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu.machine_state import MachineState
+from libmu.socket_nb import SocketNB
+from libmu.timers import TimerQueue
+import lambda_state_server as lss
+import test.util as tutil
+
+# can't take 'later' until it has seen 'first'
+class PickyState(MachineState):
+    def __init__(self, prevState):
+        super(PickyState, self).__init__(prevState)
+        self.handled = []
+
+    def transition(self, msg):
+        if msg == 'later' and 'first' not in self.handled:
+            raise ValueError("not yet")
+        self.handled.append(msg)
+        return self
+
+def run_tests():
+    # send side: full at the high mark, and stays full until the low mark
+    (a, b) = tutil.make_pair()
+    a.send_high_water = 300000
+    for _ in range(4):
+        a.enqueue('x' * 100000)
+    assert a.send_full and a.send_pending() > 400000
+    while a.send_pending() > 150000:
+        assert a.send_full
+        a.do_write()
+        while tutil.readable(b, 0):
+            b.do_read()
+            while b.want_handle:
+                b.dequeue()
+    assert not a.send_full
+
+    # a throttled socket stops polling for input and leaves it in the kernel
+    b.enqueue('hello')
+    b.do_write()
+    assert tutil.readable(a)
+    a.throttle(True)
+    assert a.throttled and not a.poll_flags() & select.POLLIN
+    a.do_read()
+    assert not a.want_handle
+    a.throttle(False)
+    assert a.poll_flags() & select.POLLIN
+    a.do_read()
+    assert a.dequeue() == 'hello'
+    a.close()
+    b.close()
+
+    # receive side: stop reading while too many messages are waiting to be handled
+    (a, b) = tutil.make_pair()
+    b.recv_high_water = 4
+    for i in range(10):
+        a.enqueue('msg %d' % i)
+        a.do_write()
+        if tutil.readable(b):
+            b.do_read()
+    assert b.recv_full and not b.poll_flags() & select.POLLIN
+    nqueued = len(b.recv_queue)
+    b.do_read()
+    assert len(b.recv_queue) == nqueued
+    msgs = []
+    while b.recv_full:
+        msgs.append(b.dequeue())
+    assert len(b.recv_queue) == 2
+    while len(msgs) < 10:
+        if tutil.readable(b):
+            b.do_read()
+        while b.want_handle:
+            msgs.append(b.dequeue())
+    assert msgs == [ 'msg %d' % i for i in range(10) ]
+    a.close()
+    b.close()
+
+    # a message the handler puts back doesn't count, so it can't stop the read it's waiting for
+    (a, b) = tutil.make_pair()
+    b = PickyState(b)
+    b.recv_high_water = 1
+    a.enqueue('later')
+    a.do_write()
+    assert tutil.readable(b)
+    b = b.do_read()
+    assert list(b.recv_queue) == ['later'] and b.recv_held == 1
+    assert not b.recv_full and b.poll_flags() & select.POLLIN
+    a.enqueue('first')
+    a.do_write()
+    assert tutil.readable(b)
+    b = b.do_read()
+    assert b.handled == ['first'] and b.recv_held == 1
+    b = b.do_handle()
+    assert b.handled == ['first', 'later'] and len(b.recv_queue) == 0 and b.recv_held == 0
+    a.close()
+    b.close()
+
+    # request/response peers: a full send queue stops reads too
+    (a, b) = tutil.make_pair()
+    a.throttle_when_full = True
+    a.send_high_water = 1000
+    a.enqueue('y' * 2000)
+    assert a.throttled and not a.poll_flags() & select.POLLIN
+    a.do_write()
+    assert not a.throttled and a.poll_flags() & select.POLLIN
+    a.close()
+    b.close()
+
+    # the state relay stops reading from a worker whose partner is backed up
+    SocketNB.send_high_water = 1000
+    try:
+        (src, dst) = tutil.make_pair(lss.StateSocket)
+        (src.stateid, src.partner) = ('x_1', 'x_2')
+        (dst.stateid, dst.partner) = ('x_2', 'x_1')
+        sts = {'x_1': src, 'x_2': dst}
+        dst.enqueue('z' * 2000)
+        rwflags = {}
+        lss.rwsplit(sts, rwflags, {}, TimerQueue())
+        assert src.throttled and not rwflags['x_1'] & select.POLLIN
+        dst.do_write()
+        lss.rwsplit(sts, rwflags, {}, TimerQueue())
+        assert not src.throttled and rwflags['x_1'] & select.POLLIN
+        src.close()
+        dst.close()
+    finally:
+        SocketNB.send_high_water = None
+
+    print "Flow control tests passed."
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import sys
+import os
+import select
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu.defs import Defs
+import test.util as tutil
+
+# push everything a has queued over to b
+def pump(a, b):
+    while a.want_write:
+        a.do_write()
+        if select.select([b], [], [], 0)[0]:
+            b.do_read()
+    while select.select([b], [], [], 0.05)[0]:
+        b.do_read()
+        if b.sock is None:
+            break
+
+def drain(sock):
+    ret = []
+    while sock.want_handle:
+        ret.append(sock.dequeue())
+    return ret
+
+def run_tests():
+    # ASCII frames, including big and empty messages
+    (a, b) = tutil.make_pair()
+    msgs = ['hello', '', 'x' * 200000, 'INFO:foo:bar']
+    for msg in msgs:
+        a.enqueue(msg)
+    pump(a, b)
+    assert drain(b) == msgs
+    assert not a.send_binary and not b.send_binary
+    a.close()
+    b.close()
+
+    # binary framing is negotiated by a HELLO from the worker side...
+    (coord, worker) = tutil.make_pair()
+    worker.enqueue(Defs.hello_binary)
+    pump(worker, coord)
+    assert drain(coord) == [Defs.hello_binary]
+    assert coord.send_binary and not worker.send_binary
+
+    # ...and the worker switches once it sees a binary frame (the coordinator's capabilities)
+    coord.enqueue('set:foo:bar')
+    pump(coord, worker)
+    assert drain(worker) == ['set:foo:bar']
+    assert worker.send_binary and worker.peer_compress and coord.peer_compress
+
+    # big messages get compressed; small ones don't
+    output = 'OK:RETVAL(0):OUTPUT(%s)' % ('frame 1234 done\n' * 5000)
+    worker.enqueue(output)
+    worker.enqueue('OK:SMALL')
+    pump(worker, coord)
+    assert drain(coord) == [output, 'OK:SMALL']
+    assert worker.compressor.nout == 1 and coord.compressor.nin == 1
+    assert worker.bytes_out < len(output) / 10
+
+    # typed INFO frames don't go through recv_queue
+    worker.enqueue('INFO:foo:bar', Defs.ftype_info)
+    worker.enqueue('OK:GETI(foo)')
+    worker.enqueue('y' * 100000, Defs.ftype_state)
+    pump(worker, coord)
+    assert list(coord.info_queue) == ['INFO:foo:bar']
+    assert drain(coord) == ['OK:GETI(foo)', 'y' * 100000]
+    coord.close()
+    worker.close()
+
+    # with binary framing turned off, the HELLO is just a HELLO
+    (coord, worker) = tutil.make_pair()
+    coord.binary_framing = False
+    worker.enqueue(Defs.hello_binary)
+    pump(worker, coord)
+    assert drain(coord) == [Defs.hello_binary]
+    assert not coord.send_binary
+    coord.close()
+    worker.close()
+
+    # frame flags we don't know about are an error
+    (a, b) = tutil.make_pair()
+    a.sock.sendall(Defs.bin_header.pack(Defs.bin_magic, Defs.ftype_command, 0x80, 1) + 'z')
+    try:
+        b.do_read()
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError for unknown frame flags"
+    a.close()
+    b.close()
+
+    print "Framing tests passed."
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+
+import sys
+import os
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu.metrics import Histogram, CoordinatorMetrics
+
+class FakeState(object):
+    def __init__(self, bytes_in, msgs_in):
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.msgs_in = msgs_in
+        self.msgs_out = 0
+        self.send_bytes = bytes_in * 2
+
+class OtherState(FakeState):
+    pass
+
+def run_tests():
+    hist = Histogram()
+    assert hist.percentile(50) is None
+
+    for _ in range(0, 98):
+        hist.add(0.001)
+    hist.add(1)
+    hist.add(2)
+
+    # percentiles are bucket upper bounds, good to within about 20%
+    p50 = hist.percentile(50)
+    assert 0.001 <= p50 < 0.0012, "bad p50 %s" % str(p50)
+    p99 = hist.percentile(99)
+    assert 1 <= p99 < 1.2, "bad p99 %s" % str(p99)
+    assert hist.percentile(100) == 2
+    assert hist.to_dict()['count'] == 100
+
+    metrics = CoordinatorMetrics()
+    metrics.record_iteration(0.5, 0.001)
+    metrics.record_state_time('FakeState', 0.25)
+    snap = metrics.snapshot([FakeState(10, 1), FakeState(20, 2), OtherState(5, 0)], {'shard': None})
+    assert snap['states'] == {'FakeState': 2, 'OtherState': 1}
+    assert snap['io']['bytes_in'] == 35 and snap['io']['msgs_in'] == 3
+    assert snap['compression']['raw_out'] == 0
+    assert snap['queues']['send_bytes'] == 70 and snap['queues']['send_bytes_max'] == 40
+    assert snap['loop']['iterations'] == 1
+    assert snap['state_time']['FakeState']['count'] == 1
+    assert 'shard' in snap
+
+    print "Metrics tests passed."
+
+if __name__ == "__main__":
+    run_tests()
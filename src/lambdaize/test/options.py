@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+import sys
+import os
+import tempfile
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+import libmu.server
+from libmu.socket_nb import SocketNB
+
+class ServerInfo(object):
+    num_parts = 1
+    port_number = 13579
+
+def parse(*argv):
+    (fd, pem) = tempfile.mkstemp(suffix=".pem")
+    os.write(fd, "-----BEGIN X-----\nAAAA\n-----END X-----\n")
+    os.close(fd)
+
+    oldargv = sys.argv
+    sys.argv = ['options_test', '-c', pem, '-s', pem, '-k', pem] + list(argv)
+    try:
+        info = ServerInfo()
+        libmu.server.options(info)
+        return info
+    finally:
+        sys.argv = oldargv
+        os.unlink(pem)
+
+def run_tests():
+    # -W takes an argument, and the switches after it still parse
+    info = parse('-W', '/tmp/metrics.sock', '-A', '-Q', '4096', '-G', '8')
+    try:
+        assert info.metrics_addr == '/tmp/metrics.sock'
+        assert SocketNB.binary_framing is False
+        assert SocketNB.send_high_water == 4096
+        assert SocketNB.recv_high_water == 8
+    finally:
+        SocketNB.binary_framing = True
+        SocketNB.send_high_water = None
+        SocketNB.recv_high_water = None
+
+    info = parse('-A', '-W', '9090')
+    try:
+        assert info.metrics_addr == '9090'
+        assert SocketNB.binary_framing is False
+    finally:
+        SocketNB.binary_framing = True
+
+    info = parse()
+    assert getattr(info, 'metrics_addr', None) is None
+    assert SocketNB.binary_framing is True
+
+    print "Options tests passed."
+
+if __name__ == "__main__":
+    run_tests()
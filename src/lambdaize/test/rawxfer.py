@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+import sys
+import os
+import select
+import tempfile
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu import rawxfer
+from libmu.socket_nb import SocketNB
+from libmu.timers import TimerQueue
+import lambda_state_server as lss
+import test.util as tutil
+
+# run the sockets until done() says so
+def run(socks, done):
+    for _ in range(100000):
+        if done():
+            return
+        live = [ s for s in socks if s.sock is not None ]
+        rd = [ s for s in live if s.poll_flags() & select.POLLIN ]
+        wr = [ s for s in live if s.poll_flags() & select.POLLOUT ]
+        (rd, wr, _) = select.select(rd, wr, [], 1)
+        for s in rd:
+            s.do_read()
+        for s in wr:
+            s.do_write()
+    assert False, "transfer never finished"
+
+class Receiver(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.msgs = []
+        self.files = []
+        self.fnames = []
+
+    # what the worker does: take messages, and write raw transfers to files
+    def handle(self):
+        while self.sock.want_handle:
+            msg = self.sock.dequeue()
+            self.msgs.append(msg)
+            raw = rawxfer.parse_begin(msg)
+            if raw is not None:
+                (fd, fname) = tempfile.mkstemp(suffix=".state")
+                os.close(fd)
+                self.fnames.append(fname)
+                self.sock.recv_raw(rawxfer.RawReceiver(open(fname, 'w+b'), raw[0], raw[1], self.files.append))
+
+    def cleanup(self):
+        for fname in self.fnames:
+            os.unlink(fname)
+
+def contents(receiver):
+    with open(receiver.fobj.name, 'r') as f:
+        return f.read()
+
+def transfer(fname, data, relayed):
+    (a, b) = tutil.make_pair()
+    socks = [a, b]
+    if relayed:
+        # worker a -> relay (ra, rb) -> worker b, as in lambda_state_server
+        ra = b
+        (rb, b) = tutil.make_pair()
+        socks = [a, ra, rb, b]
+    recv = Receiver(b)
+
+    def step():
+        if relayed:
+            while ra.want_handle:
+                msg = ra.dequeue()
+                rb.enqueue(msg)
+                raw = rawxfer.parse_begin(msg)
+                if raw is not None:
+                    relay = rawxfer.RawRelay(ra, rb, raw[0])
+                    rb.send_queue.append(relay)
+                    ra.recv_raw(relay)
+        recv.handle()
+        return len(recv.msgs) == 4 and len(recv.files) == 2
+
+    try:
+        a.enqueue("before")
+        a.send_file("STATE(1)", open(fname, 'r'))
+        a.enqueue("after")
+        a.send_file("STATE(2)", open(fname, 'r'))
+        run(socks, step)
+
+        # like streams, files are queued as the socket drains, so "after" overtakes them
+        assert recv.msgs[:2] == ["before", "after"]
+        assert len(recv.files) == 2
+        for rcv in recv.files:
+            assert rcv.ok
+            assert contents(rcv) == data
+        assert rawxfer.parse_begin(recv.msgs[2])[2] == "STATE(1)"
+        assert rawxfer.parse_begin(recv.msgs[3])[2] == "STATE(2)"
+        assert not a.want_write and a.send_pending() == 0
+        if relayed:
+            assert ra.raw_left is None and not rb.want_write
+    finally:
+        recv.cleanup()
+        for s in socks:
+            s.close()
+
+def run_tests():
+    data = os.urandom(3 * 1048576 + 4321)
+    (fd, fname) = tempfile.mkstemp(suffix=".state")
+    os.write(fd, data)
+    os.close(fd)
+
+    try:
+        # with sendfile and splice, and then with plain reads and writes
+        for (use_sendfile, use_splice) in [(rawxfer.use_sendfile, rawxfer.use_splice), (False, False)]:
+            (rawxfer.use_sendfile, rawxfer.use_splice) = (use_sendfile, use_splice)
+            transfer(fname, data, False)
+            transfer(fname, data, True)
+
+        # a corrupted file fails its checksum
+        (a, b) = tutil.make_pair()
+        recv = Receiver(b)
+        a.sock.sendall(SocketNB.format_message(rawxfer.format_begin(5, 1234, "STATE(3)")) + "hello" + SocketNB.format_message("next"))
+        run([a, b], lambda: recv.handle() or len(recv.msgs) == 2)
+        assert recv.files[0].ok is False and recv.msgs[1] == "next"
+        recv.cleanup()
+        a.close()
+        b.close()
+
+        # the relay hangs up on the partner of a worker that died before its file came through
+        (dead, peer) = tutil.make_pair(lss.StateSocket)
+        (dead.stateid, dead.partner) = ('x_1', 'x_2')
+        for msg in ["hello", rawxfer.format_begin(5, 1234, "STATE(4)"), "after"]:
+            dead.recv_queue.append(msg)
+        dead.close()
+        dead.update_flags()
+        (tmbs, timers) = ({}, TimerQueue())
+        lss.rwsplit({'x_1': dead}, {}, tmbs, timers)
+        assert [ msg for (msg, _) in tmbs['x_2'] ] == ["hello", None] and not dead.want_handle
+        (partner, other) = tutil.make_pair(lss.StateSocket)
+        lss.deliver_tombstones(tmbs, {'x_2': partner}, timers)
+        assert len(tmbs) == 0 and partner.sock is None
+        assert timers.poll_timeout(1000) == 1000
+        other.close()
+        peer.close()
+
+    finally:
+        (rawxfer.use_sendfile, rawxfer.use_splice) = (rawxfer._sendfile is not None, rawxfer._splice is not None)
+        os.unlink(fname)
+
+    print "Raw transfer tests passed."
+
+if __name__ == "__main__":
+    run_tests()
@@ -2,6 +2,8 @@
 
 import sys
 import os
+import select
+import time
 sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
 # insert parent directory in search path, since test/ lives alongside libmu
 
@@ -46,6 +48,19 @@ def test_server(sock, run_nonblock, args, _):
 
     sock.close()
 
+# a command that never finishes or says anything doesn't keep the worker around forever
+def test_hung_server(sock, *_):
+    tutil.blocking_recv(sock)
+    tutil.blocking_send(sock, "run:")
+    assert tutil.blocking_recv(sock).startswith("OK:RUNNING")
+
+    start = time.time()
+    while sock.sock is not None:
+        assert time.time() - start < 20, "worker never timed out"
+        if select.select([sock], [], [], 1)[0]:
+            sock.do_read()
+    print "  Worker gave up after %.1f seconds." % (time.time() - start)
+
 def run_tests():
     cmdstring = "echo ##INFILE## | md5sum"
     libmu.Defs.debug = True
@@ -58,5 +73,12 @@ def run_tests():
     tutil.run_one_test(test_server, cmdstring, True, False, True)
     tutil.run_one_test(test_server, cmdstring, True, True, True)
 
+    timeout = libmu.Defs.timeout
+    libmu.Defs.timeout = 2
+    try:
+        tutil.run_one_test(test_hung_server, "sleep 60", False, True)
+    finally:
+        libmu.Defs.timeout = timeout
+
 if __name__ == "__main__":
     run_tests()
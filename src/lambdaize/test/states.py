@@ -7,6 +7,7 @@ sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
 # insert parent directory in search path, since test/ lives alongside libmu
 
 from libmu import CommandListState, OnePassState, TerminalState, ErrorState, SuperpositionState, ForLoopState, InfoWatcherState, Defs
+import libmu.server
 
 import test.util as tutil
 
@@ -123,10 +124,28 @@ def test_server(sock, *_):
             state = state.do_handle()
             print repr(state)
 
+# same scenario, driven by the server's Coordinator instead of by hand
+class CoordinatorInfo(object):
+    num_parts = 1
+    out_file = None
+    profiling = None
+
+def test_coordinator(sock, *_):
+    coord = libmu.server.Coordinator([], StartState, CoordinatorInfo)
+    coord.add_connection(sock)
+
+    while coord.step():
+        pass
+
+    for (_, _, _, errval) in coord.finish():
+        if errval is not None:
+            raise Exception("ERROR: %s" % errval)
+
 def run_tests():
     cmdstring = """ ##INFILE## """
     Defs.debug = True
     tutil.run_one_test(test_server, cmdstring, True, True)
+    tutil.run_one_test(test_coordinator, cmdstring, True, True)
 
 if __name__ == "__main__":
     run_tests()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+import sys
+import os
+import shutil
+import tempfile
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu import handler, Defs
+from libmu.storage import LocalStorage, S3Storage, TransferSettings, open_storage
+import test.util as tutil
+
+# records what the boto3 client is asked to do
+class RecordingS3(object):
+    def __init__(self):
+        self.calls = []
+
+    def download_file(self, bucket, key, filename, **kwargs):
+        self.calls.append(('download', bucket, key, filename, kwargs.get('Config')))
+
+    def upload_file(self, filename, bucket, key, **kwargs):
+        self.calls.append(('upload', bucket, key, filename, kwargs.get('Config')))
+
+def make_urstring(msg, vals):
+    (key, filename) = msg.split('\0', 1)
+    return (True, vals['bucket'], key, filename)
+
+def run_tests():
+    tmpdir = tempfile.mkdtemp()
+    (retrieve, upload) = (Defs.__dict__['make_retrievestring'], Defs.__dict__['make_uploadstring'])
+    Defs.make_retrievestring = Defs.make_uploadstring = staticmethod(make_urstring)
+    try:
+        # a directory stands in for S3
+        storage = open_storage("file://%s/store" % tmpdir)
+        assert isinstance(storage, LocalStorage)
+        src = os.path.join(tmpdir, 'src')
+        with open(src, 'w') as f:
+            f.write('frame data')
+        storage.upload(src, 'bkt', 'vid/00000001.y4m')
+        storage.download('bkt', 'vid/00000001.y4m', os.path.join(tmpdir, 'dst'))
+        with open(os.path.join(tmpdir, 'dst'), 'r') as f:
+            assert f.read() == 'frame data'
+        try:
+            storage.download('bkt', 'vid/nope', os.path.join(tmpdir, 'dst'))
+        except IOError:
+            pass
+        else:
+            assert False, "expected IOError for a missing object"
+
+        try:
+            open_storage("ftp://somewhere")
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError for an unknown storage"
+
+        # the worker picks it up from set:, and transfers through it
+        sock = tutil.FakeSock()
+        vals = {'cmdsock': sock, 'bucket': 'bkt'}
+        handler.handle_message('set:storage:file://%s/store' % tmpdir, vals)
+        handler.handle_message('retrieve:vid/00000001.y4m\0%s/got' % tmpdir, vals)
+        assert sock.sent[-1] == 'OK:RETRIEVE(bkt/vid/00000001.y4m)'
+        handler.handle_message('upload_many:' + '\0'.join( 'out/%d\0%s' % (i, src) for i in range(3) ), vals)
+        assert sock.sent[-1].startswith('OK:UPLOAD_MANY(')
+        assert sorted(os.listdir(os.path.join(tmpdir, 'store', 'bkt', 'out'))) == ['0', '1', '2']
+        handler.handle_message('retrieve:vid/nope\0%s/got' % tmpdir, vals)
+        assert sock.sent[-1].startswith('FAIL(retrieving bkt:vid/nope->')
+
+        # transfer settings come from set: or the event, and only then reach boto3
+        assert TransferSettings.from_vals({}).is_default()
+        settings = TransferSettings.from_vals({'s3_part_size': '16777216', 'event': {'s3_max_concurrency': 20, 's3_part_size': 1}})
+        assert (settings.part_size, settings.concurrency, settings.use_threads) == (16777216, 20, True)
+        assert not TransferSettings.from_vals({'s3_use_threads': 0}).use_threads
+
+        client = RecordingS3()
+        s3 = S3Storage(client)
+        s3.download('bkt', 'k', '/tmp/k')
+        s3.upload('/tmp/k', 'bkt', 'k', settings)
+        assert client.calls[0] == ('download', 'bkt', 'k', '/tmp/k', None)
+        config = client.calls[1][4]
+        assert config.multipart_chunksize == 16777216 and config.multipart_threshold == 16777216 and config.max_concurrency == 20
+
+        # bad settings are a FAIL, not a crash
+        vals['s3_part_size'] = 'big'
+        handler.handle_message('retrieve:vid/00000001.y4m\0%s/got' % tmpdir, vals)
+        assert sock.sent[-1].startswith('FAIL(invalid literal')
+
+    finally:
+        (Defs.make_retrievestring, Defs.make_uploadstring) = (retrieve, upload)
+        shutil.rmtree(tmpdir)
+
+    print "Storage tests passed."
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import sys
+import os
+import select
+import tempfile
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu.stream import StreamSender, StreamReceiver, parse_begin
+import test.util as tutil
+
+class Sink(object):
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, data):
+        self.pieces.append(str(data))
+
+    def value(self):
+        return ''.join(self.pieces)
+
+# run a and b until b has received one whole stream; returns (header, data)
+def transfer(a, b):
+    receiver = None
+    header = None
+    sink = Sink()
+    while True:
+        if a.want_write:
+            a.do_write()
+        if select.select([b], [], [], 0 if a.want_write else 1)[0]:
+            b.do_read()
+
+        while b.want_handle:
+            msg = b.dequeue()
+            if receiver is None:
+                (header, compressed) = parse_begin(msg)
+                receiver = StreamReceiver(sink, compressed)
+            elif receiver.feed(msg):
+                return (header, sink.value())
+
+def run_tests():
+    # compressible, but not trivially so
+    nibbles = ''.join( chr(i & 15) for i in range(256) )
+    data = os.urandom(StreamSender.window + 2 * StreamSender.chunk_size + 1234).translate(nibbles)
+
+    (fd, fname) = tempfile.mkstemp(suffix=".state")
+    os.write(fd, data)
+    os.close(fd)
+
+    try:
+        # a file, compressed
+        (a, b) = tutil.make_pair()
+        a.send_stream("STATE(1)", open(fname, 'r'))
+        assert transfer(a, b) == ("STATE(1)", data)
+
+        # a file, uncompressed
+        a.send_stream("STATE(2)", open(fname, 'r'), False)
+        assert transfer(a, b) == ("STATE(2)", data)
+
+        # an iterator, and an empty stream right behind it
+        a.send_stream("iter", iter(['abc', '', 'def']))
+        a.send_stream("empty", iter([]))
+        assert transfer(a, b) == ("iter", "abcdef")
+        assert transfer(a, b) == ("empty", "")
+        assert not a.want_write
+        a.close()
+        b.close()
+
+        # a receiver that isn't reading: the sender stops reading the file once its window is full
+        (a, b) = tutil.make_pair()
+        big = open(fname, 'r')
+        a.send_stream("STATE(3)", big, False)
+        for _ in range(20):
+            a.do_write()
+        assert big.tell() < len(data)
+        assert a.send_pending() <= StreamSender.window + StreamSender.chunk_size + 64
+        assert transfer(a, b) == ("STATE(3)", data)
+        assert big.closed
+        a.close()
+        b.close()
+
+    finally:
+        os.unlink(fname)
+
+    print "Stream tests passed."
+
+if __name__ == "__main__":
+    run_tests()
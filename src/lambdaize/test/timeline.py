@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+import sys
+import os
+import socket
+import tempfile
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu.machine_state import MachineState
+from libmu.socket_nb import SocketNB
+from libmu.timeline import TimelineWriter, read_timeline, load_timeline
+
+def run_tests():
+    (fd, fname) = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
+
+    try:
+        tl = TimelineWriter(fname, start_time=100, batch_size=2)
+        tl.record(0, 'StartState', 101, 0, 0)
+        tl.record(1, 'StartState', 102, 0, 0)
+        tl.record(0, 'FinalState', 103.5, 20, 40)
+
+        # a speculative duplicate of actor 1: same actor number, but tagged
+        (a, b) = socket.socketpair()
+        dupsock = SocketNB(a)
+        (dupsock.timeline, dupsock.speculative) = (tl, True)
+        dup = MachineState(dupsock, 1)
+        assert dup.speculative
+        dup.close()
+        b.close()
+        tl.close()
+
+        recs = list(read_timeline(fname))
+        assert recs[:3] == [ (0, 'StartState', 1, 0, 0, False)
+                           , (1, 'StartState', 2, 0, 0, False)
+                           , (0, 'FinalState', 3.5, 20, 40, False)
+                           ], "unexpected timeline %s" % str(recs)
+        assert [ (r[0], r[1], r[5]) for r in recs[3:] ] == [(1, 'MachineState', True)]
+
+        # the duplicate's transitions don't get mixed into actor 1's
+        actors = load_timeline(fname)
+        assert actors[0] == [(1, 'StartState'), (3.5, 'FinalState')]
+        assert actors[1] == [(2, 'StartState')]
+
+        # a partial last line (e.g., after a crash) is ignored
+        with open(fname, 'a') as f:
+            f.write('[1,1,10')
+        assert len(list(read_timeline(fname))) == 4
+
+    finally:
+        os.unlink(fname)
+
+    print "Timeline tests passed."
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+import sys
+import os
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu.timers import TimerQueue
+
+def run_tests():
+    fired = []
+    tq = TimerQueue()
+
+    t1 = tq.arm_at(10, fired.append, 1)
+    tq.arm_at(30, fired.append, 3)
+    tq.arm_at(20, fired.append, 2)
+    t4 = tq.arm_at(15, fired.append, 4)
+    assert len(tq) == 4
+
+    # cancelled timers never fire
+    tq.cancel(t4)
+    assert len(tq) == 3
+    assert tq.next_deadline() == 10
+
+    # only expired timers fire, and in deadline order
+    assert tq.run_expired(5) == 0
+    assert tq.run_expired(25) == 2
+    assert fired == [1, 2], "unexpected firing order %s" % str(fired)
+
+    # cancelling a timer that already fired is harmless
+    tq.cancel(t1)
+    assert len(tq) == 1
+    assert tq.poll_timeout(2000, now=29.5) == 501
+    assert tq.poll_timeout(2000, now=0) == 2000
+
+    assert tq.run_expired(100) == 1
+    assert fired == [1, 2, 3]
+    assert tq.next_deadline() is None
+
+    # lots of cancellations get compacted out of the heap
+    timers = [ tq.arm_at(i, fired.append, i) for i in range(0, 1000) ]
+    for t in timers[:900]:
+        tq.cancel(t)
+    assert len(tq) == 100
+    assert len(tq.heap) < 1000
+
+    print "Timer tests passed."
+
+if __name__ == "__main__":
+    run_tests()
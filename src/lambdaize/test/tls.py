@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+import sys
+import os
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from OpenSSL import SSL
+from OpenSSL._util import lib as _ssl_lib
+
+from libmu import util
+
+from test.defs import Defs as Td
+import test.util as tutil
+
+def handshake(a, b):
+    for _ in range(1000):
+        # a failed handshake closes the socket
+        assert a.sock is not None and b.sock is not None, "handshake failed"
+        if not (a.handshaking or b.handshaking):
+            return
+        a.do_handshake()
+        b.do_handshake()
+    assert False, "handshake never finished"
+
+def reused(sock):
+    return _ssl_lib.SSL_session_reused(sock.sock._ssl) == 1 # pylint: disable=protected-access
+
+def run_tests():
+    # one context per set of credentials
+    ctx = util.ssl_context(Td.cacert, Td.srvcrt, Td.srvkey)
+    assert util.ssl_context(Td.cacert, Td.srvcrt, Td.srvkey) is ctx
+
+    # the first connection does a full handshake; reconnects resume its session
+    ls = util.listen_socket('127.0.0.1', 0, Td.cacert, Td.srvcrt, Td.srvkey, 4)
+    port = ls.getsockname()[1]
+    for i in range(3):
+        cs = util.connect_socket('127.0.0.1', port, Td.cacert, Td.srvcrt, Td.srvkey)
+        ss = tutil.blocking_accept(ls)
+        handshake(cs, ss)
+        assert reused(cs) == (i > 0) and reused(ss) == (i > 0), "connection %d: session reuse %s/%s" % (i, reused(cs), reused(ss))
+
+        # and the connection works
+        tutil.blocking_send(cs, "hello %d" % i)
+        assert tutil.blocking_recv(ss) == "hello %d" % i
+        cs.close()
+        ss.close()
+
+    # what's kept for resumption is the session, not the connection it came from
+    assert len(util._ssl_sessions) == 1 # pylint: disable=protected-access
+    assert all( isinstance(sess, SSL.Session) for sess in util._ssl_sessions.values() ) # pylint: disable=protected-access
+    ls.close()
+
+    print "TLS tests passed."
+
+if __name__ == "__main__":
+    run_tests()
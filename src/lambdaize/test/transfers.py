@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+import sys
+import os
+import select
+import threading
+import time
+sys.path.insert(1, os.path.abspath(os.path.join(sys.path[0], os.pardir)))
+# insert parent directory in search path, since test/ lives alongside libmu
+
+from libmu import handler, Defs
+from libmu.executor import Executor
+import test.util as tutil
+
+# stands in for a boto3 client whose transfers take a while
+class SlowS3(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+
+    def _transfer(self, call):
+        with self.lock:
+            self.calls.append(call)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.1)
+        with self.lock:
+            self.active -= 1
+        if 'missing' in call[1]:
+            raise IOError("no such key")
+
+    def download_file(self, bucket, key, filename):
+        self._transfer(('download', key, filename, bucket))
+
+    def upload_file(self, filename, bucket, key):
+        self._transfer(('upload', key, filename, bucket))
+
+def make_urstring(msg, vals):
+    (key, filename) = msg.split('\0', 1)
+    return (True, vals['bucket'], key, filename.replace("##TMPDIR##", "/tmp/x"))
+
+def run_tests():
+    (s3_client, retrieve, upload) = (handler.s3_client, Defs.__dict__['make_retrievestring'], Defs.__dict__['make_uploadstring'])
+    handler.s3_client = SlowS3()
+    Defs.make_retrievestring = Defs.make_uploadstring = staticmethod(make_urstring)
+    try:
+        # a key template and a range, at most transfer_threads at a time
+        sock = tutil.FakeSock()
+        vals = {'cmdsock': sock, 'bucket': 'bkt', 'transfer_threads': 3}
+        start = time.time()
+        assert not handler.handle_message('retrieve_many:vid/%08d.png\0##TMPDIR##/%08d.png\x001:7', vals)
+        elapsed = time.time() - start
+        assert handler.s3_client.max_active == 3 and 0.2 <= elapsed < 0.5, "took %f" % elapsed
+        assert sorted(handler.s3_client.calls) == [ ('download', 'vid/%08d.png' % i, '/tmp/x/%08d.png' % i, 'bkt') for i in range(1, 7) ]
+        assert sock.sent[-1].startswith('OK:RETRIEVE_MANY(')
+        assert handler.expected_response('retrieve_many:') == 'OK:RETRIEV'
+        times = handler.parse_stats('OK:STATS(' + sock.sent[-1][len('OK:RETRIEVE_MANY('):])
+        assert sorted(times) == [ 'vid/%08d.png' % i for i in range(1, 7) ]
+        assert all( 0.1 <= secs < 0.3 for secs in times.values() )
+
+        # explicit pairs; one failure fails the lot
+        handler.s3_client = SlowS3()
+        assert not handler.handle_message('upload_many:a\0/f/a\0missing\0/f/b', vals)
+        assert sorted(call[:3] for call in handler.s3_client.calls) == [('upload', 'a', '/f/a'), ('upload', 'missing', '/f/b')]
+        assert sock.sent[-1].startswith('FAIL(upload_many: 1 of 2 objects failed:\nbkt/missing: ')
+
+        # bad syntax
+        assert not handler.handle_message('retrieve_many:a\0b\0c', vals)
+        assert sock.sent[-1] == 'FAIL(invalid syntax for retrieve_many)'
+
+        # in the background, it's one job on the executor
+        executor = Executor(2)
+        handler.s3_client = SlowS3()
+        vals.update({'executor': executor, 'nonblock': 1})
+        assert not handler.handle_message('retrieve_many:k%d\0f%d\x000:4', vals)
+        assert sock.sent[-1] == 'OK:RETRIEVING_MANY(4)' and executor.running == 1
+        while executor.busy():
+            for r in select.select(executor.rsocks(), [], [], 1)[0]:
+                r.do_read()
+        assert executor.dequeue().startswith('OK:RETRIEVE_MANY({"k0": ')
+        executor.close()
+
+    finally:
+        handler.s3_client = s3_client
+        (Defs.make_retrievestring, Defs.make_uploadstring) = (retrieve, upload)
+
+    print "Transfer tests passed."
+
+if __name__ == "__main__":
+    run_tests()
@@ -2,6 +2,7 @@
 
 import os
 import select
+import socket
 import sys
 import time
 import traceback
@@ -11,6 +12,7 @@ from OpenSSL import SSL
 
 import libmu
 from libmu import util
+from libmu.socket_nb import SocketNB
 
 import lambda_function_template
 
@@ -40,6 +42,30 @@ def blocking_accept(sock):
         raise Exception("timeout waiting to accept")
     return libmu.util.accept_socket(sock)
 
+# a connected pair of non-blocking sockets wrapped in cls
+def make_pair(cls=SocketNB):
+    (a, b) = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    return (cls(a), cls(b))
+
+# is there anything to read on sock within timeout seconds?
+def readable(sock, timeout=0.05):
+    return bool(select.select([sock], [], [], timeout)[0])
+
+# stands in for a worker's cmdsock; with record_ftype, sent holds (msg, ftype)
+class FakeSock(object):
+    def __init__(self, record_ftype=False):
+        self.sent = []
+        self.sock = True
+        self.record_ftype = record_ftype
+
+    def enqueue(self, msg, ftype=libmu.Defs.ftype_command):
+        self.sent.append((msg, ftype) if self.record_ftype else msg)
+
+    def close(self):
+        self.sock = None
+
 def run_lambda_function_template(event):
     print "Client starting."
 
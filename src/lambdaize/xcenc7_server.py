@@ -12,6 +12,7 @@ class ServerInfo(object):
     state_srv_addr = '127.0.0.1'
     state_srv_port = 13337
     state_srv_threads = 1
+    raw_state = False
 
     upload_states = False
 
@@ -162,6 +163,10 @@ class XCEnc7StartState(CommandListState):
         self.commands = [ s.format(vName, pStr, rStr, nNum, stateAddr, send_statefile) if s is not None else None for s in self.commands ]
 
 def run():
+    # pick this now so that all coordinator shards agree on it
+    if ServerInfo.client_uniq is None:
+        ServerInfo.client_uniq = util.rand_str(16)
+
     server.server_main_loop(ServerInfo.states, XCEnc7StartState, ServerInfo)
 
 def main():
@@ -175,6 +180,7 @@ def main():
             , "bg_silent": 1
             , "minimal_recode": 1
             , "expect_statefile": 1
+            , "raw_state": int(ServerInfo.raw_state)
             , "cacert": ServerInfo.cacert
             , "srvcrt": ServerInfo.srvcrt
             , "srvkey": ServerInfo.srvkey